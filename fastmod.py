@@ -2,45 +2,172 @@
 """\
 fastmod: Multithreaded utility for recursively changing permissions.
 
-Runs as a standalone script.
+Runs as a standalone script, or can be imported and used through `FastMod`.
 """
 
-import getpass
+import array
+import errno
 import grp
+import heapq
+import marshal
+import mmap
 import os
-import multiprocessing as mp
 import pwd
-import shutil
-import subprocess
+import resource
+import select
+import signal
+import stat
+import struct
 import sys
+import threading
 import time
+import types
+import queue as queue_module
+from queue import Full
 
 __copyright__ = "Copyright (c) 2023 Broadcom Corporation. All rights reserved."
 __license__ = "Public Domain"
-__version__ = "2.0.2"
+__version__ = "2.1.0"
 
-# Logs chmod/chgrp commands and checks their return status.
+# Logs each chmod/chgrp operation performed by the workers.
 DEBUG = False
 
-# How many files to change per chmod/chgrp command.
+# How many files each worker buffers before applying changes.
 DEFAULT_BLOCKSIZE = int(os.environ.get("FASTMOD_BLOCKSIZE", 128))
 
 # How many worker processes to create.
-DEFAULT_CORES = int(os.environ.get("FASTMOD_CORES", os.cpu_count() - 1))
+DEFAULT_CORES = int(os.environ.get("FASTMOD_CORES",
+                                   max(1, os.cpu_count() - 1)))
+
+# Most workers -Cauto may start.
+AUTO_MAX_CORES = int(
+    os.environ.get("FASTMOD_AUTO_MAX_CORES", max(4, 4 * os.cpu_count())))
+
+# Seconds of throughput measured before each -Cauto/-Bauto adjustment.
+TUNE_WINDOW = 1.0
+
+# Relative throughput gain that counts as an improvement when tuning.
+TUNE_MIN_GAIN = 1.05
+
+# Range of batch sizes tried by -Bauto.
+TUNE_MIN_BLOCKSIZE = 16
+TUNE_MAX_BLOCKSIZE = 4096
+
+# How many directory entries may wait in the work queue at once.
+DEFAULT_MAX_INFLIGHT = int(os.environ.get("FASTMOD_MAX_INFLIGHT", 262144))
+
+# Whether workers are "processes", "threads" or chosen "auto"matically.
+DEFAULT_ENGINE = os.environ.get("FASTMOD_ENGINE", "auto")
+
+# Most metadata operations per second on each filesystem. 0 for no limit.
+DEFAULT_MAX_OPS = float(os.environ.get("FASTMOD_MAX_OPS", 0))
+
+# Most operations a worker counts before settling with the shared limit.
+MAX_THROTTLE_CHUNK = 64
+
+# Seconds between --progress lines if no interval is given.
+DEFAULT_PROGRESS_INTERVAL = 5
+
+# Filesystems whose metadata operations are dominated by network latency.
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "ceph",
+    "beegfs", "glusterfs", "fuse.glusterfs", "fuse.sshfs", "9p", "afs"
+}
 
 # Preset to use if no flag or preset is specified.
 DEFAULT_PRESET = os.environ.get("FASTMOD_PRESET", "umask")
 
+# Where to keep scan indexes for --index.
+CACHE_DIR = os.environ.get(
+    "FASTMOD_CACHE_DIR",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "fastmod"))
+
+# Most subdirectories sent to the workers in one queue message.
+MAX_DIR_CHUNK = 64
+
+# Entries a worker lists between checks for a stop.
+STOP_CHECK_ENTRIES = 64
+
+# Kinds of entries named by a queue message, and of the control messages
+# sent to every worker of a pool at once.
+WORK_FILES = 0
+WORK_DIRS = 1
+WORK_SETUP = 2
+WORK_REPORT = 3
+WORK_RESTORE = 4
+WORK_SHALLOW = 5
+
+# Bump when the layout of index records changes.
+INDEX_VERSION = 1
+
+# Directories modified more recently than this are never recorded in the
+# index, since a new entry might not have changed their mtime.
+INDEX_RACY_NS = 2_000_000_000
+
+# Units accepted by --newer and --older, in seconds.
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Slots in each pool's table of hardlinked inodes. Inodes beyond three
+# quarters of this are not tracked and may be changed more than once.
+LINK_SLOTS = int(os.environ.get("FASTMOD_LINK_SLOTS", 1 << 20))
+
+# Bump when the layout of --journal files changes.
+JOURNAL_VERSION = 1
+
+# Seconds between fsyncs of the journal, and how much of it a worker buffers
+# before writing it out in between.
+JOURNAL_SYNC_INTERVAL = 5
+JOURNAL_BUFFER_SIZE = 65536
+
+# How much of the --audit-paths output a worker buffers before writing it.
+AUDIT_BUFFER_SIZE = 65536
+
+# Most (mode, group) rows printed by --audit.
+AUDIT_MAX_ROWS = 20
+
+# Layout of --snapshot files. While a run goes, workers append a log record
+# of (mode, uid, gid, path length) and the path for each entry they are about
+# to change. Once it ends, the log is turned into a manifest: a header of
+# (magic, records, waves, offset of the paths), the index after the last
+# record of each restore wave, the records of (path offset, path length,
+# mode, uid, gid), and the paths.
+SNAPSHOT_LOG_MAGIC = b"FMSLOG1\n"
+SNAPSHOT_LOG_RECORD = struct.Struct("<IIII")
+SNAPSHOT_MAGIC = b"FMSNAP1\n"
+SNAPSHOT_HEADER = struct.Struct("<8sQQQ")
+SNAPSHOT_RECORD = struct.Struct("<QIIII")
+
+# Seconds --watch keeps gathering events after the first one before applying
+# them as one batch, and most events it gathers into a batch.
+DEFAULT_WATCH_DELAY = 1.0
+MAX_WATCH_BATCH = 65536
+
+# Seconds between rescans of the folders --watch cannot watch, e.g. once the
+# inotify watch limit is reached.
+WATCH_RESCAN_INTERVAL = float(os.environ.get("FASTMOD_WATCH_RESCAN", 300))
+
+# Number of work items --cooperate splits a run into, and how many more it
+# accepts rather than leave a folder with many subfolders as one item.
+COOPERATE_ITEMS = int(os.environ.get("FASTMOD_COOPERATE_ITEMS", 1024))
+COOPERATE_MAX_ITEMS = 4 * COOPERATE_ITEMS
+
+# Seconds after which a --cooperate lease that has not been renewed is taken
+# to belong to a crashed instance. Leases are renewed three times as often.
+COOPERATE_LEASE = float(os.environ.get("FASTMOD_LEASE", 60))
+
+# Seconds between looks at the --cooperate directory while waiting.
+COOPERATE_POLL = 1.0
+
 
 def get_umask_str():
-    """Returns the user's umask as a chmod-style string."""
-    umask_exe = shutil.which("umask")
-    umask_cmd = subprocess.Popen([umask_exe, "-S"],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 text=True)
-    umask, _ = umask_cmd.communicate()
-    return umask.strip()
+    """Returns the user's umask as a chmod-style string, like `umask -S`."""
+    allowed = ~get_umask()
+    return ",".join(
+        who + "=" + "".join(perm for perm, bit in zip("rwx", (4, 2, 1))
+                            if allowed >> shift & bit)
+        for who, shift in (("u", 6), ("g", 3), ("o", 0)))
 
 
 def calculate_umask_modifier(umask_str):
@@ -77,23 +204,8 @@ def calculate_umask_modifier(umask_str):
     return mod_str_fil, mod_str_dir
 
 
-def _test_calculate_umask_modifier():
-    assert calculate_umask_modifier("u=rwx,g=rwx,o=rwx") == (
-        "u+rw,g+rw,o+rw", "u+rwx,g+rwx,o+rwx")
-    assert calculate_umask_modifier("u=rwx,g=rx,o=") == ("u+rw,g+r-w,o-rwx",
-                                                         "u+rwx,g+rx-w,o-rwx")
-    assert calculate_umask_modifier("u=rx,g=rx,o=") == ("u+r-w,g+r-w,o-rwx",
-                                                        "u+rx-w,g+rx-w,o-rwx")
-    assert calculate_umask_modifier("u=,g=,o=") == ("u-rwx,g-rwx,o-rwx",
-                                                    "u-rwx,g-rwx,o-rwx")
-    assert calculate_umask_modifier("u=rw,g=rw,o=r") == (
-        "u+rw-x,g+rw-x,o+r-wx", "u+rw-x,g+rw-x,o+r-wx")
-
-
-_test_calculate_umask_modifier()
-
-_umask_fil, _umask_dir = calculate_umask_modifier(get_umask_str())
-
+# Named file and folder permissions. The umask preset is only filled in by
+# get_presets(), once presets are needed.
 PRESETS = {
     "baseline": {
         "fil": "u+rw,g+r-w,o+r-w",
@@ -115,62 +227,1593 @@ PRESETS = {
         "fil": "a-w,+t",
         "dir": "a-w,+t"
     },
-    "umask": {
-        "fil": _umask_fil,
-        "dir": _umask_dir
-    }
+    "umask": None
 }
 
-PRIMARY_GROUP = grp.getgrgid(pwd.getpwnam(getpass.getuser()).pw_gid).gr_name
-
-if DEBUG:
-    # DEBUG WRAPPER FOR TESTING
-    _real_system = os.system
-    def wrapped_system(cmd):
-        print(os.getpid(), cmd)
-        ret = _real_system(cmd)
-        if ret != 0:
-            print(f"ERROR :: {cmd} failed with exit code {ret}")
-    os.system = wrapped_system
-
-
-def worker_main(queue, group, quiet, blocksize, nontrivial):
-    """Entry point for worker process."""
-    buffer = {}
-    if quiet:
-        chmod = "chmod -f"
-        chgrp = f"chgrp -f {group}"
-    else:
-        chmod = "chmod"
-        chgrp = f"chgrp {group}"
-    while True:
-        root, name, perms = queue.get()
-        if name == ".":
-            path = root
+
+def get_presets():
+    """Returns PRESETS with the umask preset filled in."""
+    if PRESETS["umask"] is None:
+        umask_fil, umask_dir = calculate_umask_modifier(get_umask_str())
+        PRESETS["umask"] = {"fil": umask_fil, "dir": umask_dir}
+    return PRESETS
+
+
+def primary_group():
+    """Returns the name of the user's primary group."""
+    import getpass
+    return grp.getgrgid(pwd.getpwnam(getpass.getuser()).pw_gid).gr_name
+
+
+# Permission bits selected by each chmod "who" character.
+_WHO_BITS = {
+    "u": stat.S_ISUID | stat.S_IRWXU,
+    "g": stat.S_ISGID | stat.S_IRWXG,
+    "o": stat.S_ISVTX | stat.S_IRWXO,
+    "a": 0o7777,
+}
+
+# Permission bits named by each chmod permission character. 'X' is handled
+# separately since it depends on the mode of the file being changed.
+_PERM_BITS = {
+    "r": 0o444,
+    "w": 0o222,
+    "x": 0o111,
+    "s": stat.S_ISUID | stat.S_ISGID,
+    "t": stat.S_ISVTX,
+}
+
+
+def get_umask():
+    """Returns the process umask, without changing it where the kernel
+    reports it."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def compile_perm(s, umask=0o022):
+    """Compiles a chmod-style permission string into a list of changes that
+    can be applied to a mode with `apply_perm`.
+
+    Follows the semantics of GNU chmod: without a "who" selector the umask
+    masks the change, and directories keep their set-user-ID and set-group-ID
+    bits unless the change explicitly mentions them.
+
+    Each change is a tuple of (op, value, mask, preserved, mentioned, x_if_any).
+
+    Raises ValueError if the string is not a valid permission string.
+    """
+    while s.startswith("%"):
+        s = s[1:]
+    if s and all(c in "01234567" for c in s):
+        value = int(s, 8)
+        if value > 0o7777:
+            raise ValueError(f"invalid permission string '{s}'")
+        if len(s) < 5:
+            mentioned = (value & (stat.S_ISUID | stat.S_ISGID)) | 0o1777
         else:
-            path = f"{root}/{name}"
+            mentioned = 0o7777
+        return [("=", value, 0o7777, 0, mentioned, False)]
 
-        if root is None:
-            break
+    changes = []
+    for group in s.split(","):
+        affected = 0
+        i = 0
+        while i < len(group) and group[i] in _WHO_BITS:
+            affected |= _WHO_BITS[group[i]]
+            i += 1
+        if i == len(group):
+            raise ValueError(f"invalid permission string '{s}'")
+        mask = affected if affected else 0o7777 & ~umask
+        preserved = 0o7777 & ~affected if affected else 0
+        while i < len(group):
+            op = group[i]
+            if op not in "+-=":
+                raise ValueError(f"invalid permission string '{s}'")
+            i += 1
+            value = 0
+            x_if_any = False
+            while i < len(group) and group[i] not in "+-=":
+                if group[i] == "X":
+                    x_if_any = True
+                elif group[i] in _PERM_BITS:
+                    value |= _PERM_BITS[group[i]]
+                else:
+                    raise ValueError(f"invalid permission string '{s}'")
+                i += 1
+            mentioned = affected & value if affected else value
+            changes.append((op, value, mask, preserved, mentioned, x_if_any))
+    return changes
+
+
+def apply_perm(changes, mode, is_dir):
+    """Returns the permission bits resulting from applying the compiled
+    `changes` to `mode`."""
+    new_mode = mode & 0o7777
+    for op, value, mask, preserved, mentioned, x_if_any in changes:
+        omit = (stat.S_ISUID | stat.S_ISGID) & ~mentioned if is_dir else 0
+        if x_if_any and (is_dir or new_mode & 0o111):
+            value |= 0o111
+        value &= mask & ~omit
+        if op == "=":
+            new_mode = (new_mode & (preserved | omit)) | value
+        elif op == "+":
+            new_mode |= value
+        else:
+            new_mode &= ~value
+    return new_mode
+
+
+def lstat_entry(path, quiet, failed=None, metrics=None, throttle=None,
+                timed=False):
+    """Returns the lstat result of an entry for apply_changes(), or None if
+    it cannot be had, in which case the path is appended to `failed` if
+    given."""
+    ns = None
+    try:
+        if timed:
+            start = time.perf_counter_ns()
+        st = os.lstat(path)
+        if timed:
+            ns = time.perf_counter_ns() - start
+        return st
+    except OSError as e:
+        if not quiet:
+            print(f"fastmod: cannot access '{path}': {e.strerror}",
+                  file=sys.stderr)
+        if failed is not None:
+            failed.append(path)
+        if metrics is not None:
+            metrics.counts["errors"] += 1
+        return None
+    finally:
+        if throttle is not None:
+            throttle.charge(ns)
+
+
+def would_change(st, changes, gid):
+    """Returns whether apply_changes() would modify an entry."""
+    if gid is not None and st.st_gid != gid:
+        return True
+    mode = st.st_mode
+    return changes is not None and not stat.S_ISLNK(mode) and \
+        apply_perm(changes, mode, stat.S_ISDIR(mode)) != stat.S_IMODE(mode)
+
+
+def apply_changes(entries, changes, gid, quiet, failed=None, metrics=None,
+                  throttle=None, snapshot=None):
+    """Applies group ownership and compiled permission changes to each
+    (path, stat) entry, looking up the stat result if it is None.
+
+    Paths that could not be changed are appended to `failed` if given. The
+    latency of each chmod and chgrp is recorded in `metrics` if given, and
+    every syscall is charged to `throttle` if given. If given, `snapshot` is
+    called with the (path, stat) of the entries that are to be modified
+    before any of them is; if it returns False, they are all left alone and
+    appended to `failed`.
+
+    Only issues a chown or chmod when it would actually change something.
+    Symbolic links are never followed: their own group is changed, but, as
+    with `chmod -R`, their permissions are left alone.
+
+    Return: the number of entries that were changed.
+    """
+    timed = metrics is not None or (throttle is not None and
+                                    throttle.adaptive)
+    changed = 0
+    if snapshot is not None:
+        resolved = []
+        for path, st in entries:
+            if st is None:
+                st = lstat_entry(path, quiet, failed, metrics, throttle,
+                                 timed)
+                if st is None:
+                    continue
+            resolved.append((path, st))
+        entries = [(path, st) for path, st in resolved
+                   if would_change(st, changes, gid)]
+        if entries and not snapshot(entries):
+            if failed is not None:
+                failed.extend(path for path, _ in entries)
+            return 0
+    for path, st in entries:
+        if st is None:
+            st = lstat_entry(path, quiet, failed, metrics, throttle, timed)
+            if st is None:
+                continue
+        mode = st.st_mode
+        modified = False
+        if gid is not None and st.st_gid != gid:
+            ns = None
+            try:
+                if timed:
+                    start = time.perf_counter_ns()
+                os.chown(path, -1, gid, follow_symlinks=False)
+                if timed:
+                    ns = time.perf_counter_ns() - start
+                    if metrics is not None:
+                        metrics.record("chgrp", ns)
+                modified = True
+                if DEBUG:
+                    print(os.getpid(), "chgrp", gid, path)
+            except OSError as e:
+                if not quiet:
+                    print(f"fastmod: changing group of '{path}': "
+                          f"{e.strerror}", file=sys.stderr)
+                if failed is not None:
+                    failed.append(path)
+                if metrics is not None:
+                    metrics.counts["errors"] += 1
+            finally:
+                if throttle is not None:
+                    throttle.charge(ns)
+            if modified and mode & (stat.S_ISUID | stat.S_ISGID) and \
+                    not stat.S_ISDIR(mode):
+                # The kernel may clear setuid/setgid when the group
+                # changes, so start from what is actually on disk.
+                st = lstat_entry(path, quiet, failed, metrics, throttle,
+                                 timed)
+                if st is None:
+                    changed += 1
+                    continue
+                mode = st.st_mode
+        if changes is not None and not stat.S_ISLNK(mode):
+            new_mode = apply_perm(changes, mode, stat.S_ISDIR(mode))
+            if new_mode != stat.S_IMODE(mode):
+                ns = None
+                try:
+                    if timed:
+                        start = time.perf_counter_ns()
+                    os.chmod(path, new_mode)
+                    if timed:
+                        ns = time.perf_counter_ns() - start
+                        if metrics is not None:
+                            metrics.record("chmod", ns)
+                    modified = True
+                    if DEBUG:
+                        print(os.getpid(), "chmod", oct(new_mode), path)
+                except OSError as e:
+                    if not quiet:
+                        print(f"fastmod: changing permissions of '{path}': "
+                              f"{e.strerror}", file=sys.stderr)
+                    if failed is not None:
+                        failed.append(path)
+                    if metrics is not None:
+                        metrics.counts["errors"] += 1
+                finally:
+                    if throttle is not None:
+                        throttle.charge(ns)
+        changed += modified
+    return changed
+
+
+def restore_changes(records, quiet, failed=None, throttle=None):
+    """Sets each (path, mode, uid, gid) record of a --snapshot manifest back
+    on its entry.
 
-        buffer.setdefault(perms, set()).add(path)
+    Paths that could not be restored, or that are no longer the same kind of
+    entry, are appended to `failed` if given, and every syscall is charged to
+    `throttle` if given.
 
-        buffered = buffer[perms]
-        if len(buffered) >= blocksize:
-            joined_paths = ' '.join([f"'{b}'" for b in buffered])
-            if group is not None:
-                os.system(f"{chgrp} " + joined_paths)
-            if nontrivial:
-                os.system(f"{chmod} {perms} " + joined_paths)
-            buffer[perms].clear()
-    for perms, buffered in buffer.items():
-        if not buffered:
+    Like apply_changes(), only issues a chown or chmod when it would change
+    something, so that restoring only the group needs no privileges, and
+    leaves the permissions of symbolic links alone.
+
+    Return: the number of entries that were changed.
+    """
+    changed = 0
+    for path, mode, uid, gid in records:
+        try:
+            try:
+                st = os.lstat(path)
+            finally:
+                if throttle is not None:
+                    throttle.charge()
+            if stat.S_IFMT(st.st_mode) != stat.S_IFMT(mode):
+                raise OSError(errno.EEXIST, "no longer the same kind of entry")
+            modified = False
+            if st.st_uid != uid or st.st_gid != gid:
+                try:
+                    os.chown(path, uid if st.st_uid != uid else -1,
+                             gid if st.st_gid != gid else -1,
+                             follow_symlinks=False)
+                finally:
+                    if throttle is not None:
+                        throttle.charge()
+                modified = True
+            # A chown may have cleared setuid and setgid.
+            if not stat.S_ISLNK(mode) and (
+                    stat.S_IMODE(st.st_mode) != stat.S_IMODE(mode) or
+                    modified and mode & (stat.S_ISUID | stat.S_ISGID)):
+                try:
+                    os.chmod(path, stat.S_IMODE(mode))
+                finally:
+                    if throttle is not None:
+                        throttle.charge()
+                modified = True
+        except OSError as e:
+            if not quiet:
+                print(f"fastmod: cannot restore '{os.fsdecode(path)}': "
+                      f"{e.strerror}", file=sys.stderr)
+            if failed is not None:
+                failed.append(path)
             continue
-        joined_paths = ' '.join([f"'{b}'" for b in buffered])
-        if group is not None:
-            os.system(f"{chgrp} " + joined_paths)
-        if nontrivial:
-            os.system(f"{chmod} {perms} " + joined_paths)
+        changed += modified
+    return changed
+
+
+class Throttle:
+    """A worker's handle on the token bucket shared by the workers of a pool,
+    for --max-ops and --adaptive.
+
+    Workers charge every metadata syscall to their handle, which only settles
+    with the shared bucket every `chunk` operations to keep lock traffic low.
+    A worker that overdraws the bucket sleeps until it is back in credit.
+
+    With --adaptive, the average latency of the charged operations is
+    compared to the threshold every ADJUST_INTERVAL seconds: above it, the
+    rate drops to 80% of what was achieved; below it, the rate grows by 10%
+    back towards the --max-ops ceiling, or back to unlimited if there is
+    none.
+    """
+    # Slots of the shared state.
+    TOKENS, REFILLED, RATE, WINDOW_START, WINDOW_OPS, LATENCY_NS, SAMPLES = \
+        range(7)
+
+    ADJUST_INTERVAL = 0.5
+
+    def __init__(self, shared, max_rate, threshold_ns, chunk):
+        self.state, self.lock = shared
+        self.max_rate = max_rate
+        self.threshold_ns = threshold_ns
+        self.adaptive = threshold_ns is not None
+        self.chunk = chunk
+        self.ops = 0
+        self.latency_ns = 0
+        self.samples = 0
+
+    @staticmethod
+    def create_shared(max_rate, shared):
+        """Returns the state shared by the workers of one pool, made with the
+        primitives of `shared`. A rate of 0 means unlimited."""
+        state = shared.RawArray("d", 7)
+        now = time.monotonic()
+        state[Throttle.TOKENS] = max_rate
+        state[Throttle.REFILLED] = now
+        state[Throttle.RATE] = max_rate
+        state[Throttle.WINDOW_START] = now
+        return state, shared.Lock()
+
+    def charge(self, latency_ns=None):
+        """Counts one metadata operation and its latency, if measured."""
+        self.ops += 1
+        if latency_ns is not None:
+            self.latency_ns += latency_ns
+            self.samples += 1
+        if self.ops >= self.chunk:
+            self.settle()
+
+    def settle(self):
+        """Takes the locally counted operations from the shared bucket and
+        waits if that leaves it overdrawn."""
+        state = self.state
+        wait = 0
+        with self.lock:
+            now = time.monotonic()
+            rate = state[self.RATE]
+            if rate:
+                state[self.TOKENS] = min(
+                    rate, state[self.TOKENS] +
+                    (now - state[self.REFILLED]) * rate) - self.ops
+                state[self.REFILLED] = now
+                if state[self.TOKENS] < 0:
+                    wait = -state[self.TOKENS] / rate
+            if self.adaptive:
+                state[self.WINDOW_OPS] += self.ops
+                state[self.LATENCY_NS] += self.latency_ns
+                state[self.SAMPLES] += self.samples
+                if now - state[self.WINDOW_START] >= self.ADJUST_INTERVAL:
+                    self.adjust(now)
+        self.ops = self.latency_ns = self.samples = 0
+        if wait:
+            time.sleep(max(wait, 0))
+
+    def adjust(self, now):
+        """Adapts the shared rate to the latency seen in the last window.
+        Called with the lock held."""
+        state = self.state
+        achieved = state[self.WINDOW_OPS] / (now - state[self.WINDOW_START])
+        rate = state[self.RATE]
+        if state[self.SAMPLES] and state[self.LATENCY_NS] / \
+                state[self.SAMPLES] > self.threshold_ns:
+            rate = max(1.0, 0.8 * (min(rate, achieved) if rate else achieved))
+        elif rate:
+            rate *= 1.1
+            if self.max_rate:
+                rate = min(rate, self.max_rate)
+            elif rate > 2 * achieved:
+                # Well above demand, so no longer limiting anything.
+                rate = 0
+        state[self.RATE] = rate
+        state[self.TOKENS] = min(state[self.TOKENS], rate)
+        state[self.WINDOW_START] = now
+        state[self.WINDOW_OPS] = 0
+        state[self.LATENCY_NS] = 0
+        state[self.SAMPLES] = 0
+
+
+class Metrics:
+    """Counters and latency histograms kept by one worker for --metrics.
+
+    Latencies go into power-of-two histograms: bucket i counts operations
+    that took less than 2**i microseconds (and at least half that).
+    """
+    NBUCKETS = 32
+    NSLOWEST = 10
+
+    def __init__(self):
+        self.counts = {
+            "directories": 0,
+            "entries": 0,
+            "chmod": 0,
+            "chgrp": 0,
+            "errors": 0
+        }
+        self.histograms = {
+            "walk": [0] * self.NBUCKETS,
+            "chmod": [0] * self.NBUCKETS,
+            "chgrp": [0] * self.NBUCKETS
+        }
+        self.slowest = []
+        self.apply_ns = 0
+
+    def record(self, op, ns):
+        """Records the latency of one operation."""
+        self.counts[op] += 1
+        bucket = min((ns // 1000).bit_length(), self.NBUCKETS - 1)
+        self.histograms[op][bucket] += 1
+
+    def record_directory(self, path, ns, nentries):
+        """Records the time taken to list one directory."""
+        self.counts["directories"] += 1
+        self.counts["entries"] += nentries
+        bucket = min((ns // 1000).bit_length(), self.NBUCKETS - 1)
+        self.histograms["walk"][bucket] += 1
+        self.note_slow_directory(path, ns)
+
+    def note_slow_directory(self, path, ns):
+        """Keeps the directory if it is one of the slowest seen so far."""
+        if len(self.slowest) < self.NSLOWEST:
+            heapq.heappush(self.slowest, (ns, path))
+        elif ns > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (ns, path))
+
+    def as_dict(self):
+        """Returns the metrics as a JSON-serializable dict."""
+        return {
+            "counts": self.counts,
+            "histograms_us_log2": self.histograms,
+            "slowest_directories": [{
+                "path": path,
+                "seconds": ns / 1e9
+            } for ns, path in sorted(self.slowest, reverse=True)]
+        }
+
+
+def write_metrics(path, worker_metrics, summary):
+    """Writes per-worker and merged metrics as JSON."""
+    import json
+    merged = Metrics()
+    for metrics in worker_metrics:
+        for name, count in metrics["counts"].items():
+            merged.counts[name] += count
+        for op, histogram in metrics["histograms_us_log2"].items():
+            merged.histograms[op] = [
+                a + b for a, b in zip(merged.histograms[op], histogram)
+            ]
+        for directory in metrics["slowest_directories"]:
+            merged.note_slow_directory(directory["path"],
+                                       int(directory["seconds"] * 1e9))
+    with open(path, "w") as f:
+        json.dump({
+            "summary": summary,
+            "total": merged.as_dict(),
+            "workers": worker_metrics
+        }, f, indent=2)
+        f.write("\n")
+
+
+def print_audit(total, offending, violations, histogram):
+    """Prints the findings of --audit, with the most common (mode, group)
+    pairs first."""
+    print(f"audited {total} entries: {offending} would change "
+          f"({violations['mode']} permissions, {violations['group']} group), "
+          f"{total - offending} already correct")
+    rows = sorted(histogram.items(), key=lambda item: -item[1])
+    if rows:
+        print(f"  {'count':>12}  {'mode':<10}  group")
+    for (mode, gid), count in rows[:AUDIT_MAX_ROWS]:
+        try:
+            group = grp.getgrgid(gid).gr_name
+        except KeyError:
+            group = str(gid)
+        print(f"  {count:>12}  {stat.filemode(mode):<10}  {group}")
+    if len(rows) > AUDIT_MAX_ROWS:
+        print(f"  ... and {len(rows) - AUDIT_MAX_ROWS} more (mode, group) "
+              f"pairs")
+
+
+def progress_main(stop, pools, interval):
+    """Entry point for the thread printing --progress lines."""
+    start = time.time()
+    while not stop.wait(interval):
+        discovered = applied = depth = 0
+        depth_known = True
+        for pool in pools:
+            discovered += sum(pool.counters[0::2])
+            applied += sum(pool.counters[1::2])
+            try:
+                depth += pool.queue.qsize()
+            except NotImplementedError:
+                depth_known = False
+        elapsed = time.time() - start
+        print(f"fastmod: {discovered} found, {applied} applied, "
+              f"{applied / elapsed:.01f} files/s, "
+              f"queue {depth if depth_known else '?'}",
+              file=sys.stderr, flush=True)
+
+
+class Tuner:
+    """Adjusts a running pool for -Cauto and -Bauto.
+
+    Hill-climbs on the rate at which the workers apply entries, measured over
+    TUNE_WINDOW seconds: first the number of active workers is doubled until
+    throughput stops improving by TUNE_MIN_GAIN, then the batch size is
+    doubled or, if that does not help, halved in the same way. The best
+    values found are kept for the rest of the run. `grow` is called with the
+    number of workers about to be made active, to start them if need be.
+    """
+    def __init__(self, counters, active, blocksize, max_cores, tune_cores,
+                 tune_blocksize, grow=None):
+        self.counters = counters
+        self.active = active
+        self.blocksize = blocksize
+        self.max_cores = max_cores
+        self.grow = grow
+        self.phases = []
+        if tune_cores:
+            self.phases.append("cores")
+        if tune_blocksize:
+            self.phases.extend(["blocksize-up", "blocksize-down"])
+        self.best_rate = None
+        self.best = {"cores": active.value, "blocksize": blocksize.value}
+        self.improved = False
+        self.windows = 0
+
+    def run(self, stop):
+        """Tunes until `stop` is set."""
+        applied = 0
+        last = time.monotonic()
+        while self.phases and not stop.wait(TUNE_WINDOW):
+            now = time.monotonic()
+            total = sum(self.counters[1::2])
+            self.step((total - applied) / (now - last))
+            applied = total
+            last = now
+
+    def step(self, rate):
+        """Takes one hill-climbing step given the rate of the last window."""
+        self.windows += 1
+        if self.best_rate is None or rate > self.best_rate * TUNE_MIN_GAIN:
+            if self.best_rate is not None:
+                self.improved = True
+            self.best_rate = rate
+            self.best["cores"] = self.active.value
+            self.best["blocksize"] = self.blocksize.value
+            if self.try_next(self.phases[0]):
+                return
+        else:
+            self.active.value = self.best["cores"]
+            self.blocksize.value = self.best["blocksize"]
+        if self.phases.pop(0) == "blocksize-up" and self.improved:
+            # Growing batches helped, so there is no point shrinking them.
+            self.phases.remove("blocksize-down")
+        self.improved = False
+        while self.phases and not self.try_next(self.phases[0]):
+            self.phases.pop(0)
+
+    def try_next(self, phase):
+        """Moves to the next value to try in `phase`.
+
+        Return: whether there was a value left to try.
+        """
+        if phase == "cores":
+            if self.active.value >= self.max_cores:
+                return False
+            cores = min(self.max_cores, 2 * self.active.value)
+            if self.grow is not None:
+                self.grow(cores)
+            self.active.value = cores
+        elif phase == "blocksize-up":
+            if self.blocksize.value >= TUNE_MAX_BLOCKSIZE:
+                return False
+            self.blocksize.value = 2 * self.blocksize.value
+        else:
+            if self.blocksize.value <= TUNE_MIN_BLOCKSIZE:
+                return False
+            self.blocksize.value = self.blocksize.value // 2
+        return True
+
+
+def load_tuning(key):
+    """Returns the cached {"cores", "blocksize"} tuned for a mount, or
+    None."""
+    import json
+    try:
+        with open(os.path.join(CACHE_DIR, "tuning.json")) as f:
+            tuned = json.load(f)[key]
+        return {"cores": int(tuned["cores"]),
+                "blocksize": int(tuned["blocksize"])}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_tuning(key, cores, blocksize, quiet):
+    """Remembers the values tuned for a mount."""
+    import json
+    path = os.path.join(CACHE_DIR, "tuning.json")
+    try:
+        try:
+            with open(path) as f:
+                tuned = json.load(f)
+            if not isinstance(tuned, dict):
+                tuned = {}
+        except (OSError, ValueError):
+            tuned = {}
+        tuned[key] = {
+            "cores": cores,
+            "blocksize": blocksize,
+            "updated": time.time()
+        }
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".tuning-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(tuned, f, indent=2)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        if not quiet:
+            print(f"fastmod: notice: could not save tuning '{path}': {e}",
+                  file=sys.stderr)
+
+
+class InodeSet:
+    """A fixed-size set of inode numbers in shared memory, through which the
+    workers of one pool claim hardlinked files so that each inode is only
+    changed once. Pools are per filesystem, so inode numbers are unique.
+
+    Open addressing with linear probing, split into shards with a lock each.
+    Uses 8 bytes per slot, in anonymous shared memory that worker processes
+    inherit and that only takes up memory once the first hardlink is
+    claimed.
+    """
+    SHARDS = 16
+
+    def __init__(self, slots, shared):
+        self.shard_slots = max(64, slots // self.SHARDS)
+        self.limit = self.shard_slots * 3 // 4
+        self.memory = mmap.mmap(-1, self.shard_slots * self.SHARDS * 8)
+        self.table = memoryview(self.memory).cast("Q")
+        self.sizes = shared.RawArray("q", self.SHARDS)
+        self.locks = [shared.Lock() for _ in range(self.SHARDS)]
+
+    def clear(self):
+        """Empties the set, handing its memory back. Only to be called while
+        no worker is claiming."""
+        if not any(self.sizes):
+            return
+        try:
+            self.memory.madvise(mmap.MADV_REMOVE)
+        except (AttributeError, OSError):
+            self.table[:] = memoryview(bytes(len(self.memory))).cast("Q")
+        for shard in range(self.SHARDS):
+            self.sizes[shard] = 0
+
+    def claim(self, ino):
+        """Adds an inode to the set.
+
+        Return: True if it was not in the set yet, False if it was, or None
+        if it could not be tracked.
+        """
+        if not ino:
+            # Slots holding 0 are empty.
+            return None
+        h = (ino * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        shard = h >> 60
+        slots = self.shard_slots
+        base = shard * slots
+        i = h % slots
+        table = self.table
+        with self.locks[shard]:
+            while True:
+                value = table[base + i]
+                if value == ino:
+                    return False
+                if not value:
+                    if self.sizes[shard] >= self.limit:
+                        return None
+                    table[base + i] = ino
+                    self.sizes[shard] += 1
+                    return True
+                i = (i + 1) % slots
+
+
+class Filter:
+    """The --include, --exclude and --prune rules and the --owner,
+    --in-group, --newer and --older filters of a configuration.
+
+    Glob patterns without a slash are matched against entry names, and those
+    with one against whole paths. Regular expressions are searched for in
+    whole paths.
+    """
+    def __init__(self, config):
+        self.include = self.compile_rules(config.include)
+        self.exclude = self.compile_rules(config.exclude)
+        self.prune = self.compile_rules(config.prune)
+        self.uid = config.owner
+        self.gid = config.in_group
+        now_ns = time.time_ns()
+        self.newer_ns = self.older_ns = None
+        if config.newer is not None:
+            self.newer_ns = now_ns - int(config.newer * 1e9)
+        if config.older is not None:
+            self.older_ns = now_ns - int(config.older * 1e9)
+        self.by_age = config.newer is not None or config.older is not None
+        self.needs_stat = self.by_age or self.uid is not None or \
+            self.gid is not None
+
+    @staticmethod
+    def compile_rules(rules):
+        """Compiles (kind, pattern) rules into (match, on_path) pairs."""
+        import fnmatch
+        import re
+        compiled = []
+        for kind, pattern in rules:
+            if kind == "regex":
+                compiled.append((re.compile(pattern).search, True))
+            else:
+                compiled.append((re.compile(fnmatch.translate(pattern)).match,
+                                 "/" in pattern))
+        return compiled
+
+    @staticmethod
+    def matches(rules, path, name):
+        """Returns whether any of the compiled rules matches an entry."""
+        for match, on_path in rules:
+            if match(path if on_path else name):
+                return True
+        return False
+
+    def prunes(self, path, name):
+        """Returns whether a directory is not to be descended into."""
+        return self.matches(self.prune, path, name)
+
+    def excludes(self, path, name):
+        """Returns whether the rules leave an entry unchanged."""
+        if self.exclude and self.matches(self.exclude, path, name):
+            return True
+        return bool(self.include) and \
+            not self.matches(self.include, path, name)
+
+    def selects(self, st):
+        """Returns whether an entry passes the owner, group and age
+        filters."""
+        if self.uid is not None and st.st_uid != self.uid:
+            return False
+        if self.gid is not None and st.st_gid != self.gid:
+            return False
+        if self.newer_ns is not None and st.st_mtime_ns < self.newer_ns:
+            return False
+        if self.older_ns is not None and st.st_mtime_ns >= self.older_ns:
+            return False
+        return True
+
+
+def has_filters(config):
+    """Returns whether the configuration leaves any entries out."""
+    return bool(config.include or config.exclude or config.prune or
+                config.owner is not None or config.in_group is not None or
+                config.newer is not None or config.older is not None)
+
+
+def filter_spec(config):
+    """Returns a canonical description of the filters of a configuration,
+    for keying indexes and journals."""
+    if not has_filters(config):
+        return ""
+    return repr((config.include, config.exclude, config.prune, config.owner,
+                 config.in_group, config.newer, config.older))
+
+
+class Worker:
+    """State of one worker taking work from the shared queue.
+
+    Each queue message is a (parent, names, kind) tuple naming entries of one
+    directory, a (manifest, (start, end), WORK_RESTORE) tuple naming records
+    of a --snapshot manifest to restore, or a control message with a `parent`
+    of None: WORK_SETUP carries the (file changes, directory changes, gid,
+    snapshot) to apply from then on, and WORK_REPORT asks for the counts
+    since the last report.
+    Each worker answers a control message on `results` and then waits for
+    the pool to release it through `control` once every worker has answered,
+    so that every worker takes exactly one of them.
+
+    Directories are scanned by the worker itself: subdirectories go
+    back onto the queue for any idle worker to pick up, and everything else is
+    changed locally in batches of `config.blocksize`. Directories named by a
+    WORK_SHALLOW message are changed along with their other entries, but
+    their subdirectories are left alone.
+
+    The queue is bounded. When it is full, the worker keeps the subdirectories
+    it finds on a local stack and works through them depth-first before
+    taking anything else, handing them back to the queue once it drains. The
+    message it took is only marked done once that stack is empty.
+
+    If `index` is not None, directories whose mtime and ctime match their
+    index record are not listed again; only their recorded subdirectories are
+    queued. Fresh records for compliant directories are returned to the
+    parent along with the counts.
+
+    If `counters` is not None, the worker keeps the number of entries it has
+    found and applied in slots 2*worker_id and 2*worker_id+1 for --progress
+    and the tuner.
+
+    If `tuning` is not None, it is a pair of shared values holding the number
+    of workers that should be active and the current batch size, which are
+    adjusted by the parent while the pool runs. Workers whose id is not below
+    the active count wait before taking more work.
+
+    Subdirectories on a device other than `dev` are mount points and are not
+    descended into; with --cross-mounts they are handled by the pool of their
+    own device instead.
+
+    Entries left out by the filters of the configuration are neither changed
+    nor, for pruned directories, listed; see `Filter`.
+
+    If `journal` is not None, it is the path of the --journal file, to which
+    the worker appends each directory it has listed once all of its entries
+    have been changed. Directories in `done` were journaled by an interrupted
+    run: they are only listed to find their subdirectories.
+
+    Once `stopping` is set, the worker stops taking work, discards what is
+    queued, and changes and journals what it has already buffered.
+
+    Files with more than one link are claimed in `links`, and left alone if
+    another link to them has been claimed already.
+
+    With --audit, nothing is changed. Instead, the worker counts entries by
+    (mode, gid) and by what would change, and appends the paths that would
+    change to the --audit-paths file, if any.
+
+    If the snapshot of the setup is not None, the worker appends the original
+    mode, owner and group of every entry it changes to that --snapshot log
+    before changing each batch, until the next report.
+    """
+    def __init__(self, queue, results, control, config, index, worker_id,
+                 counters, tuning, dev, throttle, journal, done, stopping,
+                 links):
+        self.queue = queue
+        self.results = results
+        self.control = control
+        self.links = links
+        self.dev = dev
+        self.throttle = throttle
+        self.config = config
+        self.gid = None
+        self.index = index
+        self.counters = counters
+        self.worker_id = worker_id
+        self.slot = 2 * worker_id
+        self.tuning = tuning
+        self.blocksize = config.blocksize
+        self.changes_fil = self.changes_dir = None
+        self.filter = Filter(config) if has_filters(config) else None
+        self.buffer_fil = []
+        self.buffer_dir = []
+        self.reset()
+        self.pending = []
+        self.stopping = stopping
+        self.done = done
+        self.journal_fd = None
+        if journal is not None:
+            self.journal_fd = os.open(journal, os.O_WRONLY | os.O_APPEND)
+        self.journal_buffer = bytearray()
+        self.journal_synced = time.monotonic()
+        # Number of flushes of the file and directory buffers so far, and
+        # the listed directories waiting for the flushes that cover them.
+        self.flushes = [0, 0]
+        self.scanned = []
+        self.audit_fd = None
+        if config.audit_paths is not None:
+            self.audit_fd = os.open(config.audit_paths,
+                                    os.O_WRONLY | os.O_APPEND)
+        self.audit_buffer = bytearray()
+        self.snapshot = None
+        self.snapshot_fd = None
+        # The memory map and the offsets of the records and paths of the
+        # manifest being restored.
+        self.manifest = None
+
+    def reset(self):
+        """Starts the counts of a new report."""
+        self.total = 0
+        self.changed = 0
+        self.skipped = 0
+        self.resumed = 0
+        self.filtered = 0
+        self.duplicates = 0
+        self.untracked = 0
+        self.errors = 0
+        self.crashed = 0
+        self.records = {}
+        self.failed = [] if self.index is not None else None
+        self.histogram = {}
+        self.violations = {"mode": 0, "group": 0}
+        self.metrics = Metrics() if self.config.metrics_file else None
+
+    def run(self):
+        """Processes queue messages until receiving None."""
+        queue = self.queue
+        pending = self.pending
+        while True:
+            if self.tuning is not None:
+                active, blocksize = self.tuning
+                while self.worker_id >= active.value:
+                    time.sleep(TUNE_WINDOW / 10)
+                self.blocksize = blocksize.value
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                break
+            try:
+                if item[0] is None:
+                    generation, released = self.control
+                    current = generation.value
+                    if item[2] == WORK_SETUP:
+                        self.results.put(self.set_up(item[1]))
+                    else:
+                        self.results.put(self.report())
+                    with released:
+                        while generation.value == current:
+                            released.wait()
+                    continue
+                if not self.stopping.value:
+                    self.process(item)
+                while pending and not self.stopping.value:
+                    if len(pending) > 1 and queue.empty():
+                        self.offload()
+                    self.process(pending.pop())
+                pending.clear()
+            except Exception:
+                # Work left undone would keep the pool waiting forever.
+                self.crash()
+                pending.clear()
+            finally:
+                queue.task_done()
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+        if self.audit_fd is not None:
+            os.close(self.audit_fd)
+        self.close_snapshot()
+
+    def crash(self):
+        """Reports the exception being handled, dropping what is buffered so
+        that it does not fail again."""
+        import traceback
+        self.crashed += 1
+        print(f"fastmod: worker {self.worker_id} failed:\n"
+              f"{traceback.format_exc()}", end="", file=sys.stderr)
+        self.buffer_fil.clear()
+        self.buffer_dir.clear()
+
+    def report(self):
+        """Finishes what has been taken so far and returns its counts,
+        starting new ones."""
+        try:
+            self.flush_files()
+            self.flush_directories()
+        except Exception:
+            self.crash()
+        self.write_journal(sync=True)
+        if self.audit_fd is not None:
+            self.write_audit_paths()
+        if self.throttle is not None:
+            self.throttle.settle()
+        self.close_snapshot()
+        records = self.records
+        if self.crashed:
+            # Nothing listed since may be trusted.
+            records = {}
+        elif self.failed:
+            # A directory is only compliant if all of its entries are.
+            dirty = {os.path.dirname(path) for path in self.failed}
+            records = {path: record for path, record in records.items()
+                       if path not in dirty}
+        report = {
+            "total": self.total,
+            "changed": self.changed,
+            "skipped": self.skipped,
+            "resumed": self.resumed,
+            "filtered": self.filtered,
+            "duplicates": self.duplicates,
+            "untracked": self.untracked,
+            "errors": self.errors,
+            "crashed": self.crashed,
+            "histogram": self.histogram,
+            "violations": self.violations,
+            "records": records,
+            "metrics": [self.metrics.as_dict()] if self.metrics else []
+        }
+        self.reset()
+        return report
+
+    def process(self, item):
+        """Processes one queue message."""
+        parent, names, kind = item
+        if kind == WORK_RESTORE:
+            self.restore(parent, *names)
+            return
+        if not parent and self.counters is not None:
+            # Paths given on the command line are not found by any listing.
+            self.counters[self.slot] += len(names)
+        for name in names:
+            if self.stopping.value:
+                # What is left is marked done without being done.
+                break
+            path = os.path.join(parent, name)
+            if kind == WORK_FILES:
+                self.buffer_entry(path, self.buffer_fil)
+            elif kind == WORK_SHALLOW:
+                self.buffer_entry(path, self.buffer_dir)
+                self.scan_directory(path, descend=False)
+            elif self.done is not None and path in self.done:
+                self.resume_directory(path)
+            elif self.index is None:
+                self.buffer_entry(path, self.buffer_dir)
+                self.scan_directory(path)
+            else:
+                self.process_indexed_directory(path)
+        if len(self.buffer_fil) >= self.blocksize:
+            self.flush_files()
+        if len(self.buffer_dir) >= self.blocksize:
+            self.flush_directories()
+
+    def buffer_entry(self, path, buffer):
+        """Buffers an entry named by a queue message for changing, unless
+        the filters leave it out."""
+        if self.filter is None:
+            buffer.append((path, None))
+            return
+        if self.filter.excludes(path, os.path.basename(path)):
+            self.filtered += 1
+            return
+        st = None
+        if self.filter.needs_stat:
+            try:
+                st = os.lstat(path)
+            except OSError as e:
+                self.errors += 1
+                if not self.config.quiet:
+                    print(f"fastmod: cannot access '{path}': {e.strerror}",
+                          file=sys.stderr)
+                return
+            if not self.filter.selects(st):
+                self.leave_out(path)
+                return
+        buffer.append((path, st))
+
+    def claim(self, st):
+        """Claims a file with several links for this worker.
+
+        Return: whether the worker is to change it.
+        """
+        claimed = self.links.claim(st.st_ino)
+        if claimed is None:
+            self.untracked += 1
+        return claimed is not False
+
+    def leave_out(self, path):
+        """Counts an entry that the owner, group or age filters leave
+        unchanged."""
+        self.filtered += 1
+        if self.failed is not None and self.filter.by_age:
+            # Its age will not stay the same, so neither may its directory's
+            # index record.
+            self.failed.append(path)
+
+    def queue_directories(self, parent, names):
+        """Puts subdirectories of `parent` onto the queue, packed into as few
+        messages as still leaves work for every worker. Messages that do not
+        fit in the queue are kept on the local stack."""
+        size = max(1, min(MAX_DIR_CHUNK, len(names) // self.config.ncpus))
+        for i in range(0, len(names), size):
+            item = (parent, names[i:i + size], WORK_DIRS)
+            if self.pending:
+                self.pending.append(item)
+                continue
+            try:
+                self.queue.put_nowait(item)
+            except Full:
+                self.pending.append(item)
+
+    def offload(self):
+        """Hands the oldest half of the local stack back to the queue so that
+        idle workers can share it."""
+        count = 0
+        for item in self.pending[:len(self.pending) // 2]:
+            try:
+                self.queue.put_nowait(item)
+            except Full:
+                break
+            count += 1
+        del self.pending[:count]
+
+    def flush_files(self):
+        """Applies changes to the buffered files."""
+        self.apply(self.buffer_fil, self.changes_fil, self.failed)
+        self.buffer_fil.clear()
+        self.flushes[0] += 1
+        self.journal_directories()
+
+    def flush_directories(self):
+        """Applies changes to the buffered directories."""
+        self.apply(self.buffer_dir, self.changes_dir, None)
+        self.buffer_dir.clear()
+        self.flushes[1] += 1
+        self.journal_directories()
+
+    def journal_directories(self):
+        """Moves the listed directories whose entries have all been changed
+        to the journal."""
+        if self.journal_fd is None:
+            return
+        scanned = self.scanned
+        count = 0
+        for path, files_flushes, dirs_flushes in scanned:
+            # Buffers are applied in order, so the next flush of each one
+            # after the listing covers everything it found.
+            if self.flushes[0] <= files_flushes or \
+                    self.flushes[1] <= dirs_flushes:
+                break
+            self.journal_buffer += os.fsencode(path) + b"\0"
+            count += 1
+        del scanned[:count]
+        if len(self.journal_buffer) >= JOURNAL_BUFFER_SIZE or \
+                time.monotonic() - self.journal_synced >= \
+                JOURNAL_SYNC_INTERVAL:
+            self.write_journal()
+
+    def write_journal(self, sync=False):
+        """Appends the buffered journal records to the journal, and fsyncs
+        it if `sync` is set or it has not been for a while."""
+        if self.journal_fd is None:
+            return
+        try:
+            if self.journal_buffer:
+                os.write(self.journal_fd, self.journal_buffer)
+                self.journal_buffer.clear()
+            now = time.monotonic()
+            if sync or now - self.journal_synced >= JOURNAL_SYNC_INTERVAL:
+                os.fsync(self.journal_fd)
+                self.journal_synced = now
+        except OSError as e:
+            if not self.config.quiet:
+                print(f"fastmod: notice: could not write journal: "
+                      f"{e.strerror}", file=sys.stderr)
+            os.close(self.journal_fd)
+            self.journal_fd = None
+
+    def apply(self, entries, changes, failed):
+        """Applies changes to the given entries and updates the counts.
+
+        Return: the number of entries that were changed.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter_ns()
+        if self.config.audit:
+            changed = self.audit(entries, changes, failed)
+        elif self.snapshot is not None and self.snapshot_fd is None:
+            # A worker started during the run could not open the log, so it
+            # must not change anything.
+            changed = 0
+            self.errors += len(entries)
+            if failed is not None:
+                failed.extend(path for path, _ in entries)
+        else:
+            errors = []
+            snapshot = None
+            if self.snapshot_fd is not None:
+                snapshot = self.write_snapshot
+            changed = apply_changes(entries, changes, self.gid,
+                                    self.config.quiet, errors, metrics,
+                                    self.throttle, snapshot)
+            if errors:
+                self.errors += len(errors)
+                if failed is not None:
+                    failed.extend(errors)
+        if metrics is not None:
+            metrics.apply_ns += time.perf_counter_ns() - start
+        self.changed += changed
+        self.total += len(entries)
+        if self.counters is not None:
+            self.counters[self.slot + 1] += len(entries)
+        return changed
+
+    def audit(self, entries, changes, failed):
+        """Counts the given entries by mode and group and finds those that
+        the changes would modify, without modifying anything.
+
+        Entries that would be modified are appended to `failed` if given, so
+        that --index does not record their directory as compliant.
+
+        Return: the number of entries that would be changed.
+        """
+        histogram = self.histogram
+        violations = self.violations
+        offending = 0
+        for path, st in entries:
+            if st is None:
+                try:
+                    st = os.lstat(path)
+                except OSError as e:
+                    self.errors += 1
+                    if not self.config.quiet:
+                        print(f"fastmod: cannot access '{path}': "
+                              f"{e.strerror}", file=sys.stderr)
+                    continue
+                finally:
+                    if self.throttle is not None:
+                        self.throttle.charge()
+            mode = st.st_mode
+            key = (mode, st.st_gid)
+            histogram[key] = histogram.get(key, 0) + 1
+            wrong_group = self.gid is not None and st.st_gid != self.gid
+            wrong_mode = changes is not None and not stat.S_ISLNK(mode) and \
+                apply_perm(changes, mode, stat.S_ISDIR(mode)) != \
+                stat.S_IMODE(mode)
+            if not (wrong_group or wrong_mode):
+                continue
+            offending += 1
+            violations["group"] += wrong_group
+            violations["mode"] += wrong_mode
+            if failed is not None:
+                failed.append(path)
+            if self.audit_fd is not None:
+                self.audit_buffer += os.fsencode(path) + b"\0"
+                if len(self.audit_buffer) >= AUDIT_BUFFER_SIZE:
+                    self.write_audit_paths()
+        return offending
+
+    def set_up(self, setup):
+        """Takes the (file changes, directory changes, gid, snapshot) to
+        apply from now on.
+
+        Return: None, or why the snapshot log could not be opened.
+        """
+        self.changes_fil, self.changes_dir, self.gid, self.snapshot = setup
+        return self.open_snapshot()
+
+    def open_snapshot(self):
+        """Opens the --snapshot log of the setup, if any.
+
+        Return: None, or why it could not be opened.
+        """
+        if self.snapshot is None:
+            return None
+        try:
+            self.snapshot_fd = os.open(self.snapshot,
+                                       os.O_WRONLY | os.O_APPEND)
+        except OSError as e:
+            return f"cannot write snapshot '{self.snapshot}': {e.strerror}"
+        return None
+
+    def write_snapshot(self, entries):
+        """Appends the original (path, stat) of entries about to change to
+        the --snapshot log.
+
+        Return: whether they were written, and so may be changed.
+        """
+        buffer = bytearray()
+        for path, st in entries:
+            name = os.fsencode(path)
+            buffer += SNAPSHOT_LOG_RECORD.pack(st.st_mode, st.st_uid,
+                                               st.st_gid, len(name))
+            buffer += name
+        try:
+            # The log is opened for appending, so a short write means the
+            # disk is full, and the rest cannot be written either.
+            if os.write(self.snapshot_fd, buffer) != len(buffer):
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        except OSError as e:
+            print(f"fastmod: cannot write snapshot '{self.snapshot}': "
+                  f"{e.strerror}, leaving {len(entries)} entries unchanged",
+                  file=sys.stderr)
+            return False
+        return True
+
+    def close_snapshot(self):
+        """Closes the --snapshot log and the manifest being restored."""
+        if self.snapshot_fd is not None:
+            os.close(self.snapshot_fd)
+            self.snapshot_fd = None
+        if self.manifest is not None:
+            self.manifest[0].close()
+            self.manifest = None
+
+    def restore(self, manifest, start, end):
+        """Restores records `start` to `end` of a --snapshot manifest and
+        updates the counts."""
+        if self.manifest is None:
+            with open(manifest, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            _, _, nwaves, strings_offset = SNAPSHOT_HEADER.unpack_from(mm)
+            self.manifest = (mm, SNAPSHOT_HEADER.size + 8 * nwaves,
+                             strings_offset)
+        mm, records_offset, strings_offset = self.manifest
+        records = []
+        for i in range(start, end):
+            offset, length, mode, uid, gid = SNAPSHOT_RECORD.unpack_from(
+                mm, records_offset + SNAPSHOT_RECORD.size * i)
+            offset += strings_offset
+            records.append((mm[offset:offset + length], mode, uid, gid))
+        errors = []
+        self.changed += restore_changes(records, self.config.quiet, errors,
+                                        self.throttle)
+        self.errors += len(errors)
+        self.total += len(records)
+        if self.counters is not None:
+            self.counters[self.slot] += len(records)
+            self.counters[self.slot + 1] += len(records)
+
+    def write_audit_paths(self):
+        """Appends the buffered offending paths to the --audit-paths file."""
+        try:
+            os.write(self.audit_fd, self.audit_buffer)
+        except OSError as e:
+            if not self.config.quiet:
+                print(f"fastmod: cannot write '{self.config.audit_paths}': "
+                      f"{e.strerror}", file=sys.stderr)
+        self.audit_buffer.clear()
+
+    def scan_directory(self, path, descend=True):
+        """Lists a directory, queueing its subdirectories unless `descend` is
+        false and buffering everything else along with its stat result.
+
+        Return: tuple:
+            [0] The number of entries in the directory;
+            [1] The names of its subdirectories;
+            [2] Whether every entry could be read.
+        """
+        quiet = self.config.quiet
+        blocksize = self.blocksize
+        buffer_fil = self.buffer_fil
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter_ns()
+            apply_ns = metrics.apply_ns
+        throttle = self.throttle
+        timed = throttle is not None and throttle.adaptive
+        ns = None
+        filter = self.filter
+        nentries = 0
+        subdirs = []
+        ok = True
+        try:
+            if throttle is not None:
+                throttle.charge()
+            with os.scandir(path) as it:
+                for entry in it:
+                    if not nentries % STOP_CHECK_ENTRIES and \
+                            self.stopping.value:
+                        break
+                    nentries += 1
+                    try:
+                        # Names are checked before anything is looked up, so
+                        # that pruned subtrees cost nothing.
+                        if filter is not None:
+                            if entry.is_dir(follow_symlinks=False):
+                                if filter.prunes(entry.path, entry.name):
+                                    self.filtered += 1
+                                    continue
+                            elif filter.excludes(entry.path, entry.name):
+                                self.filtered += 1
+                                continue
+                        if timed:
+                            entry_start = time.perf_counter_ns()
+                        st = entry.stat(follow_symlinks=False)
+                        if timed:
+                            ns = time.perf_counter_ns() - entry_start
+                        if throttle is not None:
+                            throttle.charge(ns)
+                        if stat.S_ISDIR(st.st_mode):
+                            if st.st_dev != self.dev:
+                                self.skip_mount_point(entry.path)
+                                continue
+                            subdirs.append(entry.name)
+                        elif filter is not None and not filter.selects(st):
+                            self.leave_out(entry.path)
+                        elif st.st_nlink > 1 and not self.claim(st):
+                            self.duplicates += 1
+                        else:
+                            buffer_fil.append((entry.path, st))
+                            if len(buffer_fil) >= blocksize:
+                                self.flush_files()
+                                if self.stopping.value:
+                                    break
+                    except OSError as e:
+                        self.errors += 1
+                        ok = False
+                        if not quiet:
+                            print(f"fastmod: cannot access '{entry.path}': "
+                                  f"{e.strerror}", file=sys.stderr)
+        except OSError as e:
+            self.errors += 1
+            ok = False
+            if not quiet:
+                print(f"fastmod: cannot read directory '{path}': "
+                      f"{e.strerror}", file=sys.stderr)
+        if metrics is not None:
+            # Batches applied while listing are not part of the walk.
+            metrics.record_directory(
+                path, time.perf_counter_ns() - start -
+                (metrics.apply_ns - apply_ns), nentries)
+            if not ok:
+                metrics.counts["errors"] += 1
+        if self.counters is not None:
+            self.counters[self.slot] += nentries
+        if self.stopping.value:
+            # The listing may be incomplete, so leave it to --resume.
+            return nentries, subdirs, False
+        if self.journal_fd is not None:
+            self.scanned.append((path, *self.flushes))
+        if subdirs and descend:
+            self.queue_directories(path, subdirs)
+        return nentries, subdirs, ok
+
+    def resume_directory(self, path):
+        """Queues the subdirectories of a directory that an interrupted run
+        has already journaled, leaving its other entries alone."""
+        throttle = self.throttle
+        nentries = 0
+        subdirs = []
+        try:
+            if throttle is not None:
+                throttle.charge()
+            with os.scandir(path) as it:
+                for entry in it:
+                    nentries += 1
+                    try:
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        if self.filter is not None and \
+                                self.filter.prunes(entry.path, entry.name):
+                            continue
+                        if throttle is not None:
+                            throttle.charge()
+                        if entry.stat(follow_symlinks=False).st_dev != \
+                                self.dev:
+                            self.skip_mount_point(entry.path)
+                            continue
+                        subdirs.append(entry.name)
+                    except OSError as e:
+                        self.errors += 1
+                        if not self.config.quiet:
+                            print(f"fastmod: cannot access '{entry.path}': "
+                                  f"{e.strerror}", file=sys.stderr)
+        except OSError as e:
+            self.errors += 1
+            if not self.config.quiet:
+                print(f"fastmod: cannot read directory '{path}': "
+                      f"{e.strerror}", file=sys.stderr)
+        if self.counters is not None:
+            self.counters[self.slot] += nentries
+        self.resumed += nentries - len(subdirs) + 1
+        if subdirs:
+            self.queue_directories(path, subdirs)
+
+    def skip_mount_point(self, path):
+        """Leaves out a subdirectory that is on another filesystem."""
+        if not self.config.quiet and not self.config.cross_mounts:
+            print(f"fastmod: notice: not crossing into mount point '{path}' "
+                  f"(use --cross-mounts)", file=sys.stderr)
+
+    def process_indexed_directory(self, path):
+        """Changes a directory and its entries unless its index record shows
+        it has not changed since it was last brought into compliance."""
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            self.errors += 1
+            if not self.config.quiet:
+                print(f"fastmod: cannot access '{path}': {e.strerror}",
+                      file=sys.stderr)
+            return
+        record = self.index.get(path)
+        if record is not None and \
+                record[:2] == (st.st_mtime_ns, st.st_ctime_ns):
+            if record[3]:
+                self.queue_directories(path, record[3])
+            self.records[path] = record
+            self.skipped += record[2] - len(record[3]) + 1
+            return
+        selected = True
+        if self.filter is not None:
+            if self.filter.excludes(path, os.path.basename(path)):
+                self.filtered += 1
+                selected = False
+            elif not self.filter.selects(st):
+                self.leave_out(path)
+                selected = False
+        nentries, subdirs, ok = self.scan_directory(path)
+        # Change the directory right away so that its record holds the ctime
+        # it is left with.
+        nfailed = len(self.failed)
+        if selected and self.apply([(path, st)], self.changes_dir,
+                                   self.failed):
+            try:
+                st = os.lstat(path)
+            except OSError:
+                ok = False
+        # Entries created within the mtime granularity of the filesystem may
+        # not have changed it, so only trust directories that have been quiet
+        # for a while.
+        if ok and len(self.failed) == nfailed and \
+                time.time_ns() - st.st_mtime_ns > INDEX_RACY_NS:
+            self.records[path] = (st.st_mtime_ns, st.st_ctime_ns, nentries,
+                                  tuple(subdirs))
+
+
+def worker_main(queue, results, control, config, index, worker_id, counters,
+                tuning, dev, throttle_shared, journal, done, stopping, links,
+                setup):
+    """Entry point for worker process or thread, starting with the payload
+    of the last WORK_SETUP message, if any."""
+    if threading.current_thread() is threading.main_thread():
+        # Worker processes are stopped through `stopping` by the parent,
+        # which gets the same signals from the terminal.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    throttle = None
+    if throttle_shared is not None:
+        max_rate = config.max_ops or 0
+        threshold_ns = None
+        if config.adaptive_ms:
+            threshold_ns = config.adaptive_ms * 1e6
+        chunk = MAX_THROTTLE_CHUNK
+        if max_rate:
+            chunk = max(1, min(chunk, int(max_rate / (20 * config.ncpus))))
+        throttle = Throttle(throttle_shared, max_rate, threshold_ns, chunk)
+    worker = Worker(queue, results, control, config, index, worker_id,
+                    counters, tuning, dev, throttle, journal, done, stopping,
+                    links)
+    if setup is not None:
+        error = worker.set_up(setup)
+        if error is not None:
+            print(f"fastmod: {error}", file=sys.stderr)
+    worker.run()
 
 
 def print_usage():
@@ -180,7 +1823,22 @@ def print_usage():
     print("  fastmod [options] perms path[s ...]")
     print("  fastmod [options] file_perms:folder_perms path[s ...]")
     print(f"  fastmod [options] [preset=\"--{DEFAULT_PRESET}\"] path[s ...]")
-    print("Available options: -G<group>, -C<cores>, -B<blocksize>, -q")
+    print("  fastmod [options] --restore=<file>")
+    print("Available options: -G<group>, -C<cores>, -B<blocksize>, -q, "
+          "--index, --full, --max-inflight=<n>,")
+    print("                   --engine=<auto|processes|threads>, "
+          "--progress[=<seconds>],")
+    print("                   --metrics=<file>, --cross-mounts, "
+          "--max-ops=<n>, --adaptive=<ms>,")
+    print("                   --journal[=<file>], --resume, "
+          "--include[-regex]=<pattern>,")
+    print("                   --exclude[-regex]=<pattern>, "
+          "--prune[-regex]=<pattern>, --owner=<user>,")
+    print("                   --in-group=<group>, --newer=<age>, "
+          "--older=<age>, --audit,")
+    print("                   --audit-paths=<file>, --watch[=<seconds>], "
+          "--snapshot=<file>,")
+    print("                   --cooperate=<dir>")
     print("Use 'fastmod --help' for more information.")
 
 
@@ -200,17 +1858,18 @@ def print_full_help():
     print("  You can  also specify separate perms for files and directories with:")
     print("    file-perms:folder-perms     e.g. u+xs,g+x,o-w:g+s,o-w")
     print("  PRESET can be *one* of the presets below:")
-    max_width = max(len(preset_name) for preset_name in PRESETS)
+    presets = get_presets()
+    max_width = max(len(preset_name) for preset_name in presets)
     fil_perms_width = max(len("File Permissions"),
-                          max(len(perms["fil"]) for perms in PRESETS.values()))
+                          max(len(perms["fil"]) for perms in presets.values()))
     dir_perms_width = max(len("Folder Permissions"),
-                          max(len(perms["dir"]) for perms in PRESETS.values()))
+                          max(len(perms["dir"]) for perms in presets.values()))
     print(f"    {'Preset Flag'.ljust(max_width+2)}    "
           f"{'File Permissions'.ljust(fil_perms_width)}    "
           f"{'Folder Permissions'.ljust(dir_perms_width)}")
     print(f"    {'-'*(max_width+2)}    {'-'*fil_perms_width}    "
           f"{'-'*dir_perms_width}")
-    for preset_name, perms in PRESETS.items():
+    for preset_name, perms in presets.items():
         print(f"    --{preset_name.ljust(max_width)}    "
               f"{perms['fil'].ljust(fil_perms_width)}    "
               f"{perms['dir'].ljust(dir_perms_width)}")
@@ -222,19 +1881,133 @@ def print_full_help():
     print("Options:")
     print("  Specify -G<group> to set group ownership, e.g. -Gusers.")
     print(f"  Specify -G to set group ownership to the user's primary group. "
-          f"(Yours is: {PRIMARY_GROUP})")
+          f"(Yours is: {primary_group()})")
     print("     Omit -G to keep group ownership as it is.")
     print("  If you specify group ownership with -G, this will take effect "
           "*before* permissions are applied.")
     print("  Specify -q to suppress most messages.")
-    print(f"  Specify -C<cores> to set the number of worker processes to use. "
+    print(f"  Specify -C<cores> to set the number of workers to use. "
           f"Else, defaults to number available minus 1. ({DEFAULT_CORES})")
+    print(f"     Specify -Cauto to start up to {AUTO_MAX_CORES} workers and "
+          f"activate more while")
+    print("     throughput keeps improving.")
+    print("  Specify --engine=processes or --engine=threads to choose how "
+          "workers run.")
+    print("     With --engine=auto, threads are used on network filesystems, "
+          "with -C2 or")
+    print("     fewer, or when no path is a folder. Else, defaults to "
+          f"{DEFAULT_ENGINE}.")
     print(f"  Specify -B<blocksize> to set the number of files changed per "
           f"batch. Else, defaults to {DEFAULT_BLOCKSIZE}.")
+    print("     Specify -Bauto to adjust the batch size while running.")
+    print("     Values tuned by -Cauto/-Bauto are remembered per mount as "
+          "the next starting")
+    print("     point.")
+    print("  Specify --index to record compliant directories in a scan index "
+          "and skip")
+    print("     directories that have not changed since the last indexed run. "
+          "Changes to")
+    print("     existing files that do not touch their directory are not "
+          "noticed.")
+    print("  Specify --full with --index to rescan everything and rebuild "
+          "the index.")
+    print("  Specify --journal to record finished directories as the run "
+          "goes, so that an")
+    print("     interrupted run can be continued with --resume instead of "
+          "starting over.")
+    print("     --resume only lists journaled directories to find their "
+          "subdirectories.")
+    print("     The journal is kept next to the scan indexes unless you "
+          "specify")
+    print("     --journal=<file>, and is removed once a run completes.")
+    print("  Specify --exclude=<glob> to leave matching entries unchanged, "
+          "or --include=<glob>")
+    print("     to only change matching entries. Directories are still "
+          "descended into.")
+    print("  Specify --prune=<glob> to leave matching directories and "
+          "everything below them")
+    print("     alone without listing them, e.g. --prune=.git.")
+    print("     Globs without a '/' match names, else whole paths. Use "
+          "--include-regex=<re>,")
+    print("     --exclude-regex=<re> or --prune-regex=<re> to search whole "
+          "paths instead.")
+    print("     Each of these may be given more than once.")
+    print("  Specify --owner=<user> or --in-group=<group> to only change "
+          "entries with that")
+    print("     owner or current group.")
+    print("  Specify --newer=<age> or --older=<age> to only change entries "
+          "modified less or")
+    print("     more than <age> ago, e.g. 90m, 12h, 30d or 2w. Plain numbers "
+          "are days.")
+    print("  Specify --audit to report what would change without changing "
+          "anything: how")
+    print("     many entries need new permissions or group, and how many "
+          "have each mode and")
+    print("     group.")
+    print("  Specify --audit-paths=<file> with --audit to write the paths "
+          "that would change")
+    print("     to <file>, each followed by a NUL, e.g. for xargs -0.")
+    print("  Mount points below a path are skipped unless you specify "
+          "--cross-mounts.")
+    print("     Every filesystem is worked on by its own pool of workers.")
+    print("  Specify --max-ops=<n> to allow at most <n> metadata operations "
+          "(listings, stats,")
+    print("     chmods and chgrps) per second on each filesystem.")
+    print("  Specify --adaptive=<ms> to slow down whenever the average "
+          "operation takes")
+    print("     longer than <ms> milliseconds, and speed back up when it does "
+          "not.")
+    print(f"  Specify --progress to print progress to stderr every "
+          f"{DEFAULT_PROGRESS_INTERVAL} seconds, or")
+    print("     --progress=<seconds> to choose the interval.")
+    print("  Specify --metrics=<file> to write per-worker counts, latency "
+          "histograms and")
+    print("     the slowest directories to <file> as JSON.")
+    print("  Specify --max-inflight=<n> to limit how many directory entries "
+          "may be waiting")
+    print(f"     for a worker at once. Else, defaults to "
+          f"{DEFAULT_MAX_INFLIGHT}.")
+    print("  Specify --snapshot=<file> to record the original mode, owner "
+          "and group of every")
+    print("     entry that is changed in <file>, which must not exist yet.")
+    print("  Specify --restore=<file> without perms or paths to set them back "
+          "from such a")
+    print("     file, using the same workers, e.g. after running with the "
+          "wrong preset.")
+    print("  Specify --watch to keep running after the first pass and change "
+          "entries as they")
+    print("     are created, moved in or have their permissions or group "
+          "changed, until")
+    print("     interrupted. Uses an inotify watch per folder. Events are "
+          "applied in batches")
+    print(f"     gathered for {DEFAULT_WATCH_DELAY:g} second, or for "
+          "--watch=<seconds>, where 0 applies")
+    print("     them as soon as they are read. Folders that cannot be "
+          "watched, e.g. beyond")
+    print("     fs.inotify.max_user_watches, are rescanned every "
+          f"{WATCH_RESCAN_INTERVAL:g} seconds instead.")
+    print("  Specify --cooperate=<dir> to share the run with other fastmod "
+          "instances given")
+    print("     the same perms, paths and options, e.g. on other hosts, "
+          "through <dir> on a")
+    print("     filesystem they all see. The paths are split into about "
+          f"{COOPERATE_ITEMS} subtrees that")
+    print("     the instances lease from each other; the leases of an "
+          "instance that stops")
+    print(f"     renewing them for {COOPERATE_LEASE:g} seconds are taken "
+          "over. Once every subtree")
+    print("     is done, each instance prints the merged counts and writes "
+          "them to")
+    print("     <dir>/summary.json. Start from an empty <dir> for each run.")
     print()
     print("Configuration:")
     print("  You can override defaults with these environment variables:")
-    print("    FASTMOD_BLOCKSIZE, FASTMOD_CORES, FASTMOD_PRESET")
+    print("    FASTMOD_BLOCKSIZE, FASTMOD_CORES, FASTMOD_PRESET, "
+          "FASTMOD_CACHE_DIR,")
+    print("    FASTMOD_MAX_INFLIGHT, FASTMOD_ENGINE, FASTMOD_AUTO_MAX_CORES,")
+    print("    FASTMOD_MAX_OPS, FASTMOD_LINK_SLOTS, FASTMOD_WATCH_RESCAN,")
+    print("    FASTMOD_COOPERATE_ITEMS, FASTMOD_LEASE")
+    print(f"  Scan indexes and tuned values are kept in {CACHE_DIR}")
     print()
     print("Examples:")
     print("  fastmod .                            to apply default preset to cwd")
@@ -256,14 +2029,41 @@ class Config:
     """
     def __init__(self):
         self.paths = []
-        self.perms_fil = PRESETS[DEFAULT_PRESET]["fil"]
-        self.perms_dir = PRESETS[DEFAULT_PRESET]["dir"]
+        preset = get_presets()[DEFAULT_PRESET]
+        self.perms_fil = preset["fil"]
+        self.perms_dir = preset["dir"]
         self.group = None
         self.set_group = False
         self.ncpus = DEFAULT_CORES
         self.blocksize = DEFAULT_BLOCKSIZE
+        self.auto_cores = False
+        self.auto_blocksize = False
         self.quiet = False
         self.nontrivial = True
+        self.use_index = False
+        self.full = False
+        self.journal = None
+        self.resume = False
+        self.include = []
+        self.exclude = []
+        self.prune = []
+        self.owner = None
+        self.in_group = None
+        self.newer = None
+        self.older = None
+        self.audit = False
+        self.audit_paths = None
+        self.max_inflight = DEFAULT_MAX_INFLIGHT
+        self.engine = DEFAULT_ENGINE
+        self.cross_mounts = False
+        self.max_ops = DEFAULT_MAX_OPS
+        self.adaptive_ms = None
+        self.progress = 0
+        self.metrics_file = None
+        self.watch = None
+        self.snapshot = None
+        self.restore = None
+        self.cooperate = None
 
 
 def check_perm(s):
@@ -279,12 +2079,11 @@ def check_perm(s):
     """
     while s.startswith("%"):
         s = s[1:]
-    try:
-        n = int(s)
-        valid = n >= 0 and n <= 0o7777
+    if s and all(c in "01234567" for c in s):
+        # Only plain octal digits, as int() also takes signs, prefixes,
+        # underscores and whitespace.
+        valid = int(s, 8) <= 0o7777
         return valid, valid
-    except ValueError:
-        pass
     selectors = ["u", "g", "o", "a", ""]
     operators = ["+", "-", "="]
     permissions = ["r", "w", "x", "X", "s", "t", ""]
@@ -312,37 +2111,32 @@ def check_perm(s):
     return True, nontrivial
 
 
-def _test_check_perm():
-    """Tests parsing logic for validating permissions strings."""
-    assert check_perm("u+r,g-wx,u-r") == (True, True)
-    assert check_perm("777") == (True, True)
-    assert check_perm("u=r") == (True, True)
-    assert check_perm("u+rX,g-w,g+s,+t") == (True, True)
-    assert check_perm("ug+rwX,o+rX-w,g+s,+t") == (True, True)
-    assert check_perm("+rwx") == (True, True)
-    assert check_perm("u+-w") == (True, True)
-    assert check_perm("u+w-") == (True, True)
-    assert check_perm("=") == (True, True)
-    assert check_perm("+=") == (True, True)
-
-    assert check_perm("-") == (True, False)
-    assert check_perm("+") == (True, False)
-    assert check_perm("u+") == (True, False)
-    assert check_perm("ug-") == (True, False)
-
-    assert check_perm("") == (False, False)
-    assert check_perm("a") == (False, False)
-    assert check_perm("rwx") == (False, False)
-    assert check_perm("-5") == (False, False)
-    assert check_perm("999999999999") == (False, False)
-    assert check_perm("u.g=rw/o+x") == (False, False)
-    assert check_perm("f+oo") == (False, False)
-    assert check_perm("f+oo,b-ar,+qux") == (False, False)
-    assert check_perm("u+rwx,b-ar") == (False, False)
-    assert check_perm("u+rwx, g+rx-w") == (False, False)
+def parse_perms(spec):
+    """Parses a permission string, a file_perms:folder_perms pair, or a
+    preset flag such as '--umask'.
 
+    Return: tuple:
+        [0] The permission string for files;
+        [1] The permission string for folders;
+        [2] Whether they have any effect.
 
-_test_check_perm()
+    Raises ValueError if the spec is not valid.
+    """
+    if spec.startswith("--"):
+        preset = get_presets().get(spec[2:])
+        if preset is None:
+            raise ValueError(f"preset '{spec[2:]}' does not exist")
+        return preset["fil"], preset["dir"], True
+    perms_fil, colon, perms_dir = spec.partition(":")
+    if not colon:
+        perms_dir = perms_fil
+    nontrivial = False
+    for perms in (perms_fil, perms_dir):
+        valid, effective = check_perm(perms)
+        if not valid:
+            raise ValueError(f"invalid permission string '{perms}'")
+        nontrivial = nontrivial or effective
+    return perms_fil, perms_dir, nontrivial
 
 
 def parse_args(argv):
@@ -355,47 +2149,184 @@ def parse_args(argv):
         if arg.startswith("-G"):
             config.set_group = True
             if arg == "-G":
-                config.group = PRIMARY_GROUP
+                config.group = primary_group()
             else:
                 config.group = arg[2:]
             continue
+        elif arg == "-Cauto":
+            config.auto_cores = True
+            config.ncpus = AUTO_MAX_CORES
+            continue
         elif arg.startswith("-C"):
             config.ncpus = int(arg[2:])
+            config.auto_cores = False
+            continue
+        elif arg == "-Bauto":
+            config.auto_blocksize = True
             continue
         elif arg.startswith("-B"):
             config.blocksize = int(arg[2:])
+            config.auto_blocksize = False
             continue
         elif arg == "-q":
             config.quiet = True
             continue
-        elif arg.startswith("--"):
-            preset_name = arg[2:]
-            if preset_name not in PRESETS:
-                print(f"fastmod: preset '{preset_name}' does not exist")
+        elif arg == "--index":
+            config.use_index = True
+            continue
+        elif arg == "--full":
+            config.full = True
+            continue
+        elif arg == "--journal":
+            if config.journal is None:
+                config.journal = ""
+            continue
+        elif arg.startswith("--journal="):
+            config.journal = arg[len("--journal="):]
+            continue
+        elif arg == "--resume":
+            config.resume = True
+            if config.journal is None:
+                config.journal = ""
+            continue
+        elif arg.startswith("--engine="):
+            config.engine = arg[len("--engine="):]
+            if config.engine not in ("auto", "processes", "threads"):
+                print(f"fastmod: engine must be one of auto, processes or "
+                      f"threads, not '{config.engine}'")
                 return None
-            config.perms_fil = PRESETS[preset_name]["fil"]
-            config.perms_dir = PRESETS[preset_name]["dir"]
-            have_preset = True
             continue
-        elif ":" in arg:
-            if have_preset:
-                print("fastmod: cannot specify both preset and permission flags")
+        elif arg == "--cross-mounts":
+            config.cross_mounts = True
+            continue
+        elif arg.startswith(("--include", "--exclude", "--prune")) and \
+                "=" in arg:
+            option, pattern = arg[2:].split("=", 1)
+            rules, _, kind = option.partition("-")
+            if rules not in ("include", "exclude", "prune") or \
+                    kind not in ("", "regex"):
+                print(f"fastmod: unknown option '{arg}'")
                 return None
-            try:
-                config.perms_fil, config.perms_dir = arg.split(":")
-                valid, nontrivial_fil = check_perm(config.perms_fil)
-                if not valid:
-                    print(f"fastmod: invalid permission string '{config.perms_fil}'")
-                    return None
-                valid, nontrivial_dir = check_perm(config.perms_dir)
-                if not valid:
-                    print(f"fastmod: invalid permission string '{config.perms_dir}'")
+            if kind:
+                import re
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    print(f"fastmod: invalid regular expression "
+                          f"'{pattern}': {e}")
                     return None
-                config.nontrivial = nontrivial_fil or nontrivial_dir
-            except ValueError:
-                print("fastmod: specify multiple permission flags like"
-                      " 'file-perms:folder-perms'")
-                print("e.g. 'u+xs,g+x,o-w:g+s,o-w'")
+            getattr(config, rules).append((kind or "glob", pattern))
+            continue
+        elif arg.startswith("--owner="):
+            config.owner = resolve_user(arg[len("--owner="):])
+            if config.owner is None:
+                print(f"fastmod: invalid user: '{arg[len('--owner='):]}'")
+                return None
+            continue
+        elif arg.startswith("--in-group="):
+            config.in_group = resolve_group(arg[len("--in-group="):])
+            if config.in_group is None:
+                print(f"fastmod: invalid group: "
+                      f"'{arg[len('--in-group='):]}'")
+                return None
+            continue
+        elif arg.startswith(("--newer=", "--older=")):
+            option, value = arg[2:].split("=", 1)
+            age = parse_age(value)
+            if age is None:
+                print(f"fastmod: invalid age: '{value}'")
+                return None
+            setattr(config, option, age)
+            continue
+        elif arg == "--audit":
+            config.audit = True
+            continue
+        elif arg.startswith("--audit-paths="):
+            config.audit = True
+            config.audit_paths = arg[len("--audit-paths="):]
+            continue
+        elif arg.startswith(("--max-ops=", "--adaptive=")):
+            option, value = arg.split("=", 1)
+            n = parse_number(value)
+            if n is None:
+                print(f"fastmod: {option} must be a positive number, not "
+                      f"'{value}'")
+                return None
+            if option == "--max-ops":
+                config.max_ops = n
+            else:
+                config.adaptive_ms = n
+            continue
+        elif arg == "--progress":
+            config.progress = DEFAULT_PROGRESS_INTERVAL
+            continue
+        elif arg.startswith("--progress="):
+            value = arg[len("--progress="):]
+            config.progress = parse_number(value)
+            if config.progress is None:
+                print(f"fastmod: --progress must be a positive number of "
+                      f"seconds, not '{value}'")
+                return None
+            continue
+        elif arg.startswith("--metrics="):
+            config.metrics_file = arg[len("--metrics="):]
+            continue
+        elif arg.startswith("--max-inflight="):
+            value = arg[len("--max-inflight="):]
+            config.max_inflight = parse_number(value, int)
+            if config.max_inflight is None:
+                print(f"fastmod: --max-inflight must be a positive integer, "
+                      f"not '{value}'")
+                return None
+            continue
+        elif arg.startswith("--snapshot="):
+            config.snapshot = arg[len("--snapshot="):]
+            continue
+        elif arg.startswith("--restore="):
+            config.restore = arg[len("--restore="):]
+            continue
+        elif arg.startswith("--cooperate="):
+            config.cooperate = arg[len("--cooperate="):]
+            continue
+        elif arg == "--watch":
+            config.watch = DEFAULT_WATCH_DELAY
+            continue
+        elif arg.startswith("--watch="):
+            value = arg[len("--watch="):]
+            config.watch = parse_number(value, zero=True)
+            if config.watch is None:
+                print(f"fastmod: --watch must be a number of seconds, 0 or "
+                      f"more, not '{value}'")
+                return None
+            continue
+        elif arg.startswith("--"):
+            preset_name = arg[2:]
+            if preset_name not in PRESETS:
+                print(f"fastmod: preset '{preset_name}' does not exist")
+                return None
+            config.perms_fil = get_presets()[preset_name]["fil"]
+            config.perms_dir = get_presets()[preset_name]["dir"]
+            have_preset = True
+            continue
+        elif ":" in arg:
+            if have_preset:
+                print("fastmod: cannot specify both preset and permission flags")
+                return None
+            try:
+                config.perms_fil, config.perms_dir = arg.split(":")
+                valid, nontrivial_fil = check_perm(config.perms_fil)
+                if not valid:
+                    print(f"fastmod: invalid permission string '{config.perms_fil}'")
+                    return None
+                valid, nontrivial_dir = check_perm(config.perms_dir)
+                if not valid:
+                    print(f"fastmod: invalid permission string '{config.perms_dir}'")
+                    return None
+                config.nontrivial = nontrivial_fil or nontrivial_dir
+            except ValueError:
+                print("fastmod: specify multiple permission flags like"
+                      " 'file-perms:folder-perms'")
+                print("e.g. 'u+xs,g+x,o-w:g+s,o-w'")
                 return None
             continue
         else:
@@ -436,70 +2367,42 @@ def parse_args(argv):
                 config.paths.append(arg)
                 continue
 
+    if config.restore is not None:
+        if config.paths or config.snapshot is not None or config.audit or \
+                config.watch is not None or config.journal is not None or \
+                config.cooperate is not None:
+            print("fastmod: --restore takes no paths and cannot be combined "
+                  "with --snapshot, --audit, --watch, --journal, --resume or "
+                  "--cooperate")
+            return None
+        return config
+
     if not config.paths:
         print("fastmod: must specify at least one path")
         return None
 
-    return config
-
+    if config.watch is not None and \
+            (config.journal is not None or config.audit or
+             config.snapshot is not None):
+        print("fastmod: --watch cannot be combined with --journal, --resume, "
+              "--audit or --snapshot")
+        return None
 
-def _test_parse_args():
-    config = parse_args(["fastmod.exe", "."])
-    assert config.paths == ["."]
-    assert config.perms_fil == PRESETS[DEFAULT_PRESET]["fil"]
-    assert config.perms_dir == PRESETS[DEFAULT_PRESET]["dir"]
-    assert config.quiet == False
-    assert config.set_group == False
-
-    config = parse_args(["fastmod.exe", "u+w", "."])
-    assert config.paths == ["."]
-    assert config.perms_fil == "u+w"
-    assert config.perms_dir == "u+w"
-    assert config.quiet == False
-    assert config.set_group == False
-
-    config = parse_args(["fastmod.exe", "%%%%u+w", "."])
-    assert config.paths == ["."]
-    assert config.perms_fil == "u+w"
-    assert config.perms_dir == "u+w"
-    assert config.quiet == False
-    assert config.set_group == False
-
-    config = parse_args(["fastmod.exe", "u+rwx:u+r,+t", "."])
-    assert config.paths == ["."]
-    assert config.perms_fil == "u+rwx"
-    assert config.perms_dir == "u+r,+t"
-    assert config.quiet == False
-    assert config.set_group == False
-
-    config = parse_args(["fastmod.exe", "--readonly", "."])
-    assert config.paths == ["."]
-    assert config.perms_fil == PRESETS["readonly"]["fil"]
-    assert config.perms_dir == PRESETS["readonly"]["dir"]
-    assert config.quiet == False
-    assert config.set_group == False
-
-    config = parse_args(
-        ["fastmod.exe", "u+rwx:u+r,+t", ".", "..", "../././../."])
-    assert config.paths == [".", "..", "../././../."]
-    assert config.perms_fil == "u+rwx"
-    assert config.perms_dir == "u+r,+t"
-    assert config.quiet == False
-    assert config.set_group == False
-
-    config = parse_args([
-        "fastmod.exe", "-q", "-Gfoobar", "u+rwx:u+r,+t", ".", "..",
-        "../././../."
-    ])
-    assert config.paths == [".", "..", "../././../."]
-    assert config.perms_fil == "u+rwx"
-    assert config.perms_dir == "u+r,+t"
-    assert config.quiet == True
-    assert config.set_group == True
-    assert config.group == "foobar"
+    if config.audit and config.snapshot is not None:
+        print("fastmod: --audit cannot be combined with --snapshot")
+        return None
 
+    if config.cooperate is not None and \
+            (config.use_index or config.journal is not None or
+             config.watch is not None or config.snapshot is not None or
+             config.audit_paths is not None or
+             config.metrics_file is not None):
+        print("fastmod: --cooperate cannot be combined with --index, "
+              "--journal, --resume, --watch, --snapshot, --audit-paths or "
+              "--metrics")
+        return None
 
-_test_parse_args()
+    return config
 
 
 def print_config(config):
@@ -532,48 +2435,1857 @@ def print_config(config):
         changes = [
             chg for chg in [fil_changes, dir_changes, grp_changes] if chg
         ]
-        print(f"changes to make:  {'  '.join(changes)}")
+        verb = "audit" if config.audit else "make"
+        print(f"changes to {verb}:  {'  '.join(changes)}")
+
+
+def resolve_group(group):
+    """Returns the gid for a group name or number, or None if there is no
+    such group."""
+    try:
+        return grp.getgrnam(group).gr_gid
+    except KeyError:
+        pass
+    if group.isdigit():
+        return int(group)
+    return None
+
+
+def resolve_user(user):
+    """Returns the uid for a user name or number, or None if there is no
+    such user."""
+    try:
+        return pwd.getpwnam(user).pw_uid
+    except KeyError:
+        pass
+    if user.isdigit():
+        return int(user)
+    return None
+
+
+def parse_age(s):
+    """Returns the number of seconds in an age such as 90m, 12h or 30d, or
+    None if it is not one. Plain numbers are days."""
+    unit = AGE_UNITS["d"]
+    if s[-1:] in AGE_UNITS:
+        unit = AGE_UNITS[s[-1]]
+        s = s[:-1]
+    try:
+        age = float(s)
+    except ValueError:
+        return None
+    return age * unit if age >= 0 else None
+
+
+def parse_number(s, convert=float, zero=False):
+    """Returns the positive number in `s`, or None if it is not one. With
+    `zero`, 0 is taken too."""
+    try:
+        n = convert(s)
+    except ValueError:
+        return None
+    # Comparisons are false for NaN.
+    if 0 < n < float("inf") or zero and n == 0:
+        return n
+    return None
+
+
+def unescape_mount(field):
+    """Decodes the octal escapes used in /proc/self/mountinfo fields."""
+    if "\\" not in field:
+        return field
+    import re
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def mount_info(path):
+    """Returns the (type, source, mount point) of the filesystem holding
+    `path` from /proc/self/mountinfo, or Nones if it cannot be determined."""
+    try:
+        dev = os.stat(path).st_dev
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                if fields[2] == f"{os.major(dev)}:{os.minor(dev)}":
+                    sep = fields.index("-")
+                    return fields[sep + 1], fields[sep + 2], unescape_mount(
+                        fields[4])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None, None, None
+
+
+def filesystem_type(path):
+    """Returns the type of the filesystem holding `path`, or None if it
+    cannot be determined."""
+    return mount_info(path)[0]
+
+
+def choose_engine(config, paths):
+    """Resolves the "auto" engine for this run.
+
+    Threads avoid the start-up cost of worker processes and the GIL is
+    released around every syscall, so they win whenever the workers spend
+    their time waiting on the filesystem: on network filesystems, or when
+    there are too few workers for the Python work to contend.
+    """
+    if config.engine != "auto":
+        return config.engine
+    if config.ncpus <= 2:
+        return "threads"
+    if not any(os.path.isdir(path) for path in paths):
+        # Lone files leave nothing for more workers to do.
+        return "threads"
+    if all(filesystem_type(path) in NETWORK_FILESYSTEMS for path in paths):
+        return "threads"
+    return "processes"
+
+
+def index_key(root, config, gid, umask):
+    """Returns the key identifying the index for a root path under the given
+    configuration."""
+    return "\0".join([
+        os.path.abspath(root), config.perms_fil if config.nontrivial else "",
+        config.perms_dir if config.nontrivial else "", str(gid),
+        oct(umask), filter_spec(config)
+    ])
+
+
+def key_digest(key):
+    """Returns the SHA-256 hex digest of an index or journal key."""
+    import hashlib  # Only needed by runs with an index or journal.
+    return hashlib.sha256(key.encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def index_file(key):
+    """Returns the path of the index file for an index key."""
+    digest = key_digest(key)
+    return os.path.join(CACHE_DIR, f"index-{digest[:32]}")
+
+
+def load_index(key, quiet):
+    """Returns the records of the index for `key`, or an empty dict if there
+    is no usable index.
+
+    Each record maps a directory path to a tuple of
+    (mtime_ns, ctime_ns, number of entries, subdirectory names).
+    """
+    path = index_file(key)
+    try:
+        with open(path, "rb") as f:
+            version, stored_key, records = marshal.load(f)
+        if version != INDEX_VERSION or stored_key != key:
+            return {}
+        if not isinstance(records, dict):
+            raise ValueError("records are not a dict")
+        return records
+    except FileNotFoundError:
+        return {}
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        if not quiet:
+            print(f"fastmod: notice: ignoring unreadable index '{path}': {e}",
+                  file=sys.stderr)
+        return {}
+
+
+def save_index(key, records, quiet):
+    """Atomically replaces the index for `key` with `records`."""
+    path = index_file(key)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".index-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump((INDEX_VERSION, key, records), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        if not quiet:
+            print(f"fastmod: notice: could not save index '{path}': {e}",
+                  file=sys.stderr)
+
+
+def journal_key(paths, config, gid, umask):
+    """Returns the key identifying the journal of a run over `paths` under
+    the given configuration."""
+    return "\0\0".join(index_key(path, config, gid, umask) for path in paths)
+
+
+def journal_header(key):
+    """Returns the first record of a journal for a journal key."""
+    digest = key_digest(key)
+    return f"fastmod-journal {JOURNAL_VERSION} {digest}\0".encode()
+
+
+def journal_file(key):
+    """Returns the default path of the journal for a journal key."""
+    digest = key_digest(key)
+    return os.path.join(CACHE_DIR, f"journal-{digest[:32]}")
+
+
+def load_journal(path, key, quiet):
+    """Returns the set of directories recorded in the journal at `path`, or
+    None if there is no journal for `key` there.
+
+    Records are NUL-terminated paths appended by the workers. A record cut
+    short by a crash is ignored.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        if not quiet:
+            print(f"fastmod: notice: ignoring unreadable journal '{path}': "
+                  f"{e.strerror}", file=sys.stderr)
+        return None
+    header = journal_header(key)
+    if not data.startswith(header):
+        if not quiet:
+            print(f"fastmod: notice: ignoring journal '{path}' of a "
+                  f"different run", file=sys.stderr)
+        return None
+    records = data[len(header):].split(b"\0")
+    # The last record is empty, or was cut short.
+    return {os.fsdecode(record) for record in records[:-1]}
+
+
+def start_journal(path, key, quiet):
+    """Creates a new, empty journal for `key` at `path`.
+
+    Return: whether the journal could be created.
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(journal_header(key))
+            f.flush()
+            os.fsync(f.fileno())
+        return True
+    except OSError as e:
+        if not quiet:
+            print(f"fastmod: notice: could not create journal '{path}': "
+                  f"{e.strerror}", file=sys.stderr)
+        return False
+
+
+def start_snapshot(path):
+    """Creates an empty --snapshot log, refusing to overwrite an existing
+    file.
+
+    Raises OSError if it cannot be created.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.write(fd, SNAPSHOT_LOG_MAGIC)
+    finally:
+        os.close(fd)
+
+
+def finalize_snapshot(path):
+    """Turns the log written to a --snapshot file into a manifest, in place.
+
+    Directories come first, in one restore wave per depth from the top
+    down, so that each wave can be restored in parallel and restored entries
+    stay reachable. Everything else comes last, in a single wave. A record
+    cut short by a crash ends the log.
+
+    Raises OSError if the file cannot be read or replaced, or ValueError if
+    it is neither a log nor a manifest.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(SNAPSHOT_LOG_MAGIC))
+        if magic == SNAPSHOT_MAGIC:
+            return
+        if magic != SNAPSHOT_LOG_MAGIC:
+            raise ValueError("not a fastmod snapshot")
+        size = os.fstat(f.fileno()).st_size
+        log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size > len(magic) else b""
+    # Log offsets of the records of each wave, keyed by (not a directory,
+    # depth).
+    waves = {}
+    offset = len(magic)
+    header_size = SNAPSHOT_LOG_RECORD.size
+    while offset + header_size <= size:
+        mode, _, _, length = SNAPSHOT_LOG_RECORD.unpack_from(log, offset)
+        if offset + header_size + length > size:
+            break
+        if stat.S_ISDIR(mode):
+            name = log[offset + header_size:offset + header_size + length]
+            key = (False, name.count(b"/"))
+        else:
+            key = (True, 0)
+        waves.setdefault(key, array.array("Q")).append(offset)
+        offset += header_size + length
+    keys = sorted(waves)
+    count = sum(len(offsets) for offsets in waves.values())
+    records_offset = SNAPSHOT_HEADER.size + 8 * len(keys)
+    strings_offset = records_offset + SNAPSHOT_RECORD.size * count
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, count, len(keys),
+                                     strings_offset))
+        end = 0
+        for key in keys:
+            end += len(waves[key])
+            f.write(end.to_bytes(8, "little"))
+        name_offset = 0
+        buffer = bytearray()
+        for key in keys:
+            for offset in waves[key]:
+                mode, uid, gid, length = SNAPSHOT_LOG_RECORD.unpack_from(
+                    log, offset)
+                buffer += SNAPSHOT_RECORD.pack(name_offset, length, mode,
+                                               uid, gid)
+                name_offset += length
+                if len(buffer) >= 1 << 20:
+                    f.write(buffer)
+                    buffer.clear()
+        for key in keys:
+            for offset in waves[key]:
+                length = SNAPSHOT_LOG_RECORD.unpack_from(log, offset)[3]
+                start = offset + header_size
+                buffer += log[start:start + length]
+                if len(buffer) >= 1 << 20:
+                    f.write(buffer)
+                    buffer.clear()
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """Returns the restore waves of a --snapshot file, turning a log into a
+    manifest first.
+
+    Return: tuple:
+        [0] The index after the last record of each wave;
+        [1] The path of the first record, or None if there are none.
+
+    Raises OSError if the file cannot be read, or ValueError if it is not a
+    snapshot.
+    """
+    finalize_snapshot(path)
+    with open(path, "rb") as f:
+        header = f.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size:
+            raise ValueError("not a fastmod snapshot")
+        magic, count, nwaves, strings_offset = SNAPSHOT_HEADER.unpack(header)
+        waves = [int.from_bytes(f.read(8), "little") for _ in range(nwaves)]
+        first = None
+        if count:
+            _, length, _, _, _ = SNAPSHOT_RECORD.unpack(
+                f.read(SNAPSHOT_RECORD.size))
+            f.seek(strings_offset)
+            first = os.fsdecode(f.read(length))
+    return waves, first
+
+
+def nested_mounts(root):
+    """Returns the paths, under `root` as given, of the mount points below it
+    that hold a different filesystem than their parent directory."""
+    real_root = os.path.realpath(root)
+    prefix = os.path.join(real_root, "")
+    mounts = []
+    try:
+        with open("/proc/self/mountinfo") as f:
+            points = [unescape_mount(line.split()[4]) for line in f]
+    except OSError:
+        return mounts
+    for point in points:
+        if not point.startswith(prefix):
+            continue
+        try:
+            if os.stat(point).st_dev == \
+                    os.stat(os.path.dirname(point)).st_dev:
+                continue
+        except OSError:
+            continue
+        path = os.path.join(root, os.path.relpath(point, real_root))
+        if path not in mounts:
+            mounts.append(path)
+    return mounts
+
+
+class ThreadShared:
+    """Shared values, arrays and locks for pools whose workers are threads,
+    with the interface of the multiprocessing ones. Importing
+    multiprocessing and setting up its shared heap takes longer than a
+    small run does, so thread pools do without it.
+    """
+    Lock = threading.Lock
+    Condition = threading.Condition
+
+    @staticmethod
+    def RawValue(typecode, value):
+        return types.SimpleNamespace(value=value)
+
+    @staticmethod
+    def RawArray(typecode, size):
+        # Anonymous memory is zeroed and only takes up memory once touched.
+        itemsize = 8 if typecode in "qQd" else 4 if typecode == "i" else 1
+        return memoryview(mmap.mmap(-1, size * itemsize)).cast(typecode)
+
+
+def process_shared():
+    """Returns the multiprocessing context of forked workers, importing
+    multiprocessing on first use. Workers have to be forked to inherit the
+    anonymous shared memory of an InodeSet."""
+    import multiprocessing
+    return multiprocessing.get_context("fork")
+
+
+class Pool:
+    """The work queue and workers for the paths on one filesystem.
+
+    Every filesystem gets its own pool of `config.ncpus` workers, so a slow
+    or hung filesystem only holds up its own workers. With -Cauto, only as
+    many as are active are started, and more as the tuner adds them. The
+    workers stay up between paths until close() is called.
+    """
+    def __init__(self, dev, paths, config, index, journal, done):
+        self.dev = dev
+        self.config = config
+        self.fs_type, self.fs_source, self.mount_point = mount_info(paths[0])
+        self.engine = choose_engine(config, paths)
+        maxsize = max(2 * config.ncpus, config.max_inflight // MAX_DIR_CHUNK)
+        if self.engine == "threads":
+            shared = ThreadShared
+            self.queue = queue_module.Queue(maxsize)
+            self.results = queue_module.Queue()
+            worker_class = threading.Thread
+        else:
+            shared = process_shared()
+            self.queue = shared.JoinableQueue(maxsize)
+            self.results = shared.Queue()
+            worker_class = shared.Process
+        # Bumped to release the workers once all have answered a control
+        # message.
+        self.control = (shared.RawValue("i", 0), shared.Condition())
+        # Set to the number of the signal that stopped the current run.
+        self.stopping = shared.RawValue("b", 0)
+        self.counters = None
+        if config.progress or config.auto_cores or config.auto_blocksize:
+            self.counters = shared.RawArray("q", 2 * config.ncpus)
+        self.tuning = self.tuner = self.tuning_key = None
+        if config.auto_cores or config.auto_blocksize:
+            self.tuning_key = f"{self.fs_type} {self.fs_source} {self.engine}"
+            tuned = load_tuning(self.tuning_key) or {}
+            cores = config.ncpus
+            if config.auto_cores:
+                cores = min(cores, tuned.get("cores", DEFAULT_CORES))
+            blocksize = config.blocksize
+            if config.auto_blocksize:
+                blocksize = tuned.get("blocksize", blocksize)
+            self.tuning = (shared.RawValue("i", cores),
+                           shared.RawValue("i", blocksize))
+            self.tuner = Tuner(self.counters, self.tuning[0], self.tuning[1],
+                               config.ncpus, config.auto_cores,
+                               config.auto_blocksize, self.start)
+        self.links = InodeSet(LINK_SLOTS, shared)
+        throttle_shared = None
+        if config.max_ops or config.adaptive_ms:
+            throttle_shared = Throttle.create_shared(config.max_ops or 0,
+                                                   shared)
+        self.worker_class = worker_class
+        self.worker_args = (index, throttle_shared, journal, done)
+        self.workers = []
+        self.settings = None
+        # What the workers were last set up with, for those started later.
+        self.setup = None
+        self.duration = 0.0
+
+    def start(self, count=None):
+        """Starts workers until there are `count` of them, or as many as are
+        active."""
+        if count is None:
+            count = self.config.ncpus
+            if self.tuning is not None:
+                count = self.tuning[0].value
+        index, throttle_shared, journal, done = self.worker_args
+        for worker_id in range(len(self.workers), count):
+            worker = self.worker_class(
+                target=worker_main,
+                args=(self.queue, self.results, self.control, self.config,
+                      index, worker_id, self.counters, self.tuning, self.dev,
+                      throttle_shared, journal, done, self.stopping,
+                      self.links, self.setup))
+            worker.start()
+            self.workers.append(worker)
+
+    def broadcast(self, kind, payload=None):
+        """Sends a control message to every started worker and returns their
+        answers."""
+        active = None
+        if self.tuning is not None:
+            # Wake paused workers so that they see the message.
+            active = self.tuning[0].value
+            self.tuning[0].value = len(self.workers)
+        for _ in self.workers:
+            self.queue.put((None, payload, kind))
+        answers = [self.results.get() for _ in self.workers]
+        generation, released = self.control
+        with released:
+            generation.value += 1
+            released.notify_all()
+        if active is not None:
+            self.tuning[0].value = active
+        return answers
+
+    def run(self, path, settings, snapshot=None, shallow=False):
+        """Changes a path and everything below it, or with `shallow` only a
+        folder and the entries directly in it, recording the original state
+        of what changes in the `snapshot` log if given.
+
+        Return: tuple:
+            [0] The merged reports of the workers;
+            [1] How long it took in seconds.
+
+        Raises OSError if a worker cannot open the snapshot log.
+        """
+        start = time.time()
+        setup = (*settings, snapshot)
+        if setup != self.settings:
+            errors = [error for error in self.broadcast(WORK_SETUP, setup)
+                      if error is not None]
+            # Workers close the snapshot log when reporting, so it has to
+            # be opened again next time.
+            self.settings = setup if snapshot is None else None
+            self.setup = setup
+            if errors:
+                self.setup = None
+                self.broadcast(WORK_REPORT)
+                raise OSError(errors[0])
+        stop_tuner = threading.Event()
+        tuner = None
+        if self.tuner is not None:
+            tuner = threading.Thread(target=self.tuner.run,
+                                     args=(stop_tuner,), daemon=True)
+            tuner.start()
+        kind = WORK_FILES
+        if os.path.isdir(path):
+            kind = WORK_SHALLOW if shallow else WORK_DIRS
+        self.queue.put(("", (path,), kind))
+
+        # Workers only mark a directory done after queueing its
+        # subdirectories, so once every queued item is done the whole tree
+        # has been scanned. When stopping, workers mark what is left done
+        # without doing it.
+        self.queue.join()
+        stop_tuner.set()
+        if tuner is not None:
+            # It must not pause workers again while they are being reported.
+            tuner.join()
+        stats = merge_reports(self.broadcast(WORK_REPORT))
+        duration = time.time() - start
+        self.duration += duration
+        return stats, duration
+
+    def restore(self, manifest, waves):
+        """Restores the records of a --snapshot manifest, one wave after the
+        other, each in chunks of the batch size spread over the workers.
+
+        Return: tuple:
+            [0] The merged reports of the workers;
+            [1] How long it took in seconds.
+        """
+        start = time.time()
+        blocksize = self.config.blocksize
+        first = 0
+        for end in waves:
+            for i in range(first, end, blocksize):
+                if self.stopping.value:
+                    break
+                self.queue.put((manifest, (i, min(i + blocksize, end)),
+                                WORK_RESTORE))
+            self.queue.join()
+            if self.stopping.value:
+                break
+            first = end
+        stats = merge_reports(self.broadcast(WORK_REPORT))
+        duration = time.time() - start
+        self.duration += duration
+        return stats, duration
+
+    def close(self):
+        """Stops the workers."""
+        if self.tuning is not None:
+            # Wake paused workers so that they see their sentinel.
+            self.tuning[0].value = len(self.workers)
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def describe(self):
+        """Returns a short description of the filesystem for summaries."""
+        return f"{self.mount_point} ({self.fs_type})"
+
+
+def merge_reports(reports):
+    """Merges the reports of workers, or the stats of results, into one."""
+    merged = {
+        "total": 0,
+        "changed": 0,
+        "skipped": 0,
+        "resumed": 0,
+        "filtered": 0,
+        "duplicates": 0,
+        "untracked": 0,
+        "errors": 0,
+        "crashed": 0,
+        "histogram": {},
+        "violations": {"mode": 0, "group": 0},
+        "records": {},
+        "metrics": []
+    }
+    for report in reports:
+        for name, value in report.items():
+            if name == "histogram":
+                histogram = merged["histogram"]
+                for key, count in value.items():
+                    histogram[key] = histogram.get(key, 0) + count
+            elif name == "violations":
+                for kind, count in value.items():
+                    merged["violations"][kind] += count
+            elif name == "records":
+                merged["records"].update(value)
+            elif name == "metrics":
+                merged["metrics"].extend(value)
+            else:
+                merged[name] += value
+    return merged
+
+
+class Result:
+    """The outcome of changing one of the paths given to FastMod.run().
+
+    `error` is None, or why the path could not be changed at all or in
+    full, e.g. because a worker failed on an unexpected error. `total` is
+    the number of entries that were changed or already correct, `changed`
+    the number that were changed (or would be, with `audit`), and `errors`
+    the number of entries below the path that could not be changed. `stats`
+    holds the rest of the counts, as reported by the workers.
+    """
+    def __init__(self, path, error=None, stats=None, mount=None, seconds=0.0):
+        self.path = path
+        self.error = error
+        self.stats = stats if stats is not None else merge_reports([])
+        self.total = self.stats["total"]
+        self.changed = self.stats["changed"]
+        self.errors = self.stats["errors"]
+        self.mount = mount
+        self.seconds = seconds
+
+    def __repr__(self):
+        if self.error is not None:
+            return f"Result({self.path!r}, error={self.error!r})"
+        return (f"Result({self.path!r}, total={self.total}, "
+                f"changed={self.changed}, errors={self.errors})")
+
+
+class FastMod:
+    """Changes permissions recursively with pools of workers that are kept
+    warm between calls, for use as a library:
+
+        with fastmod.FastMod(ncpus=8, engine="threads") as fm:
+            for result in fm.run(["/data/a", "/data/b"], "g+w", "users"):
+                print(result.path, result.changed, result.error)
+
+    Options are the attributes of `Config`, and default as on the command
+    line, except that `quiet` defaults to True. A pool is started for each
+    filesystem the first time one of its paths is given.
+    """
+    def __init__(self, config=None, index=None, journal=None, done=None,
+                 **options):
+        if config is None:
+            config = Config()
+            config.quiet = True
+        for name, value in options.items():
+            if not hasattr(config, name):
+                raise TypeError(f"unknown option '{name}'")
+            setattr(config, name, value)
+        self.config = config
+        self.index = index
+        self.journal = journal
+        self.done = done
+        self.umask = get_umask()
+        # Set to the number of the signal that stopped the current run.
+        self.stopped = 0
+        self.pools = []
+        self.pools_by_dev = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def settings(self, perms, group):
+        """Returns the compiled (file changes, directory changes, gid) for a
+        perms spec and group, which default to those of the configuration.
+
+        Raises ValueError if either is invalid.
+        """
+        config = self.config
+        if perms is None:
+            perms_fil, perms_dir = config.perms_fil, config.perms_dir
+            nontrivial = config.nontrivial
+        else:
+            perms_fil, perms_dir, nontrivial = parse_perms(perms)
+        changes_fil = changes_dir = None
+        if nontrivial:
+            changes_fil = compile_perm(perms_fil, self.umask)
+            changes_dir = compile_perm(perms_dir, self.umask)
+        if group is None and config.set_group:
+            group = config.group
+        gid = None
+        if group is not None:
+            gid = resolve_group(group)
+            if gid is None:
+                raise ValueError(f"invalid group: '{group}'")
+        return changes_fil, changes_dir, gid
+
+    def pool(self, dev, paths):
+        """Returns the pool for a device, starting it for `paths` if need
+        be."""
+        pool = self.pools_by_dev.get(dev)
+        if pool is None:
+            pool = Pool(dev, paths, self.config, self.index, self.journal,
+                        self.done)
+            pool.start()
+            self.pools_by_dev[dev] = pool
+            self.pools.append(pool)
+        return pool
+
+    def run(self, paths, perms=None, group=None, snapshot=None,
+            shallow=False):
+        """Changes each path and everything below it, or with `shallow` only
+        the entries directly in each folder, yielding a `Result` for each
+        path as soon as it is done.
+
+        Paths on different filesystems are worked on at the same time, and
+        the paths on one filesystem one after the other, each by all of the
+        workers of its pool. `perms` is a permission string, a
+        file_perms:folder_perms pair or a preset such as '--umask', and
+        `group` a group name or number. The original mode, owner and group
+        of every entry that changes is recorded in the file `snapshot`, or
+        that of the configuration, for restore().
+
+        Raises ValueError if `perms` or `group` is invalid, and OSError if
+        the snapshot cannot be created, e.g. because it already exists.
+        """
+        settings = self.settings(perms, group)
+        if snapshot is None:
+            snapshot = self.config.snapshot
+        if snapshot is not None:
+            start_snapshot(snapshot)
+        self.stopped = 0
+        for pool in self.pools:
+            pool.stopping.value = 0
+            # Hardlinks changed by an earlier run are to be changed again.
+            pool.links.clear()
+        failed = []
+        paths_by_dev = {}
+        for path in paths:
+            try:
+                dev = os.lstat(path).st_dev
+            except OSError as e:
+                failed.append(Result(path, error=e.strerror))
+                continue
+            paths_by_dev.setdefault(dev, []).append(path)
+        paths_by_pool = {self.pool(dev, dev_paths): dev_paths
+                         for dev, dev_paths in paths_by_dev.items()}
+        results = queue_module.Queue()
+        for pool, pool_paths in paths_by_pool.items():
+            threading.Thread(target=self.run_pool,
+                             args=(pool, pool_paths, settings, snapshot,
+                                   shallow, results),
+                             daemon=True).start()
+        yield from failed
+        for _ in range(sum(len(paths) for paths in paths_by_pool.values())):
+            yield results.get()
+        if snapshot is not None:
+            finalize_snapshot(snapshot)
+
+    def run_pool(self, pool, paths, settings, snapshot, shallow, results):
+        """Runs the paths of one pool in turn, putting their results on
+        `results`."""
+        for path in paths:
+            if self.stopped:
+                results.put(Result(path, error="interrupted"))
+                continue
+            try:
+                stats, seconds = pool.run(path, settings, snapshot, shallow)
+            except Exception as e:
+                results.put(Result(path, error=str(e)))
+                continue
+            error = None
+            if stats["crashed"]:
+                crashed = stats["crashed"]
+                error = f"{crashed} worker failure" + \
+                    ("s" if crashed != 1 else "")
+            results.put(Result(path, error=error, stats=stats,
+                               mount=pool.describe(), seconds=seconds))
+
+    def restore(self, snapshot):
+        """Sets the mode, owner and group recorded in a snapshot written by
+        run() back on every entry, returning a `Result` for the snapshot.
+
+        Directories are restored from the top down before everything else,
+        each level by all of the workers of the pool of the first entry. A
+        snapshot cut short by a crash is restored as far as it goes.
+        """
+        self.stopped = 0
+        for pool in self.pools:
+            pool.stopping.value = 0
+        try:
+            waves, first = read_snapshot(snapshot)
+        except OSError as e:
+            return Result(snapshot, error=e.strerror)
+        except ValueError as e:
+            return Result(snapshot, error=str(e))
+        if first is None:
+            return Result(snapshot)
+        try:
+            dev = os.lstat(first).st_dev
+        except OSError:
+            first = snapshot
+            dev = os.stat(snapshot).st_dev
+        pool = self.pool(dev, [first])
+        stats, seconds = pool.restore(snapshot, waves)
+        return Result(snapshot, stats=stats, mount=pool.describe(),
+                      seconds=seconds)
+
+    def stop(self, signum=signal.SIGTERM):
+        """Makes the workers finish what they have buffered and skip the rest
+        of the current run. May be called from a signal handler."""
+        self.stopped = signum
+        for pool in self.pools:
+            pool.stopping.value = signum
+
+    def close(self):
+        """Stops the workers of every pool."""
+        for pool in self.pools:
+            pool.close()
+        self.pools = []
+        self.pools_by_dev = {}
+
+
+class Inotify:
+    """A minimal binding of inotify(7) through ctypes.
+
+    Raises OSError if no inotify instance can be created.
+    """
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_EXCL_UNLINK = 0x04000000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self):
+        import ctypes
+        self.ctypes = ctypes
+        self.header = struct.Struct("iIII")
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.add = libc.inotify_add_watch
+        self.add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.rm = libc.inotify_rm_watch
+        self.rm.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self.raise_errno()
+
+    def raise_errno(self, path=None):
+        err = self.ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask):
+        """Returns the watch descriptor of a new or updated watch."""
+        wd = self.add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self.raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Removes a watch, which may already be gone."""
+        self.rm(self.fd, wd)
+
+    def read(self):
+        """Returns the (wd, mask, cookie, name) of every queued event."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = self.header.unpack_from(buf, offset)
+                offset += self.header.size
+                name = buf[offset:offset + length].rstrip(b"\0")
+                offset += length
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """Keeps applying the changes of a configuration to entries below some
+    folders as they are created, moved in or have their attributes changed,
+    for --watch.
+
+    Every folder gets an inotify watch. Events are gathered for
+    `config.watch` seconds after the first one and then applied in a batch:
+    new and changed entries are changed directly, and new folders are first
+    watched and then changed recursively through `fm`, whose pools stay warm.
+    Folders that cannot be watched, e.g. because the watch limit is reached,
+    are rescanned every WATCH_RESCAN_INTERVAL seconds instead.
+    """
+    MASK = (Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_MOVED_FROM |
+            Inotify.IN_ATTRIB | Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW |
+            Inotify.IN_EXCL_UNLINK)
+
+    def __init__(self, fm, roots):
+        self.fm = fm
+        self.config = fm.config
+        self.roots = roots
+        self.changes_fil, self.changes_dir, self.gid = fm.settings(None, None)
+        self.filter = Filter(self.config) if has_filters(self.config) \
+            else None
+        self.inotify = None
+        try:
+            self.inotify = Inotify()
+        except (OSError, AttributeError) as e:
+            if not self.config.quiet:
+                print(f"fastmod: notice: cannot use inotify "
+                      f"({getattr(e, 'strerror', None) or e}), rescanning "
+                      f"every {WATCH_RESCAN_INTERVAL:g} seconds instead",
+                      file=sys.stderr)
+        # Watched folders by watch descriptor.
+        self.dirs = {}
+        # Folders without a watch, which are rescanned instead.
+        self.unwatched = set()
+        self.limit_reached = False
+        self.stopped = 0
+        self.changed = self.total = self.errors = 0
+
+    def watch(self, path):
+        """Adds a watch on a folder.
+
+        Return: whether its subfolders are to be watched too.
+        """
+        if self.inotify is None:
+            self.unwatched.add(path)
+            return False
+        try:
+            self.dirs[self.inotify.add_watch(path, self.MASK)] = path
+            return True
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                self.unwatched.add(path)
+                if not self.limit_reached and not self.config.quiet:
+                    print(f"fastmod: notice: inotify watch limit reached "
+                          f"(fs.inotify.max_user_watches); folders beyond "
+                          f"it are rescanned every "
+                          f"{WATCH_RESCAN_INTERVAL:g} seconds instead",
+                          file=sys.stderr)
+                self.limit_reached = True
+            elif e.errno not in (errno.ENOENT, errno.ENOTDIR) and \
+                    not self.config.quiet:
+                print(f"fastmod: cannot watch '{path}': {e.strerror}",
+                      file=sys.stderr)
+            return False
+
+    def watch_tree(self, root):
+        """Watches a folder and every folder below it that a run would
+        descend into."""
+        try:
+            dev = os.lstat(root).st_dev
+        except OSError:
+            return
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            if not self.watch(path):
+                continue
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if not entry.is_dir(follow_symlinks=False):
+                            continue
+                        if self.filter is not None and \
+                                self.filter.prunes(entry.path, entry.name):
+                            continue
+                        if not self.config.cross_mounts and entry.stat(
+                                follow_symlinks=False).st_dev != dev:
+                            continue
+                        stack.append(entry.path)
+            except OSError:
+                pass
+
+    def unwatch_tree(self, root):
+        """Drops the watches on a folder that was moved away and on every
+        folder below it."""
+        prefix = os.path.join(root, "")
+        for wd, path in list(self.dirs.items()):
+            if path == root or path.startswith(prefix):
+                del self.dirs[wd]
+                self.inotify.rm_watch(wd)
+        self.unwatched = {
+            path for path in self.unwatched
+            if path != root and not path.startswith(prefix)
+        }
+
+    def run(self):
+        """Watches until stop() is called.
+
+        Return: the exit status.
+        """
+        for root in self.roots:
+            self.watch_tree(root)
+        if not self.config.quiet:
+            print(f"fastmod: watching {len(self.dirs)} folders for new and "
+                  f"changed entries", file=sys.stderr)
+        wake_r, wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        old_wakeup = None
+        if threading.current_thread() is threading.main_thread():
+            # Signals then also wake up the poll below.
+            old_wakeup = signal.set_wakeup_fd(wake_w)
+        poller = select.poll()
+        poller.register(wake_r, select.POLLIN)
+        if self.inotify is not None:
+            poller.register(self.inotify.fd, select.POLLIN)
+        events = []
+        deadline = None
+        next_rescan = time.monotonic() + WATCH_RESCAN_INTERVAL
+        try:
+            while not self.stopped:
+                now = time.monotonic()
+                if deadline is not None and \
+                        (now >= deadline or len(events) >= MAX_WATCH_BATCH):
+                    self.apply(events)
+                    events = []
+                    deadline = None
+                    continue
+                if now >= next_rescan:
+                    if self.unwatched:
+                        self.rescan()
+                    next_rescan = time.monotonic() + WATCH_RESCAN_INTERVAL
+                    continue
+                timeout = min(deadline or next_rescan, next_rescan) - now
+                for fd, _ in poller.poll(max(0, timeout) * 1000):
+                    if fd == wake_r:
+                        while True:
+                            try:
+                                if not os.read(wake_r, 4096):
+                                    break
+                            except BlockingIOError:
+                                break
+                    else:
+                        events += self.inotify.read()
+                        if deadline is None and events:
+                            deadline = time.monotonic() + self.config.watch
+        finally:
+            if old_wakeup is not None:
+                signal.set_wakeup_fd(old_wakeup)
+            os.close(wake_r)
+            os.close(wake_w)
+            if self.inotify is not None:
+                self.inotify.close()
+        return 1 if self.errors else 0
+
+    def apply(self, events):
+        """Applies the changes to the entries named by a batch of events."""
+        touched = {}
+        new_dirs = {}
+        for wd, mask, cookie, name in events:
+            if mask & Inotify.IN_Q_OVERFLOW:
+                # Events were lost, so everything has to be looked at.
+                for root in self.roots:
+                    new_dirs[root] = None
+                continue
+            parent = self.dirs.get(wd)
+            if parent is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                del self.dirs[wd]
+                continue
+            path = os.path.join(parent, name) if name else parent
+            if mask & Inotify.IN_MOVED_FROM:
+                if mask & Inotify.IN_ISDIR:
+                    self.unwatch_tree(path)
+                    new_dirs.pop(path, None)
+                continue
+            if mask & Inotify.IN_ISDIR and \
+                    mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                new_dirs[path] = None
+            else:
+                touched[path] = None
+
+        # New folders are watched before they are scanned, so that nothing
+        # created in them in between is missed.
+        runs = []
+        for path in sorted(new_dirs):
+            if self.below(path, new_dirs):
+                continue
+            if self.filter is not None and path not in self.roots and \
+                    self.filter.prunes(path, os.path.basename(path)):
+                continue
+            self.watch_tree(path)
+            runs.append(path)
+
+        entries_fil = []
+        entries_dir = []
+        for path in touched:
+            if path in new_dirs or self.below(path, new_dirs):
+                continue
+            try:
+                st = os.lstat(path)
+            except OSError:
+                # Gone again already.
+                continue
+            name = os.path.basename(path)
+            if self.filter is not None:
+                if stat.S_ISDIR(st.st_mode):
+                    if path not in self.roots and \
+                            self.filter.prunes(path, name):
+                        continue
+                if self.filter.excludes(path, name) or \
+                        not self.filter.selects(st):
+                    continue
+            if stat.S_ISDIR(st.st_mode):
+                entries_dir.append((path, st))
+            else:
+                entries_fil.append((path, st))
+        failed = []
+        changed = apply_changes(entries_fil, self.changes_fil, self.gid,
+                                self.config.quiet, failed)
+        changed += apply_changes(entries_dir, self.changes_dir, self.gid,
+                                 self.config.quiet, failed)
+        total = len(entries_fil) + len(entries_dir)
+        errors = len(failed)
+        if runs:
+            run_total, run_changed, run_errors = self.run_paths(runs)
+            total += run_total
+            changed += run_changed
+            errors += run_errors
+        self.report(total, changed, errors)
+
+    @staticmethod
+    def below(path, dirs):
+        """Returns whether a path is below any of `dirs`."""
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in dirs:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False
+
+    def rescan(self):
+        """Retries watching the folders without a watch, and changes them
+        recursively."""
+        paths = sorted(self.unwatched)
+        self.unwatched = set()
+        for path in paths:
+            self.watch_tree(path)
+        self.report(*self.run_paths(paths))
+
+    def run_paths(self, paths):
+        """Changes folders recursively through the pools.
+
+        Return: tuple:
+            [0] The number of entries looked at;
+            [1] The number of entries changed;
+            [2] The number of errors.
+        """
+        total = changed = errors = 0
+        for result in self.fm.run(paths):
+            if result.error is not None:
+                if result.error not in ("interrupted",
+                                        os.strerror(errno.ENOENT)):
+                    print(f"fastmod: cannot access '{result.path}': "
+                          f"{result.error}", file=sys.stderr)
+                    errors += 1
+                continue
+            total += result.total
+            changed += result.changed
+            errors += result.errors
+        return total, changed, errors
+
+    def report(self, total, changed, errors):
+        """Counts a batch, printing what it changed."""
+        self.total += total
+        self.changed += changed
+        self.errors += errors
+        if (changed or errors) and not self.config.quiet:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} changed {changed} "
+                  f"of {total} new or modified entries" +
+                  (f" ({errors} errors)" if errors else ""), flush=True)
+
+    def stop(self, signum=signal.SIGTERM):
+        """Makes run() return. May be called from a signal handler."""
+        self.stopped = signum
+        self.fm.stop(signum)
+
+
+class Coordinator:
+    """Shares one run between fastmod instances, on one host or several,
+    through a directory on a filesystem that all of them see.
+
+    The first instance to lease the job splits its paths into work items,
+    breadth first until there are COOPERATE_ITEMS: whole subtrees, and the
+    folders above them, which are changed with only the entries directly in
+    them. It writes the items to the `work` file, along with the digest of
+    the job so that instances started for a different one are turned away.
+
+    Every instance then claims items by creating a lease file for them under
+    `leases` with O_EXCL, and renews its leases by touching them while it
+    works. A lease that has not been touched for COOPERATE_LEASE seconds
+    belongs to an instance that crashed, and is taken over. Times are those
+    of the filesystem, as read back from the file under `nodes` that each
+    instance touches, so the clocks of the hosts do not matter. Losing a
+    race for a lease at worst has an item done twice, which changes nothing
+    twice.
+
+    The counts of each finished item are written to `done`. Once every item
+    is done, each instance merges them and writes `summary.json`.
+    """
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        self.owner = f"{os.uname().nodename}.{os.getpid()}"
+        self.node = os.path.join(directory, "nodes", self.owner)
+        self.held = set()
+        self.stopping = threading.Event()
+
+    def path(self, *names):
+        """Returns the path of a file in the directory."""
+        return os.path.join(self.directory, *names)
+
+    def start(self):
+        """Signs up in the directory and starts renewing leases."""
+        for name in ("leases", "done", "nodes"):
+            os.makedirs(self.path(name), exist_ok=True)
+        os.close(os.open(self.node, os.O_WRONLY | os.O_CREAT, 0o644))
+        threading.Thread(target=self.renew, daemon=True).start()
+
+    def now(self):
+        """Returns the current time of the filesystem."""
+        os.utime(self.node)
+        return os.stat(self.node).st_mtime
+
+    def renew(self):
+        """Touches the held leases until stopped."""
+        while not self.stopping.wait(COOPERATE_LEASE / 3):
+            for name in list(self.held):
+                try:
+                    os.utime(self.path("leases", name))
+                except OSError:
+                    pass
+
+    def acquire(self, name):
+        """Creates the lease `name`, taking it over if it has expired.
+
+        Return: whether this instance holds it now.
+        """
+        lease = self.path("leases", name)
+        try:
+            fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            try:
+                expired = os.stat(lease).st_mtime < \
+                    self.now() - COOPERATE_LEASE
+            except FileNotFoundError:
+                return False
+            if not expired:
+                return False
+            # Only one instance can move the expired lease out of the way.
+            stale = f"{lease}.{self.owner}"
+            try:
+                os.rename(lease, stale)
+            except FileNotFoundError:
+                return False
+            if os.stat(stale).st_mtime >= self.now() - COOPERATE_LEASE:
+                # Another instance took it over in the meantime; give it
+                # back unless yet another one already holds it.
+                try:
+                    os.link(stale, lease)
+                except FileExistsError:
+                    pass
+                os.unlink(stale)
+                return False
+            os.unlink(stale)
+            return self.acquire(name)
+        try:
+            os.write(fd, f"{self.owner}\n".encode())
+        finally:
+            os.close(fd)
+        self.held.add(name)
+        return True
+
+    def release(self, name):
+        """Gives up the lease `name`."""
+        self.held.discard(name)
+        try:
+            os.unlink(self.path("leases", name))
+        except OSError:
+            pass
+
+    def write(self, path, data):
+        """Writes JSON to a file in the directory in one go."""
+        import json
+        tmp = os.path.join(os.path.dirname(path),
+                           f".{os.path.basename(path)}.{self.owner}")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def load_work(self):
+        """Returns the (shallow, path) work items, or None if there are none
+        yet.
+
+        Raises ValueError if the directory belongs to another job.
+        """
+        import json
+        try:
+            with open(self.path("work")) as f:
+                work = json.load(f)
+        except FileNotFoundError:
+            return None
+        if work["key"] != self.key:
+            raise ValueError("it is being used by a different run")
+        return work["items"]
+
+    def join(self, roots, config):
+        """Returns the work items of the job, splitting `roots` into them if
+        no other instance has yet."""
+        while not self.stopping.is_set():
+            items = self.load_work()
+            if items is not None:
+                return items
+            if not self.acquire("seed"):
+                self.stopping.wait(COOPERATE_POLL)
+                continue
+            try:
+                items = self.load_work()
+                if items is None:
+                    items = self.split(roots, config)
+                    self.write(self.path("work"),
+                               {"key": self.key, "items": items})
+                return items
+            finally:
+                self.release("seed")
+        return []
+
+    @staticmethod
+    def split(roots, config):
+        """Splits paths into [shallow, path] work items."""
+        filter = Filter(config) if has_filters(config) else None
+        items = [[False, root] for root in roots]
+        for item in items:
+            if len(items) >= COOPERATE_ITEMS:
+                break
+            subdirs = []
+            try:
+                dev = os.lstat(item[1]).st_dev
+                with os.scandir(item[1]) as it:
+                    for entry in it:
+                        # Left as they are for the workers of the folder to
+                        # count as pruned or as mount points.
+                        if entry.is_dir(follow_symlinks=False) and \
+                                (filter is None or
+                                 not filter.prunes(entry.path, entry.name)) \
+                                and entry.stat(follow_symlinks=False).st_dev \
+                                == dev:
+                            subdirs.append(entry.path)
+            except OSError:
+                continue
+            if not subdirs or len(items) + len(subdirs) > COOPERATE_MAX_ITEMS:
+                continue
+            item[0] = True
+            items.extend([False, path] for path in sorted(subdirs))
+        return items
+
+    def claims(self, count):
+        """Yields the indexes of the items this instance is to do, until all
+        of them are done. Each is to be passed to finish() or release()."""
+        import random
+        first = random.randrange(count) if count else 0
+        order = [(first + i) % count for i in range(count)]
+        while not self.stopping.is_set():
+            done = set(os.listdir(self.path("done")))
+            if sum(str(index) in done for index in order) == count:
+                return
+            claimed = False
+            for index in order:
+                name = str(index)
+                if self.stopping.is_set():
+                    return
+                if name in done or not self.acquire(name):
+                    continue
+                if os.path.exists(self.path("done", name)):
+                    # Finished by whoever held it since the listing.
+                    self.release(name)
+                    continue
+                claimed = True
+                yield index
+            if not claimed:
+                self.stopping.wait(COOPERATE_POLL)
+
+    def finish(self, index, result):
+        """Records the counts of a finished item and releases it."""
+        stats = {name: value for name, value in result.stats.items()
+                 if name not in ("records", "metrics")}
+        stats["histogram"] = [[mode, gid, count] for (mode, gid), count
+                              in stats["histogram"].items()]
+        if result.error is not None:
+            stats["errors"] += 1
+        self.write(self.path("done", str(index)),
+                   {"owner": self.owner, "stats": stats})
+        self.release(str(index))
+
+    def summary(self, count):
+        """Merges the counts of every item and writes them to
+        `summary.json`.
+
+        Return: tuple:
+            [0] The merged counts;
+            [1] The instances that did the items.
+        """
+        import json
+        reports = []
+        owners = set()
+        for index in range(count):
+            with open(self.path("done", str(index))) as f:
+                done = json.load(f)
+            owners.add(done["owner"])
+            stats = done["stats"]
+            stats["histogram"] = {(mode, gid): n for mode, gid, n
+                                  in stats["histogram"]}
+            reports.append(stats)
+        stats = merge_reports(reports)
+        summary = {name: value for name, value in stats.items()
+                   if name not in ("histogram", "records", "metrics")}
+        summary["items"] = count
+        summary["instances"] = sorted(owners)
+        summary["modes"] = {
+            f"{stat.filemode(mode)} {gid}": n
+            for (mode, gid), n in stats["histogram"].items()
+        }
+        self.write(self.path("summary.json"), summary)
+        return stats, owners
+
+    def stop(self):
+        """Makes claims() and join() return. May be called from a signal
+        handler."""
+        self.stopping.set()
+
+    def close(self):
+        """Releases every lease and signs off."""
+        self.stopping.set()
+        for name in list(self.held):
+            self.release(name)
+        try:
+            os.unlink(self.node)
+        except OSError:
+            pass
+
+
+def catch_signals(handler):
+    """Sends SIGINT and SIGTERM to `handler`, if called from the main
+    thread.
+
+    Return: the previous handlers, for release_signals().
+    """
+    handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handlers[signum] = signal.signal(signum, handler)
+    return handlers
+
+
+def interrupter(fm, quiet):
+    """Returns a signal handler that stops the runs of `fm`."""
+    def interrupt(signum, frame):
+        if not fm.stopped and not quiet:
+            print(f"fastmod: {signal.strsignal(signum).lower()}, finishing "
+                  f"the current batches...", file=sys.stderr)
+        fm.stop(signum)
+    return interrupt
+
+
+def release_signals(handlers):
+    """Puts back the handlers replaced by catch_signals()."""
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
 
 
 def fastmod(config):
     """Runs fastmod recursively on all specified paths."""
-    group_or_none = config.group if config.set_group else None
-    queue = mp.Queue()
-    workers = [
-        mp.Process(target=worker_main,
-                   args=(queue, group_or_none, config.quiet, config.blocksize,
-                         config.nontrivial)) for _ in range(config.ncpus)
-    ]
-    for worker in workers:
-        worker.start()
-
-    dot = "."
-    total = 0
-    start = time.time()
-    for path in config.paths:
-        if os.path.isfile(path):
-            queue.put_nowait((dot, path, config.perms_fil))
-            total += 1
-        else:
-            for root, _, files in os.walk(path):
-                queue.put_nowait((root, dot, config.perms_dir))
-                total += 1
-                for file in files:
-                    queue.put_nowait((root, file, config.perms_fil))
-                    total += 1
+    gid = None
+    if config.set_group:
+        gid = resolve_group(config.group)
+        if gid is None:
+            print(f"fastmod: invalid group: '{config.group}'")
+            return 1
+    umask = get_umask()
+
+    paths = config.paths
+    index = None
+    index_keys = {}
+    if config.use_index or config.journal is not None or \
+            config.snapshot is not None:
+        # Index and journal records are keyed by absolute path, and
+        # snapshots are to be restorable from any directory.
+        paths = [os.path.abspath(path) for path in paths]
+    if config.use_index:
+        index = {}
+        for path in paths:
+            if os.path.isdir(path):
+                index_keys[path] = index_key(path, config, gid, umask)
+                if not config.full:
+                    index.update(load_index(index_keys[path], config.quiet))
+    journal = done = None
+    if config.journal is not None:
+        key = journal_key(paths, config, gid, umask)
+        journal = config.journal or journal_file(key)
+        if config.resume:
+            done = load_journal(journal, key, config.quiet)
+            if done is None and not config.quiet:
+                print(f"fastmod: notice: no journal to resume from at "
+                      f"'{journal}', starting from the top", file=sys.stderr)
+        if done is None and not start_journal(journal, key, config.quiet):
+            journal = None
+    if config.snapshot is not None and os.path.lexists(config.snapshot):
+        print(f"fastmod: snapshot '{config.snapshot}' already exists")
+        return 1
+    if config.audit_paths is not None:
+        try:
+            open(config.audit_paths, "wb").close()
+        except OSError as e:
+            print(f"fastmod: cannot write '{config.audit_paths}': "
+                  f"{e.strerror}")
+            return 1
+    roots = paths
+    if config.cross_mounts:
+        paths = paths + [
+            mount for path in paths if os.path.isdir(path)
+            for mount in nested_mounts(path)
+        ]
 
-    for _ in workers:
-        queue.put_nowait((None, None, None))
+    fm = FastMod(config, index, journal, done)
 
-    for worker in workers:
-        worker.join()
+    handlers = catch_signals(interrupter(fm, config.quiet))
+    results = []
+    status = 0
+    try:
+        start = time.time()
+        stop_progress = threading.Event()
+        if config.progress:
+            threading.Thread(target=progress_main,
+                             args=(stop_progress, fm.pools, config.progress),
+                             daemon=True).start()
+        try:
+            for result in fm.run(paths):
+                if result.stats["crashed"]:
+                    print(f"fastmod: '{result.path}' was not finished: "
+                          f"{result.error}", file=sys.stderr)
+                    status = 1
+                elif result.error is not None and not fm.stopped:
+                    print(f"fastmod: cannot access '{result.path}': "
+                          f"{result.error}", file=sys.stderr)
+                    status = 1
+                results.append(result)
+        except OSError as e:
+            print(f"fastmod: cannot write snapshot '{config.snapshot}': "
+                  f"{e.strerror}", file=sys.stderr)
+            status = 1
+        stop_progress.set()
+        interrupted = fm.stopped
+    finally:
+        pools = fm.pools
+        fm.close()
+        release_signals(handlers)
+    stats = merge_reports(result.stats for result in results)
+    total, changed = stats["total"], stats["changed"]
+    skipped, resumed = stats["skipped"], stats["resumed"]
+    filtered, duplicates = stats["filtered"], stats["duplicates"]
+    untracked, records = stats["untracked"], stats["records"]
+    histogram, violations = stats["histogram"], stats["violations"]
+    mount_totals = {}
+    for result in results:
+        if result.mount is not None:
+            mount_totals[result.mount] = \
+                mount_totals.get(result.mount, 0) + result.total
+
+    if interrupted:
+        # Directories the run did not get to keep their old records.
+        records = {**index, **records} if index else records
+    for root, key in index_keys.items():
+        prefix = os.path.join(root, "")
+        save_index(key, {
+            path: record for path, record in records.items()
+            if path == root or path.startswith(prefix)
+        }, config.quiet)
 
     duration = time.time() - start
 
     s_per_file = f"{duration / total:.05f}" if total != 0 else "NA"
     fs = "s" if total != 1 else ""
-    print(f"set permissions on {total} file{fs} in {duration:.03f} seconds "
-          f"({s_per_file} s/file; {total/duration:.01f} files/s)")
+    if config.audit:
+        print_audit(total, changed, violations, histogram)
+        print(f"in {duration:.03f} seconds ({s_per_file} s/file; "
+              f"{total/duration:.01f} files/s)")
+    else:
+        print(f"set permissions on {total} file{fs} ({changed} changed, "
+              f"{total - changed} already correct) in {duration:.03f} "
+              f"seconds ({s_per_file} s/file; {total/duration:.01f} "
+              f"files/s)")
+    if skipped:
+        print(f"skipped {skipped} entries in directories unchanged since the "
+              f"last indexed run")
+    if resumed:
+        print(f"skipped {resumed} entries in directories finished before the "
+              f"run was interrupted")
+    if duplicates:
+        print(f"avoided {duplicates} duplicate operations on hardlinked "
+              f"files")
+    if untracked and not config.quiet:
+        print(f"fastmod: notice: {untracked} hardlinked files were not "
+              f"tracked and may have been changed more than once (raise "
+              f"FASTMOD_LINK_SLOTS)", file=sys.stderr)
+    if filtered:
+        print(f"left out {filtered} entries by filters (pruned directories "
+              f"count once)")
+    if config.snapshot is not None and os.path.exists(config.snapshot):
+        try:
+            waves = read_snapshot(config.snapshot)[0]
+            print(f"recorded the original state of "
+                  f"{waves[-1] if waves else 0} changed entries in "
+                  f"'{config.snapshot}'; undo with "
+                  f"--restore={config.snapshot}")
+        except (OSError, ValueError):
+            pass
+    if len(pools) > 1 and not config.quiet:
+        for pool in pools:
+            pool_total = mount_totals.get(pool.describe(), 0)
+            print(f"  {pool.describe()}: {pool_total} files in "
+                  f"{pool.duration:.03f} seconds "
+                  f"({pool_total / pool.duration:.01f} files/s)")
+    for pool in pools:
+        tuner = pool.tuner
+        if tuner is None:
+            continue
+        if tuner.windows < 2:
+            continue
+        save_tuning(pool.tuning_key, tuner.best["cores"],
+                    tuner.best["blocksize"], config.quiet)
+        if not config.quiet:
+            print(f"tuned {pool.describe()}: {tuner.best['cores']} workers, "
+                  f"batches of {tuner.best['blocksize']}")
+    if config.metrics_file:
+        write_metrics(config.metrics_file, stats["metrics"], {
+            "engines": [pool.engine for pool in pools],
+            "mounts": {
+                pool.describe(): {
+                    "total": mount_totals.get(pool.describe(), 0),
+                    "seconds": pool.duration
+                } for pool in pools
+            },
+            "workers": config.ncpus,
+            "blocksize": config.blocksize,
+            "total": total,
+            "changed": changed,
+            "skipped": skipped,
+            "filtered": filtered,
+            "errors": stats["errors"],
+            "hardlink_duplicates": duplicates,
+            "audit": config.audit and {
+                "violations": violations,
+                "modes": {
+                    f"{stat.filemode(mode)} {gid}": count
+                    for (mode, gid), count in histogram.items()
+                }
+            },
+            "seconds": duration
+        })
+    if pools and not config.quiet:
+        # ru_maxrss is in KiB on Linux.
+        parent_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if all(pool.engine == "threads" for pool in pools):
+            print(f"peak memory: {parent_rss / 1024:.01f} MiB "
+                  f"({len(pools) * config.ncpus} worker threads)")
+        else:
+            worker_rss = resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss
+            print(f"peak memory: {parent_rss / 1024:.01f} MiB (main), "
+                  f"{worker_rss / 1024:.01f} MiB (largest worker)")
+    if interrupted:
+        if journal is not None:
+            print("fastmod: interrupted; run again with --resume to continue "
+                  "where it stopped", file=sys.stderr)
+        else:
+            print("fastmod: interrupted", file=sys.stderr)
+        return 128 + interrupted
+    if stats["crashed"]:
+        if journal is not None:
+            print("fastmod: run again with --resume to finish what the "
+                  "failed workers left", file=sys.stderr)
+    elif journal is not None:
+        try:
+            os.unlink(journal)
+        except OSError:
+            pass
+    if config.watch is not None:
+        watcher = Watcher(fm, [path for path in roots if os.path.isdir(path)])
+
+        def stop_watching(signum, frame):
+            watcher.stop(signum)
+
+        handlers = catch_signals(stop_watching)
+        try:
+            status = max(status, watcher.run())
+        finally:
+            fm.close()
+            release_signals(handlers)
+        if not config.quiet:
+            print(f"fastmod: stopped watching; changed {watcher.changed} "
+                  f"entries", file=sys.stderr)
+    return status
+
+
+def restore(config):
+    """Restores the entries recorded in a --snapshot file."""
+    fm = FastMod(config)
+
+    handlers = catch_signals(interrupter(fm, config.quiet))
+    try:
+        result = fm.restore(config.restore)
+        interrupted = fm.stopped
+    finally:
+        fm.close()
+        release_signals(handlers)
+    if result.error is not None:
+        print(f"fastmod: cannot restore from '{result.path}': "
+              f"{result.error}")
+        return 1
+    total, changed, errors = result.total, result.changed, result.errors
+    print(f"restored {total} entries ({changed} changed, "
+          f"{total - changed - errors} already as recorded, {errors} failed) "
+          f"in {result.seconds:.03f} seconds")
+    if errors:
+        print(f"fastmod: {errors} entries could not be restored",
+              file=sys.stderr)
+    if interrupted:
+        print("fastmod: interrupted", file=sys.stderr)
+        return 128 + interrupted
+    return 1 if errors else 0
+
+
+def cooperate(config):
+    """Works on a run shared with other fastmod instances through the
+    --cooperate directory."""
+    gid = None
+    if config.set_group:
+        gid = resolve_group(config.group)
+        if gid is None:
+            print(f"fastmod: invalid group: '{config.group}'")
+            return 1
+    # Every instance has to give the same paths, options and umask.
+    paths = [os.path.abspath(path) for path in config.paths]
+    key = key_digest(journal_key(paths, config, gid, get_umask()) +
+                     ("\0\0audit" if config.audit else ""))
+    roots = paths
+    if config.cross_mounts:
+        roots = paths + [
+            mount for path in paths if os.path.isdir(path)
+            for mount in nested_mounts(path)
+        ]
+    coordinator = Coordinator(config.cooperate, key)
+    fm = FastMod(config)
+    interrupt = interrupter(fm, config.quiet)
+
+    def stop(signum, frame):
+        interrupt(signum, frame)
+        coordinator.stop()
+
+    handlers = catch_signals(stop)
+    results = []
+    status = 0
+    stats = None
+    start = time.time()
+    try:
+        coordinator.start()
+        items = coordinator.join(roots, config)
+        if items and not config.quiet:
+            print(f"fastmod: sharing {len(items)} work items through "
+                  f"'{config.cooperate}'", file=sys.stderr)
+        for index in coordinator.claims(len(items)):
+            shallow, path = items[index]
+            for result in fm.run([path], shallow=shallow):
+                if fm.stopped:
+                    # Left for another instance to do over.
+                    coordinator.release(str(index))
+                    break
+                if result.error is not None:
+                    print(f"fastmod: cannot access '{result.path}': "
+                          f"{result.error}", file=sys.stderr)
+                    status = 1
+                coordinator.finish(index, result)
+                results.append(result)
+        if not fm.stopped:
+            stats, owners = coordinator.summary(len(items))
+    except (OSError, ValueError) as e:
+        print(f"fastmod: cannot cooperate through '{config.cooperate}': "
+              f"{getattr(e, 'strerror', None) or e}")
+        status = 1
+    finally:
+        fm.close()
+        coordinator.close()
+        release_signals(handlers)
+    duration = time.time() - start
+    mine = merge_reports(result.stats for result in results)
+    if not config.quiet:
+        print(f"this instance did {len(results)} work items with "
+              f"{mine['total']} entries ({mine['changed']} changed) in "
+              f"{duration:.03f} seconds")
+    if fm.stopped:
+        print("fastmod: interrupted; run again with the same --cooperate "
+              "directory to continue", file=sys.stderr)
+        return 128 + fm.stopped
+    if stats is None:
+        return status
+    total, changed = stats["total"], stats["changed"]
+    instances = f"{len(owners)} instance{'s' if len(owners) != 1 else ''}"
+    if config.audit:
+        print_audit(total, changed, stats["violations"], stats["histogram"])
+        print(f"across {instances}")
+    else:
+        print(f"set permissions on {total} files ({changed} changed, "
+              f"{total - changed} already correct) across {instances}")
+    if stats["filtered"]:
+        print(f"left out {stats['filtered']} entries by filters (pruned "
+              f"directories count once)")
+    if stats["errors"]:
+        print(f"fastmod: {stats['errors']} entries could not be changed",
+              file=sys.stderr)
+    if not config.quiet:
+        print(f"merged summary written to "
+              f"'{coordinator.path('summary.json')}'")
+    return status
 
 
 def main(argv):
@@ -589,13 +4301,14 @@ def main(argv):
     config = parse_args(argv)
     if config is None:
         return 1
+    if config.restore is not None:
+        return restore(config)
     print_config(config)
+    if config.cooperate is not None:
+        return cooperate(config)
 
-    fastmod(config)
-    return 0
+    return fastmod(config)
 
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
-else:
-    raise ImportError("fastmod is run as a script, not included as a module.")
@@ -0,0 +1,404 @@
+#!/usr/local/bin/python3.11 -S
+"""\
+fastmod_bench: Benchmarks fastmod against chmod -R and chgrp -R.
+
+Generates synthetic trees of a few shapes, runs every requested fastmod
+configuration and the coreutils baselines over them, and prints one JSON
+object per run with files/s, CPU time and peak RSS so that results can be
+compared between versions.
+
+Runs as a standalone script.
+"""
+
+import grp
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+__copyright__ = "Copyright (c) 2023 Broadcom Corporation. All rights reserved."
+__license__ = "Public Domain"
+__version__ = "1.0.0"
+
+# Tree shapes that can be generated, and what they look like at --scale=1.
+SHAPES = {
+    "wide": "1000 directories side by side with 10 files each",
+    "deep": "5 chains of 200 nested directories with 5 files each",
+    "tiny": "20000 directories with 1 file each",
+    "bigdir": "1000000 files in a single directory",
+    "links": "10000 files, each hardlinked twice more and symlinked once",
+}
+
+# Permissions alternated between runs so that every run changes every entry.
+TOGGLE_PERMS = ("g+w", "g-w")
+
+# Median wall time allowed for a cold `fastmod -q g+w <file>` by --startup.
+DEFAULT_STARTUP_BUDGET_MS = 100
+
+
+def default_root():
+    """Returns a tmpfs directory if there is one, else the temp directory."""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return os.environ.get("TMPDIR", "/tmp")
+
+
+def touch(path):
+    """Creates an empty file."""
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o644))
+
+
+def generate(shape, path, scale):
+    """Generates a tree of the given shape at `path`."""
+    def n(count):
+        return max(1, int(count * scale))
+
+    os.makedirs(path)
+    if shape == "wide":
+        for i in range(n(1000)):
+            d = f"{path}/d{i}"
+            os.mkdir(d)
+            for j in range(10):
+                touch(f"{d}/f{j}")
+    elif shape == "deep":
+        for i in range(5):
+            d = f"{path}/c{i}"
+            os.mkdir(d)
+            for j in range(n(200)):
+                d = f"{d}/d{j}"
+                os.mkdir(d)
+                for k in range(5):
+                    touch(f"{d}/f{k}")
+    elif shape == "tiny":
+        for i in range(n(20000)):
+            d = f"{path}/{i % 100}/d{i}"
+            os.makedirs(d)
+            touch(f"{d}/f")
+    elif shape == "bigdir":
+        for i in range(n(1000000)):
+            touch(f"{path}/f{i}")
+    elif shape == "links":
+        for d in ("files", "links1", "links2", "symlinks"):
+            os.mkdir(f"{path}/{d}")
+        for i in range(n(10000)):
+            touch(f"{path}/files/f{i}")
+            os.link(f"{path}/files/f{i}", f"{path}/links1/f{i}")
+            os.link(f"{path}/files/f{i}", f"{path}/links2/f{i}")
+            os.symlink(f"../files/f{i}", f"{path}/symlinks/f{i}")
+    else:
+        raise ValueError(f"unknown shape '{shape}'")
+
+
+def prepare_tree(root, shape, scale):
+    """Returns the path of a generated tree, reusing a complete one.
+
+    Return: tuple:
+        [0] The path of the tree;
+        [1] The number of entries in it, including the top directory.
+    """
+    path = os.path.join(root, f"fastmod-bench-{shape}-{scale:g}")
+    marker = f"{path}.complete"
+    if not os.path.exists(marker):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        print(f"fastmod_bench: generating {shape} tree at {path}",
+              file=sys.stderr)
+        generate(shape, path, scale)
+        touch(marker)
+    count = 1
+    for _, dirs, files in os.walk(path):
+        count += len(dirs) + len(files)
+    return path, count
+
+
+def group_name(gid):
+    """Returns the name of a group, or its number if it has none."""
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return str(gid)
+
+
+def other_group(gid):
+    """Returns the name of a group other than `gid` that files can be given
+    by this user, or None if there is none."""
+    if os.geteuid() == 0:
+        gids = {group.gr_gid for group in grp.getgrall()}
+    else:
+        gids = set(os.getgroups()) | {os.getegid()}
+    gids.discard(gid)
+    return group_name(min(gids)) if gids else None
+
+
+def fastmod_version(fastmod):
+    """Returns the __version__ of the fastmod script, or None."""
+    try:
+        with open(fastmod) as f:
+            match = re.search(r'^__version__ = "([^"]*)"', f.read(), re.M)
+    except OSError:
+        return None
+    return match.group(1) if match else None
+
+
+def run_measured(cmd):
+    """Runs a command and measures it.
+
+    Return: tuple:
+        [0] The exit status;
+        [1] Wall time in seconds;
+        [2] User plus system CPU time of the command and its children;
+        [3] Peak RSS of the largest process in KiB.
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return (proc.returncode, wall, rusage.ru_utime + rusage.ru_stime,
+            rusage.ru_maxrss)
+
+
+def measure_startup(fastmod, root, runs, budget_ms, common, out):
+    """Times cold fastmod invocations on a single file and prints one JSON
+    object with the median and worst wall time.
+
+    Return: True if every run succeeded and the median is within
+    `budget_ms`.
+    """
+    path = os.path.join(root, f"fastmod-bench-startup-{os.getpid()}")
+    touch(path)
+    times = []
+    statuses = set()
+    try:
+        for run in range(runs):
+            cmd = [sys.executable, fastmod, "-q", TOGGLE_PERMS[run % 2], path]
+            status, wall, _, _ = run_measured(cmd)
+            statuses.add(status)
+            times.append(wall)
+    finally:
+        os.unlink(path)
+    times.sort()
+    median_ms = times[len(times) // 2] * 1000
+    result = dict(common)
+    result.update({
+        "tool": "fastmod startup",
+        "runs": runs,
+        "status": max(statuses),
+        "median_ms": median_ms,
+        "max_ms": times[-1] * 1000,
+        "budget_ms": budget_ms,
+    })
+    print(json.dumps(result), file=out, flush=True)
+    return median_ms <= budget_ms and statuses == {0}
+
+
+def parse_list(value, convert=str):
+    """Parses a comma-separated option value."""
+    return [convert(v) for v in value.split(",") if v]
+
+
+def print_usage():
+    """Displays usage information."""
+    print("Usage:")
+    print("  fastmod_bench [options]")
+    print()
+    print("Options:")
+    print("  --root=<dir>          where to generate trees "
+          f"(default: {default_root()})")
+    print("  --shapes=<a,b,...>    tree shapes to run "
+          f"(default: all of {','.join(SHAPES)})")
+    print("  --scale=<factor>      scale every tree by this factor "
+          "(default: 1)")
+    print("  --cores=<n,...>       fastmod -C values (default: 1,4)")
+    print("  --blocksizes=<n,...>  fastmod -B values (default: 128)")
+    print("  --engines=<e,...>     fastmod --engine values "
+          "(default: processes,threads)")
+    print("  --group               also change group ownership, back and "
+          "forth between")
+    print("                        the tree's group and another one of "
+          "yours")
+    print("  --repeat=<n>          runs per configuration (default: 3, or 20 "
+          "with --startup)")
+    print("  --fastmod=<path>      fastmod script to benchmark "
+          "(default: next to this script)")
+    print("  --no-baseline         skip chmod -R and chgrp -R")
+    print("  --output=<file>       append results to <file> instead of "
+          "stdout")
+    print("  --clean               remove generated trees afterwards")
+    print("  --startup             only time cold starts of fastmod on a "
+          "single file, and")
+    print("                        exit with 1 if the median is over budget")
+    print("  --startup-budget=<ms> budget for --startup (default: "
+          f"{DEFAULT_STARTUP_BUDGET_MS})")
+    print()
+    print("Shapes at --scale=1:")
+    for shape, description in SHAPES.items():
+        print(f"  {shape.ljust(8)}  {description}")
+
+
+def main(argv):
+    """Entry point for the application."""
+    root = default_root()
+    shapes = list(SHAPES)
+    scale = 1.0
+    cores = [1, 4]
+    blocksizes = [128]
+    engines = ["processes", "threads"]
+    set_group = False
+    repeat = None
+    fastmod = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "fastmod.py")
+    baseline = True
+    output = None
+    clean = False
+    startup = False
+    budget_ms = DEFAULT_STARTUP_BUDGET_MS
+    for arg in argv[1:]:
+        name, _, value = arg.partition("=")
+        if name in ("-h", "--help"):
+            print_usage()
+            return 1
+        elif name == "--root":
+            root = value
+        elif name == "--shapes":
+            shapes = parse_list(value)
+            for shape in shapes:
+                if shape not in SHAPES:
+                    print(f"fastmod_bench: unknown shape '{shape}'")
+                    return 1
+        elif name == "--scale":
+            scale = float(value)
+        elif name == "--cores":
+            cores = parse_list(value, int)
+        elif name == "--blocksizes":
+            blocksizes = parse_list(value, int)
+        elif name == "--engines":
+            engines = parse_list(value)
+        elif name == "--group":
+            set_group = True
+        elif name == "--repeat":
+            repeat = int(value)
+        elif name == "--fastmod":
+            fastmod = value
+        elif name == "--no-baseline":
+            baseline = False
+        elif name == "--output":
+            output = value
+        elif name == "--clean":
+            clean = True
+        elif name == "--startup":
+            startup = True
+        elif name == "--startup-budget":
+            budget_ms = float(value)
+        else:
+            print(f"fastmod_bench: unknown option '{arg}'")
+            print_usage()
+            return 1
+
+    out = open(output, "a") if output else sys.stdout
+    common = {
+        "fastmod_version": fastmod_version(fastmod),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "scale": scale,
+        "root": root,
+        "timestamp": time.time(),
+    }
+
+    if startup:
+        within = measure_startup(fastmod, root, repeat or 20, budget_ms,
+                                 common, out)
+        if output:
+            out.close()
+        if not within:
+            print(f"fastmod_bench: median start-up time is over the budget of "
+                  f"{budget_ms:g} ms", file=sys.stderr)
+            return 1
+        return 0
+
+    repeat = repeat or 3
+
+    configs = []
+    for ncores in cores:
+        for blocksize in blocksizes:
+            for engine in engines:
+                configs.append(("fastmod", {
+                    "cores": ncores,
+                    "blocksize": blocksize,
+                    "engine": engine
+                }))
+    if baseline:
+        configs.append(("chmod -R", {}))
+        if set_group:
+            configs.append(("chgrp -R", {}))
+
+    for shape in shapes:
+        path, entries = prepare_tree(root, shape, scale)
+        toggle = group_toggle = 0
+        groups = None
+        runs = configs
+        if set_group:
+            # Groups are alternated like perms: with the tree's own group
+            # alone, fastmod would find nothing to change.
+            gid = os.stat(path).st_gid
+            other = other_group(gid)
+            if other is None:
+                print(f"fastmod_bench: skipping the {shape} tree: --group "
+                      f"needs a group other than {group_name(gid)} to give "
+                      f"it to", file=sys.stderr)
+                runs = []
+            else:
+                groups = (other, group_name(gid))
+        for tool, params in runs:
+            for run in range(repeat):
+                perms = TOGGLE_PERMS[toggle]
+                toggle ^= 1
+                group = None
+                if groups and tool != "chmod -R":
+                    group = groups[group_toggle]
+                    group_toggle ^= 1
+                if tool == "fastmod":
+                    cmd = [
+                        sys.executable, fastmod, "-q",
+                        f"-C{params['cores']}", f"-B{params['blocksize']}",
+                        f"--engine={params['engine']}", perms, path
+                    ]
+                    if group:
+                        cmd.insert(3, f"-G{group}")
+                elif tool == "chmod -R":
+                    cmd = ["chmod", "-R", perms, path]
+                else:
+                    cmd = ["chgrp", "-R", group, path]
+                status, wall, cpu, rss = run_measured(cmd)
+                result = dict(common)
+                result.update({
+                    "shape": shape,
+                    "entries": entries,
+                    "tool": tool,
+                    "params": params,
+                    "perms": perms if tool != "chgrp -R" else None,
+                    "group": group,
+                    "run": run,
+                    "status": status,
+                    "seconds": wall,
+                    "files_per_second": entries / wall if wall else None,
+                    "cpu_seconds": cpu,
+                    "peak_rss_kib": rss,
+                })
+                print(json.dumps(result), file=out, flush=True)
+        if clean:
+            shutil.rmtree(path)
+            os.unlink(f"{path}.complete")
+
+    if output:
+        out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
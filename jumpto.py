@@ -8,42 +8,606 @@ project may have relevant files in multiple disks.
 Store one or more locations under a label with ``jumpto -s <label>``
 and jump back to them with ``jumpto <label>`` (if there are multiple
 locations, you are prompted to select which one.)
+
+With the prompt hook of jumpto_wrapper.sh, visited folders are tracked as
+well, and ``jumpto <fragment>`` jumps to the best label or folder matching
+any part of it, ranked by how often and how recently each was visited.
+
+``jumpto --index <root>`` indexes the folders below a root, and
+``jumpto --find <pattern>`` jumps to an indexed folder matching a pattern.
 """
 
 import getpass
+import heapq
+import json
+import marshal
 import os
+import re
 import sys
+import threading
+import time
+import queue as queue_module
 
 __copyright__ = "Copyright (c) 2023 Broadcom Corporation. All rights reserved."
 __license__ = "Public Domain"
-__version__ = "1.0.0"
+__version__ = "1.4.0"
 
 USER = getpass.getuser()
-JUMP_LIST = f"/home/{USER}/.jump"
-os.umask(0o027)
-os.makedirs(JUMP_LIST, mode=0o755, exist_ok=True)
-
-if "_JUMPTO" in os.environ:
-    # We are being sourced through the Bash wrapper - good!
-    IS_SOURCED = True
-    DEST_HOLDER = os.environ["_JUMPTO"]
-else:
-    # We are not being sourced, so we have to use subshells to change
-    # cwd
-    IS_SOURCED = False
-    SHELL = os.environ.get("SHELL", "/bin/bash")
-
-if not sys.argv[1:]:
+JUMP_LIST = os.environ.get("JUMPTO_DIR", f"/home/{USER}/.jump")
+
+# Every label and its locations, as one JSON object replaced as a whole, so
+# that listing or jumping reads a single file however many labels there are.
+LABELS_FILE = os.path.join(JUMP_LIST, ".labels.json")
+
+# Taken by anything that changes LABELS_FILE, so that concurrent shells do
+# not lose each other's changes.
+LOCK_FILE = os.path.join(JUMP_LIST, ".lock")
+
+# Where the per-label files of versions before 1.1 are moved once they have
+# been copied into LABELS_FILE.
+MIGRATED_DIR = os.path.join(JUMP_LIST, ".migrated")
+
+# Visits appended by the prompt hook, as "<epoch seconds>\t<path>" lines.
+VISITS_FILE = os.path.join(JUMP_LIST, ".visits")
+
+# Visited folders ranked by visits, as "<rank>\t<last visit>\t<path>" lines
+# with the highest rank first, into which VISITS_FILE is folded.
+FRECENCY_FILE = os.path.join(JUMP_LIST, ".frecency")
+
+# Once the ranks add up to more than this, they are all multiplied by
+# FRECENCY_AGING, and folders left with a rank below 1 are forgotten.
+FRECENCY_MAX_TOTAL = 10000
+FRECENCY_AGING = 0.9
+
+# Multipliers of the rank of a folder last visited within each of these
+# seconds, and of those visited longer ago.
+RECENCY_WEIGHTS = ((3600, 4.0), (86400, 2.0), (604800, 0.5))
+OLD_WEIGHT = 0.25
+
+# Multiplier of the score of a folder whose own name matches.
+NAME_BONUS = 2.0
+
+# Matches shown by -l.
+MAX_LISTED = 20
+
+# Threads that check whether locations exist, and seconds each check may
+# take before its location is reported as unreachable, e.g. on a hung
+# automount.
+PROBE_THREADS = 8
+PROBE_TIMEOUT = float(os.environ.get("JUMPTO_PROBE_TIMEOUT", 2))
+
+# Results of recent checks, as {path: [time, exists]} with None for
+# unreachable, and how many seconds they are trusted for.
+PROBE_CACHE_FILE = os.path.join(JUMP_LIST, ".probes")
+PROBE_CACHE_SECONDS = 30
+
+# The folders below the roots given to --index, one path per line in byte
+# order, searched by --find.
+FOLDER_INDEX_FILE = os.path.join(JUMP_LIST, ".index")
+
+# The roots and what --index found in each folder, as a marshalled
+# (version, roots, {path: (mtime_ns, subfolder names)}), so that a refresh
+# only lists the folders that have changed since.
+FOLDER_RECORDS_FILE = os.path.join(JUMP_LIST, ".index.records")
+FOLDER_RECORDS_VERSION = 1
+
+# Threads that list folders for --index.
+INDEX_THREADS = int(os.environ.get("JUMPTO_INDEX_THREADS", 16))
+
+# Folders that --index does not descend into.
+INDEX_PRUNE = {".git", ".hg", ".svn", ".snapshot", "__pycache__"}
+
+# Folders changed less than this many nanoseconds before they are listed
+# are listed again on the next refresh, as entries created within the
+# mtime granularity of the filesystem may not have changed their mtime.
+INDEX_RACY_NS = 2_000_000_000
+
+# Matches of --find that are offered to choose from.
+MAX_FOUND = 50
+
+
+def read_label_files(directory):
+    """Returns the {label: [paths]} of a directory of per-label files."""
+    labels = {}
+    for label in os.listdir(directory):
+        if label.startswith("."):
+            continue
+        with open(os.path.join(directory, label), mode="r") as f:
+            labels[label] = [line.strip() for line in f if line.strip()]
+    return labels
+
+
+def read_labels():
+    """Returns the stored {label: [paths]}, or None if there is no store yet.
+
+    Exits with an error if the store cannot be read, so that it is never
+    replaced by what would be left of it.
+    """
+    try:
+        with open(LABELS_FILE, mode="r") as f:
+            labels = json.load(f)
+        if not isinstance(labels, dict):
+            raise ValueError("not a JSON object")
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print(f"jumpto: cannot read labels from '{LABELS_FILE}': {e}; "
+              "fix or remove it")
+        sys.exit(1)
+    return labels
+
+
+def load_labels():
+    """Returns the stored {label: [paths]}, migrating per-label files into
+    the store the first time."""
+    labels = read_labels()
+    if labels is None:
+        labels = update_labels(lambda labels: False)
+    return labels
+
+
+def save_labels(labels):
+    """Replaces the store with `labels` in one step."""
+    tmp_path = f"{LABELS_FILE}.{os.getpid()}"
+    try:
+        with open(tmp_path, mode="w") as f:
+            json.dump(labels, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, LABELS_FILE)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_labels(change):
+    """Calls `change` with the stored {label: [paths]} while holding the
+    lock, and saves them if it returns True.
+
+    Return: the labels as left by `change`.
+    """
+    import fcntl
+    with open(LOCK_FILE, mode="a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        labels = read_labels()
+        if labels is None:
+            # First run since per-label files: copy them in, then move them
+            # out of the way so that nobody edits them by mistake.
+            labels = read_label_files(JUMP_LIST)
+            save_labels(labels)
+            if labels:
+                os.makedirs(MIGRATED_DIR, exist_ok=True)
+                for label in labels:
+                    os.replace(os.path.join(JUMP_LIST, label),
+                               os.path.join(MIGRATED_DIR, label))
+        if change(labels):
+            save_labels(labels)
+    return labels
+
+
+def read_frecency():
+    """Returns the {path: [rank, last visit]} of the frecency table."""
+    table = {}
+    try:
+        with open(FRECENCY_FILE, mode="r", errors="surrogateescape") as f:
+            for line in f:
+                rank, last, path = line.rstrip("\n").split("\t", 2)
+                table[path] = [float(rank), int(last)]
+    except FileNotFoundError:
+        pass
+    return table
+
+
+def fold_visits():
+    """Adds the visits logged by the prompt hook to the frecency table,
+    aging it if need be, and empties the log."""
+    if not os.path.exists(VISITS_FILE):
+        return
+    import fcntl
+    with open(LOCK_FILE, mode="a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        # The hook opens the log for each visit, so once it has been moved
+        # away new visits go to a new one.
+        folding = f"{VISITS_FILE}.{os.getpid()}"
+        try:
+            os.rename(VISITS_FILE, folding)
+        except FileNotFoundError:
+            return
+        table = read_frecency()
+        with open(folding, mode="r", errors="surrogateescape") as f:
+            for line in f:
+                when, _, path = line.rstrip("\n").partition("\t")
+                if not when.isdigit() or not path.startswith("/"):
+                    continue
+                entry = table.setdefault(path, [0.0, 0])
+                entry[0] += 1
+                entry[1] = max(entry[1], int(when))
+        if sum(rank for rank, _ in table.values()) > FRECENCY_MAX_TOTAL:
+            table = {path: [rank * FRECENCY_AGING, last]
+                     for path, (rank, last) in table.items()
+                     if rank * FRECENCY_AGING >= 1}
+        tmp_path = f"{FRECENCY_FILE}.{os.getpid()}"
+        with open(tmp_path, mode="w", errors="surrogateescape") as f:
+            for path, (rank, last) in sorted(table.items(),
+                                             key=lambda item: -item[1][0]):
+                f.write(f"{rank:g}\t{last}\t{path}\n")
+        os.replace(tmp_path, FRECENCY_FILE)
+        os.unlink(folding)
+
+
+def frecency(rank, last, now):
+    """Returns the score of a folder from its rank and last visit."""
+    age = now - last
+    for seconds, weight in RECENCY_WEIGHTS:
+        if age < seconds:
+            return rank * weight
+    return rank * OLD_WEIGHT
+
+
+def find_lines(text, pattern, newline="\n"):
+    """Yields the (start, end) of each line of `text` that `pattern` is
+    found in, in order."""
+    pos = 0
+    while pos < len(text):
+        match = pattern.search(text, pos)
+        if match is None:
+            return
+        start = text.rfind(newline, 0, match.start()) + 1
+        end = text.find(newline, match.start())
+        if end == -1:
+            end = len(text)
+        yield start, end
+        pos = end + 1
+
+
+def match_folders(fragment, limit):
+    """Returns up to `limit` of the tracked folders containing a fragment,
+    or if none do, with its characters in order, as (score, path) pairs
+    with the best first. Folders containing it in their name score
+    NAME_BONUS times higher."""
+    try:
+        with open(FRECENCY_FILE, mode="r", errors="surrogateescape") as f:
+            text = f.read()
+    except FileNotFoundError:
+        return []
+    lower = text.lower()
+    needle = fragment.lower()
+    now = time.time()
+    max_weight = max(weight for _, weight in RECENCY_WEIGHTS) * NAME_BONUS
+    # Like [^\nb]*b rather than .*?b, so that each line is matched in one
+    # pass however long the fragment is.
+    fuzzy = re.compile("".join(
+        (f"[^\\n{re.escape(c)}]*" if i else "") + re.escape(c)
+        for i, c in enumerate(needle)))
+    for pattern in (re.compile(re.escape(needle)), fuzzy):
+        best = []
+        for start, end in find_lines(lower, pattern):
+            rank, last, path = text[start:end].split("\t", 2)
+            rank = float(rank)
+            # The table is sorted by rank, so once even the best weight
+            # cannot lift a folder above those found, none after it can.
+            if len(best) == limit and rank * max_weight <= best[0][0]:
+                break
+            if not pattern.search(path.lower()):
+                # Only the rank or date matched.
+                continue
+            score = frecency(rank, int(last), now)
+            if pattern is not fuzzy and \
+                    needle in os.path.basename(path).lower():
+                score *= NAME_BONUS
+            if len(best) < limit:
+                heapq.heappush(best, (score, path))
+            else:
+                heapq.heappushpop(best, (score, path))
+        if best:
+            return sorted(best, reverse=True)
+    return []
+
+
+def match_labels(fragment, labels):
+    """Returns the labels containing a fragment, or if none do, with its
+    characters in order, with the shortest first."""
+    needle = fragment.lower()
+    matches = [label for label in labels if needle in label.lower()]
+    if not matches:
+        pattern = re.compile(".*?".join(re.escape(c) for c in needle))
+        matches = [label for label in labels
+                   if pattern.search(label.lower())]
+    return sorted(matches, key=len)
+
+
+def probe(paths):
+    """Checks whether locations exist, several at a time.
+
+    Return: {path: True if it exists, False if it does not, or None if that
+    could not be found out within PROBE_TIMEOUT seconds or because of an
+    error other than it missing}. Paths that were never checked because
+    every thread was stuck on others are left out, and are not cached.
+    """
+    now = time.time()
+    try:
+        with open(PROBE_CACHE_FILE, mode="r") as f:
+            cache = {path: entry for path, entry in json.load(f).items()
+                     if now - entry[0] < PROBE_CACHE_SECONDS}
+    except (OSError, ValueError):
+        cache = {}
+    results = {path: cache[path][1] for path in paths if path in cache}
+    todo = [path for path in dict.fromkeys(paths) if path not in results]
+    if not todo:
+        return results
+
+    checked = {}
+    started = {}
+    pending = todo[::-1]
+    lock = threading.Condition()
+
+    def check():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                path = pending.pop()
+                started[path] = time.monotonic()
+            try:
+                os.stat(path)
+                exists = True
+            except (FileNotFoundError, NotADirectoryError):
+                exists = False
+            except OSError:
+                exists = None
+            with lock:
+                checked[path] = exists
+                lock.notify()
+
+    # Threads stuck on a hung mount cannot be stopped, so they are left
+    # behind as daemons.
+    nthreads = min(PROBE_THREADS, len(todo))
+    for _ in range(nthreads):
+        threading.Thread(target=check, daemon=True).start()
+    with lock:
+        while len(checked) < len(todo):
+            now_monotonic = time.monotonic()
+            deadlines = [start + PROBE_TIMEOUT
+                         for path, start in started.items()
+                         if path not in checked]
+            late = sum(deadline <= now_monotonic for deadline in deadlines)
+            # Once every thread is stuck, nothing else gets checked.
+            if len(checked) + late == len(todo) or late == nthreads:
+                break
+            lock.wait(min((deadline for deadline in deadlines
+                           if deadline > now_monotonic),
+                          default=now_monotonic + PROBE_TIMEOUT)
+                      - now_monotonic)
+        checked = dict(checked)
+        started = dict(started)
+    for path in todo:
+        if path in checked:
+            results[path] = checked[path]
+        elif path in started:
+            # Timed out.
+            results[path] = None
+        else:
+            continue
+        cache[path] = [now, results[path]]
+    try:
+        tmp_path = f"{PROBE_CACHE_FILE}.{os.getpid()}"
+        with open(tmp_path, mode="w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, PROBE_CACHE_FILE)
+    except OSError:
+        pass
+    return results
+
+
+def load_folder_records():
+    """Returns the roots and folder records of the last --index, or no
+    roots and records if there are none that can be read."""
+    try:
+        with open(FOLDER_RECORDS_FILE, mode="rb") as f:
+            version, roots, records = marshal.load(f)
+        if version == FOLDER_RECORDS_VERSION and isinstance(records, dict):
+            return list(roots), records
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return [], {}
+
+
+def scan_folders(root, old_records):
+    """Finds every folder below `root` on the same filesystem, listing
+    several folders at a time and only those that have changed since
+    their record in `old_records`.
+
+    Return: tuple:
+        [0] {path: (mtime_ns, subfolder names)} of the folders found;
+        [1] The number of folders that had to be listed.
+    """
+    records = {}
+    found = []
+    listed = [0]
+    try:
+        dev = os.stat(root).st_dev
+    except OSError as e:
+        print(f"jumpto: cannot index '{root}': {e.strerror}")
+        return records, 0
+    queue = queue_module.Queue()
+
+    def scan():
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+            try:
+                st = os.lstat(path)
+                if st.st_dev != dev:
+                    continue
+                found.append(path)
+                record = old_records.get(path)
+                if record is None or record[0] != st.st_mtime_ns:
+                    listed[0] += 1
+                    with os.scandir(path) as it:
+                        names = tuple(entry.name for entry in it
+                                      if entry.name not in INDEX_PRUNE and
+                                      entry.is_dir(follow_symlinks=False))
+                    record = (st.st_mtime_ns, names)
+                if time.time_ns() - st.st_mtime_ns > INDEX_RACY_NS:
+                    records[path] = record
+                for name in record[1]:
+                    queue.put(os.path.join(path, name))
+            except OSError:
+                pass
+            finally:
+                queue.task_done()
+
+    threads = [threading.Thread(target=scan, daemon=True)
+               for _ in range(INDEX_THREADS)]
+    for thread in threads:
+        thread.start()
+    queue.put(root)
+    queue.join()
+    # Every folder is done, so the threads are all waiting for more.
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    # Folders listed too soon after a change have no record to reuse, but
+    # are still found.
+    for path in found:
+        records.setdefault(path, None)
+    return records, listed[0]
+
+
+def index_folders(new_roots):
+    """Adds roots to those indexed by --index and refreshes the index of
+    all of them."""
+    start = time.time()
+    roots, old_records = load_folder_records()
+    for root in new_roots:
+        root = os.path.realpath(root)
+        if not os.path.isdir(root):
+            print(f"jumpto: '{root}' is not a folder")
+            return 1
+        if root not in roots:
+            roots.append(root)
+    if not roots:
+        print("jumpto --index <root>")
+        return 1
+    records = {}
+    listed = 0
+    for root in roots:
+        root_records, root_listed = scan_folders(root, old_records)
+        records.update(root_records)
+        listed += root_listed
+    pid = os.getpid()
+    with open(f"{FOLDER_INDEX_FILE}.{pid}", mode="wb") as f:
+        f.write(b"".join(os.fsencode(path) + b"\n"
+                         for path in sorted(records)))
+    with open(f"{FOLDER_RECORDS_FILE}.{pid}", mode="wb") as f:
+        marshal.dump((FOLDER_RECORDS_VERSION, roots,
+                      {path: record for path, record in records.items()
+                       if record is not None}), f)
+    os.replace(f"{FOLDER_INDEX_FILE}.{pid}", FOLDER_INDEX_FILE)
+    os.replace(f"{FOLDER_RECORDS_FILE}.{pid}", FOLDER_RECORDS_FILE)
+    print(f"jumpto: indexed {len(records)} folders under {len(roots)} "
+          f"root{'s' if len(roots) != 1 else ''} in "
+          f"{time.time() - start:.03f} seconds ({listed} listed, "
+          f"{len(records) - listed} unchanged)")
+    return 0
+
+
+def compile_find_pattern(pattern):
+    """Compiles a --find pattern into a bytes regex for one line: a glob
+    matching the whole path if it has wildcards, else a substring. It is
+    case-insensitive if it has no capitals."""
+    if not any(c in pattern for c in "*?["):
+        regex = re.escape(os.fsencode(pattern))
+    else:
+        regex = b"^"
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            end = pattern.find("]", i + 2)
+            if c == "*":
+                regex += b"[^\n]*"
+            elif c == "?":
+                regex += b"[^\n]"
+            elif c == "[" and end != -1:
+                chars = os.fsencode(pattern[i + 1:end])
+                chars = chars.replace(b"\\", b"\\\\")
+                if chars.startswith((b"!", b"^")):
+                    # Not a character of the path, nor the end of its line.
+                    chars = b"^\n" + chars[1:]
+                regex += b"[" + chars + b"]"
+                i = end
+            else:
+                regex += re.escape(os.fsencode(c))
+            i += 1
+        regex += b"$"
+    flags = re.M if pattern != pattern.lower() else re.M | re.I
+    return re.compile(regex, flags)
+
+
+def find_folders(pattern):
+    """Returns the indexed folders matching a --find pattern, or None if
+    nothing has been indexed.
+
+    Raises ValueError if the pattern is invalid.
+    """
+    import mmap
+    try:
+        pattern = compile_find_pattern(pattern)
+    except re.error as e:
+        raise ValueError(f"invalid pattern: {e}")
+    try:
+        with open(FOLDER_INDEX_FILE, mode="rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                return [os.fsdecode(index[start:end]) for start, end in
+                        find_lines(index, pattern, b"\n")]
+    except FileNotFoundError:
+        return None
+
+
+def find(pattern):
+    """Jumps to an indexed folder matching a pattern, prompting for which
+    one if several do."""
+    try:
+        matches = find_folders(pattern)
+    except ValueError as e:
+        print(f"jumpto: {e}")
+        return 1
+    if matches is None:
+        print("jumpto: no folders indexed yet; see jumpto --index <root>")
+        return 1
+    if not matches:
+        print(f"jumpto: no indexed folder matches '{pattern}'")
+        return 1
+    if len(matches) == 1:
+        print(f"jumpto: jumping to {matches[0]}")
+        return go(matches[0])
+    print(f"jumpto: {len(matches)} indexed folders match '{pattern}'")
+    if len(matches) > MAX_FOUND:
+        print(f"(showing the first {MAX_FOUND}; narrow the pattern to see "
+              f"the rest)")
+    return choose(matches[:MAX_FOUND])
+
+
+def print_usage(labels):
+    """Displays usage information and the stored labels."""
     print(f"jumpto [-s|-e|-d|-v] [label]")
+    print(f"jumpto [-l] [fragment]")
+    print(f"jumpto --index [root ...] | --find <pattern>")
     print("  -s: store cwd to jump label")
     print("  -e: edit a jump label")
     print("  -d: delete a jump label")
     print("  -v: view jump label")
+    print("  -l: list the visited folders matching a fragment, best first")
+    print("  a fragment jumps to the best label or visited folder matching it")
+    print("  --index: index the folders below the roots given now and before")
+    print("  --find: jump to an indexed folder containing <pattern>, or")
+    print("          matching it as a whole if it has wildcards (*, ?, [])")
     print("")
 
-    labels = [
-        label for label in os.listdir(JUMP_LIST) if not label.startswith(".nfs")
-    ]
     if not labels:
         print("no jump labels found")
     else:
@@ -51,101 +615,204 @@ if not sys.argv[1:]:
         maxlen = max((len(label) for label in labels), default=0)
 
         for label in sorted(labels):
-            with open(f"{JUMP_LIST}/{label}", mode="r") as f:
-                nlocs = len([line for line in f.readlines() if line.strip()])
+            nlocs = len(labels[label])
             print(f"  {label.ljust(maxlen)}"
                   f"  ({nlocs} location{'s' if nlocs > 1 else ''})")
 
-    sys.exit(0)
 
-if sys.argv[1] == "-s":
-    if not sys.argv[2:]:
-        print(f"jumpto -s <label>")
-        sys.exit(1)
-    label = sys.argv[2]
-    jumps = []
-    if os.path.exists(f"{JUMP_LIST}/{label}"):
-        with open(f"{JUMP_LIST}/{label}", mode="r") as f:
-            jumps.extend(line.strip() for line in f.readlines())
+def store(label):
+    """Adds the current directory to a label."""
     path = os.path.realpath(os.getcwd())
-    if path in jumps:
+
+    added = False
+
+    def add(labels):
+        nonlocal added
+        jumps = labels.setdefault(label, [])
+        added = path not in jumps
+        if added:
+            jumps.append(path)
+        return added
+
+    update_labels(add)
+    if not added:
         print(f"jumpto: path already stored to label '{label}': {path}")
-        sys.exit(1)
-    with open(f"{JUMP_LIST}/{label}", mode="a+") as f:
-        f.write(os.path.realpath(os.getcwd()) + "\n")
+        return 1
     print(f"jumpto: stored path to label '{label}': {path}")
-    sys.exit(0)
+    return 0
 
-if sys.argv[1] == "-e":
-    if not sys.argv[2:]:
-        print(f"jumpto -e <label>")
-        sys.exit(1)
-    label = sys.argv[2]
-    if not os.path.exists(f"{JUMP_LIST}/{label}"):
-        print(f"jumpto: label '{label}' does not exist")
-        sys.exit(1)
-    os.system(f"vim '{JUMP_LIST}/{label}'")
-    print(f"jumpto: label '{label}' edited and saved")
-    sys.exit(0)
 
-if sys.argv[1] == "-d":
-    if not sys.argv[2:]:
-        print(f"jumpto -d <label>")
-        sys.exit(1)
-    label = sys.argv[2]
-    if not os.path.exists(f"{JUMP_LIST}/{label}"):
-        print(f"jumpto: label '{label}' does not exist")
-        sys.exit(1)
-    os.remove(f"{JUMP_LIST}/{label}")
+def edit(label, jumps):
+    """Lets the user edit the locations of a label in vim."""
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(prefix=f"jumpto-{label}-")
+    try:
+        with os.fdopen(fd, mode="w") as f:
+            f.write("".join(f"{path}\n" for path in jumps))
+        os.system(f"vim '{tmp_path}'")
+        with open(tmp_path, mode="r") as f:
+            jumps = [line.strip() for line in f if line.strip()]
+    finally:
+        os.unlink(tmp_path)
+
+    def replace(labels):
+        if jumps:
+            labels[label] = jumps
+        else:
+            labels.pop(label, None)
+        return True
+
+    update_labels(replace)
+    if not jumps:
+        print(f"jumpto: label '{label}' emptied and removed")
+    else:
+        print(f"jumpto: label '{label}' edited and saved")
+    return 0
+
+
+def delete(label):
+    """Removes a label."""
+    update_labels(lambda labels: labels.pop(label, None) is not None)
     print(f"jumpto: label '{label}' removed")
-    sys.exit(0)
+    return 0
 
-if sys.argv[1] == "-v":
-    if not sys.argv[2:]:
-        print(f"jumpto -v <label>")
-        sys.exit(1)
-    label = sys.argv[2]
-    if not os.path.exists(f"{JUMP_LIST}/{label}"):
-        print(f"jumpto: label '{label}' does not exist")
-        sys.exit(1)
-    with open(f"{JUMP_LIST}/{label}", mode="r") as f:
-        jumps = [line.strip() for line in f.readlines() if line.strip()]
+
+def view(jumps):
+    """Lists the locations of a label, flagging those that are gone or
+    cannot be reached."""
+    exists = probe(jumps)
     for i, path in enumerate(jumps, 1):
         flag = ""
-        if not os.path.exists(path):
+        if path not in exists:
+            flag = "[not checked]"
+        elif exists[path] is None:
+            flag = "[unreachable]"
+        elif not exists[path]:
             flag = "[no longer exists]"
         print(f"  {i}: {path} {flag}")
-    sys.exit(0)
-
-label = sys.argv[1]
-if not os.path.exists(f"{JUMP_LIST}/{label}"):
-    print(f"jumpto: label '{label}' does not exist")
-    sys.exit(1)
-with open(f"{JUMP_LIST}/{label}", mode="r") as f:
-    jumps = [line.strip() for line in f.readlines()]
+    return 0
+
+
+def jump(label, jumps):
+    """Changes to a location of a label, prompting for which one if it has
+    several."""
     if len(jumps) == 1:
-        jump_to = jumps[0]
-    else:
-        print(f"jumpto: multiple locations defined for label '{label}'")
-        print("enter the number of the location to jump to: ")
-        for i, path in enumerate(jumps, 1):
-            flag = ""
-            if not os.path.exists(path):
-                flag = "[no longer exists]"
-            print(f"  {i}: {path} {flag}")
-        try:
-            num = int(input())
-        except KeyboardInterrupt:
-            print("\nCtrl+C received, exiting")
-            sys.exit(1)
-        if num < 1 or num > len(jumps):
-            print(f"jumpto: invalid number '{num}'")
-            sys.exit(1)
-        jump_to = jumps[num - 1]
-
-    if IS_SOURCED:
-        with open(DEST_HOLDER, "w+") as f:
+        return go(jumps[0])
+    print(f"jumpto: multiple locations defined for label '{label}'")
+    return choose(jumps)
+
+
+def choose(jumps):
+    """Prompts for which of several locations to change to."""
+    print("enter the number of the location to jump to: ")
+    view(jumps)
+    try:
+        num = int(input())
+    except KeyboardInterrupt:
+        print("\nCtrl+C received, exiting")
+        return 1
+    if num < 1 or num > len(jumps):
+        print(f"jumpto: invalid number '{num}'")
+        return 1
+    return go(jumps[num - 1])
+
+
+def go(jump_to):
+    """Changes to a location."""
+    if "_JUMPTO" in os.environ:
+        # We are being sourced through the Bash wrapper - good!
+        with open(os.environ["_JUMPTO"], "w+") as f:
             f.write(jump_to)
     else:
+        # We are not being sourced, so we have to use subshells to change
+        # cwd
         os.chdir(jump_to)
-        os.system(SHELL)
+        os.system(os.environ.get("SHELL", "/bin/bash"))
+    return 0
+
+
+def jump_fuzzy(fragment, labels):
+    """Jumps to the best label or tracked folder matching a fragment that
+    is not a label: the shortest label containing it, else the folder
+    containing it with the highest frecency, else likewise with its
+    characters in order."""
+    if not fragment:
+        print(f"jumpto: label '{fragment}' does not exist")
+        return 1
+    fold_visits()
+    matches = match_labels(fragment, labels)
+    if matches and fragment.lower() in matches[0].lower():
+        print(f"jumpto: jumping to label '{matches[0]}'")
+        return jump(matches[0], labels[matches[0]])
+    folders = match_folders(fragment, MAX_LISTED)
+    if folders and (not matches or
+                    fragment.lower() in folders[0][1].lower()):
+        exists = probe([path for _, path in folders])
+        for _, path in folders:
+            if exists.get(path):
+                print(f"jumpto: jumping to {path}")
+                return go(path)
+    if matches:
+        print(f"jumpto: jumping to label '{matches[0]}'")
+        return jump(matches[0], labels[matches[0]])
+    print(f"jumpto: label '{fragment}' does not exist")
+    return 1
+
+
+def list_folders(fragment):
+    """Lists the best tracked folders matching a fragment, or of all of
+    them, with their scores."""
+    fold_visits()
+    matches = match_folders(fragment, MAX_LISTED)
+    if not matches:
+        print("jumpto: no visited folders match" if fragment else
+              "jumpto: no visited folders tracked yet; see "
+              "jumpto_wrapper.sh --hook")
+        return 1
+    for score, path in matches:
+        print(f"  {score:8.1f}  {path}")
+    return 0
+
+
+def main(argv):
+    """Entry point for the application."""
+    os.umask(0o027)
+    os.makedirs(JUMP_LIST, mode=0o755, exist_ok=True)
+
+    if not argv[1:]:
+        print_usage(load_labels())
+        return 0
+
+    if argv[1] == "-l":
+        return list_folders(argv[2] if argv[2:] else "")
+    if argv[1] == "--index":
+        return index_folders(argv[2:])
+    if argv[1] == "--find":
+        if not argv[2:]:
+            print("jumpto --find <pattern>")
+            return 1
+        return find(argv[2])
+    option = argv[1] if argv[1] in ("-s", "-e", "-d", "-v") else None
+    if option is not None and not argv[2:]:
+        print(f"jumpto {option} <label>")
+        return 1
+    label = argv[2] if option is not None else argv[1]
+    if option == "-s":
+        return store(label)
+    labels = load_labels()
+    if option is None and label not in labels:
+        return jump_fuzzy(label, labels)
+    if label not in labels:
+        print(f"jumpto: label '{label}' does not exist")
+        return 1
+    if option == "-e":
+        return edit(label, labels[label])
+    if option == "-d":
+        return delete(label)
+    if option == "-v":
+        return view(labels[label])
+    return jump(label, labels[label])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -3,6 +3,23 @@
 if [ "${BASH_SOURCE[0]}" == "$0" ]; then
     echo "jumpto.sh: this script is meant to be sourced."
     exit 1
+elif [ "$1" == "--hook" ]; then
+    # Sourced from a bashrc: log each folder the prompt is shown in for the
+    # first time in a row, for `jumpto <fragment>`. Only shell builtins run,
+    # so the prompt is not slowed down.
+    _jumpto_visits="${JUMPTO_DIR:-/home/${USER:-$(id -un)}/.jump}/.visits"
+    _jumpto_record() {
+        if [ "$PWD" != "$_jumpto_last" ]; then
+            _jumpto_last="$PWD"
+            local now
+            printf -v now '%(%s)T' -1
+            printf '%s\t%s\n' "$now" "$PWD" 2>/dev/null >> "$_jumpto_visits"
+        fi
+    }
+    case ";$PROMPT_COMMAND;" in
+        *";_jumpto_record;"*) ;;
+        *) PROMPT_COMMAND="_jumpto_record${PROMPT_COMMAND:+;$PROMPT_COMMAND}" ;;
+    esac
 else
     script_dir="$(dirname "$(readlink -f "${BASH_SOURCE[0]}")")"
     dest_holder="$(readlink -f ~)/.jumpto.tmp"
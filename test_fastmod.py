@@ -0,0 +1,1020 @@
+"""Tests for fastmod."""
+
+import grp
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from fastmod import (COOPERATE_LEASE, DEFAULT_PRESET, SNAPSHOT_LOG_RECORD,
+                     TUNE_MAX_BLOCKSIZE, TUNE_MIN_BLOCKSIZE, Coordinator,
+                     FastMod, InodeSet, ThreadShared, Throttle, Tuner,
+                     apply_changes, apply_perm,
+                     calculate_umask_modifier, check_perm, compile_perm,
+                     get_presets, get_umask, get_umask_str, parse_args,
+                     parse_perms, start_snapshot)
+
+
+def test_calculate_umask_modifier():
+    assert calculate_umask_modifier("u=rwx,g=rwx,o=rwx") == (
+        "u+rw,g+rw,o+rw", "u+rwx,g+rwx,o+rwx")
+    assert calculate_umask_modifier("u=rwx,g=rx,o=") == ("u+rw,g+r-w,o-rwx",
+                                                         "u+rwx,g+rx-w,o-rwx")
+    assert calculate_umask_modifier("u=rx,g=rx,o=") == ("u+r-w,g+r-w,o-rwx",
+                                                        "u+rx-w,g+rx-w,o-rwx")
+    assert calculate_umask_modifier("u=,g=,o=") == ("u-rwx,g-rwx,o-rwx",
+                                                    "u-rwx,g-rwx,o-rwx")
+    assert calculate_umask_modifier("u=rw,g=rw,o=r") == (
+        "u+rw-x,g+rw-x,o+r-wx", "u+rw-x,g+rw-x,o+r-wx")
+
+
+def test_apply_perm():
+    """Tests compiled permission strings against known chmod results."""
+    def chmod(perms, mode, is_dir=False, umask=0o022):
+        return oct(apply_perm(compile_perm(perms, umask), mode, is_dir))
+
+    assert chmod("u+r,g-wx,u-r", 0o670) == oct(0o240)
+    assert chmod("777", 0o644) == oct(0o777)
+    assert chmod("%%755", 0o6644) == oct(0o755)
+    assert chmod("755", 0o2700, is_dir=True) == oct(0o2755)
+    assert chmod("00755", 0o2700, is_dir=True) == oct(0o755)
+    assert chmod("u=r", 0o777) == oct(0o477)
+    assert chmod("ug+rwX,o+rX-w,g+s,+t", 0o600) == oct(0o3664)
+    assert chmod("ug+rwX,o+rX-w,g+s,+t", 0o700) == oct(0o3775)
+    assert chmod("ug+rwX,o+rX-w", 0o600, is_dir=True) == oct(0o775)
+    assert chmod("+rwx", 0o000) == oct(0o755)
+    assert chmod("+rwx", 0o000, umask=0o007) == oct(0o770)
+    assert chmod("u+-w", 0o777) == oct(0o577)
+    assert chmod("g=rx", 0o2777, is_dir=True) == oct(0o2757)
+    assert chmod("g=rx", 0o2777) == oct(0o757)
+    assert chmod("g-s", 0o2777, is_dir=True) == oct(0o777)
+    assert chmod("=", 0o777) == oct(0o000)
+    assert chmod("u+", 0o644) == oct(0o644)
+    assert chmod("a-w,+t", 0o664) == oct(0o1444)
+    assert chmod("u+rwx,go-rwx", 0o4755) == oct(0o4700)
+
+    for perms in ("", "a", "rwx", "u.g=rw/o+x", "f+oo", "u+rwx, g+rx-w",
+                  "77777", "8"):
+        try:
+            compile_perm(perms)
+        except ValueError:
+            continue
+        raise AssertionError(f"compiled invalid permission string '{perms}'")
+
+
+def test_check_perm():
+    """Tests parsing logic for validating permissions strings."""
+    assert check_perm("u+r,g-wx,u-r") == (True, True)
+    assert check_perm("777") == (True, True)
+    assert check_perm("u=r") == (True, True)
+    assert check_perm("u+rX,g-w,g+s,+t") == (True, True)
+    assert check_perm("ug+rwX,o+rX-w,g+s,+t") == (True, True)
+    assert check_perm("+rwx") == (True, True)
+    assert check_perm("u+-w") == (True, True)
+    assert check_perm("u+w-") == (True, True)
+    assert check_perm("=") == (True, True)
+    assert check_perm("+=") == (True, True)
+
+    assert check_perm("-") == (True, False)
+    assert check_perm("+") == (True, False)
+    assert check_perm("u+") == (True, False)
+    assert check_perm("ug-") == (True, False)
+
+    assert check_perm("") == (False, False)
+    assert check_perm("a") == (False, False)
+    assert check_perm("rwx") == (False, False)
+    assert check_perm("-5") == (False, False)
+    assert check_perm("999999999999") == (False, False)
+    assert check_perm("u.g=rw/o+x") == (False, False)
+    assert check_perm("f+oo") == (False, False)
+    assert check_perm("f+oo,b-ar,+qux") == (False, False)
+    assert check_perm("u+rwx,b-ar") == (False, False)
+    assert check_perm("u+rwx, g+rx-w") == (False, False)
+    for s in ("+7", "0o7", "1_0", " 7", "7 "):
+        assert check_perm(s) == (False, False)
+
+
+def test_parse_args():
+    config = parse_args(["fastmod.exe", "."])
+    assert config.paths == ["."]
+    assert config.perms_fil == get_presets()[DEFAULT_PRESET]["fil"]
+    assert config.perms_dir == get_presets()[DEFAULT_PRESET]["dir"]
+    assert config.quiet == False
+    assert config.set_group == False
+
+    config = parse_args(["fastmod.exe", "u+w", "."])
+    assert config.paths == ["."]
+    assert config.perms_fil == "u+w"
+    assert config.perms_dir == "u+w"
+    assert config.quiet == False
+    assert config.set_group == False
+
+    config = parse_args(["fastmod.exe", "%%%%u+w", "."])
+    assert config.paths == ["."]
+    assert config.perms_fil == "u+w"
+    assert config.perms_dir == "u+w"
+    assert config.quiet == False
+    assert config.set_group == False
+
+    config = parse_args(["fastmod.exe", "u+rwx:u+r,+t", "."])
+    assert config.paths == ["."]
+    assert config.perms_fil == "u+rwx"
+    assert config.perms_dir == "u+r,+t"
+    assert config.quiet == False
+    assert config.set_group == False
+
+    config = parse_args(["fastmod.exe", "--readonly", "."])
+    assert config.paths == ["."]
+    assert config.perms_fil == get_presets()["readonly"]["fil"]
+    assert config.perms_dir == get_presets()["readonly"]["dir"]
+    assert config.quiet == False
+    assert config.set_group == False
+
+    config = parse_args(
+        ["fastmod.exe", "u+rwx:u+r,+t", ".", "..", "../././../."])
+    assert config.paths == [".", "..", "../././../."]
+    assert config.perms_fil == "u+rwx"
+    assert config.perms_dir == "u+r,+t"
+    assert config.quiet == False
+    assert config.set_group == False
+
+    config = parse_args([
+        "fastmod.exe", "-q", "-Gfoobar", "u+rwx:u+r,+t", ".", "..",
+        "../././../."
+    ])
+    assert config.paths == [".", "..", "../././../."]
+    assert config.perms_fil == "u+rwx"
+    assert config.perms_dir == "u+r,+t"
+    assert config.quiet == True
+    assert config.set_group == True
+    assert config.group == "foobar"
+
+
+def test_parse_numeric_options():
+    """Tests that numeric options only take numbers in their range."""
+    config = parse_args(["fastmod", "--max-ops=50", "--adaptive=2.5", "."])
+    assert (config.max_ops, config.adaptive_ms) == (50, 2.5)
+    assert parse_args(["fastmod", "--max-inflight=1", "."]).max_inflight == 1
+    assert parse_args(["fastmod", "--watch=0", "."]).watch == 0
+    for arg in ("--max-ops=-5", "--max-ops=0", "--max-ops=abc",
+                "--max-ops=inf", "--adaptive=nan", "--adaptive=-1",
+                "--progress=0", "--progress=-1", "--progress=x",
+                "--max-inflight=0", "--max-inflight=-3",
+                "--max-inflight=1.5", "--watch=-1", "--watch=soon"):
+        assert parse_args(["fastmod", arg, "."]) is None, arg
+
+
+def test_get_umask_str():
+    """Tests that the umask is read in-process, in the format of umask -S."""
+    old = os.umask(0o027)
+    try:
+        assert get_umask() == 0o027
+        assert get_umask_str() == "u=rwx,g=rx,o="
+    finally:
+        os.umask(old)
+
+
+def test_import_runs_nothing():
+    """Tests that importing fastmod neither runs programs nor looks up
+    users and groups."""
+    code = ("import grp, pwd, subprocess\n"
+            "def fail(*args, **kwargs): raise AssertionError(args)\n"
+            "subprocess.Popen = grp.getgrgid = pwd.getpwnam = fail\n"
+            "import fastmod\n"
+            "assert fastmod.PRESETS['umask'] is None\n")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   env={"PATH": ""})
+
+
+def test_small_run_skips_multiprocessing(tmp_path):
+    """Tests that changing a single file does not import multiprocessing."""
+    target = tmp_path / "file"
+    target.touch(mode=0o644)
+    code = ("import sys, fastmod\n"
+            "status = fastmod.main(['fastmod', '-q', '-C8', 'g+w', "
+            f"{str(target)!r}])\n"
+            "assert status == 0, status\n"
+            "assert 'multiprocessing' not in sys.modules\n")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   env={"PATH": "", "FASTMOD_CACHE_DIR": str(tmp_path)},
+                   stdout=subprocess.DEVNULL)
+    assert target.stat().st_mode & 0o777 == 0o664
+
+
+def test_auto_cores_starts_workers_lazily(tmp_path):
+    """Tests that -Cauto only starts the active workers, and that workers
+    started later take the setup of the run."""
+    root = tmp_path / "root"
+    for i in range(20):
+        (root / str(i)).mkdir(parents=True)
+        for j in range(20):
+            (root / str(i) / str(j)).touch(mode=0o644)
+    code = ("import os, time, fastmod\n"
+            "fm = fastmod.FastMod(auto_cores=True, ncpus=8, "
+            "engine='processes', blocksize=4)\n"
+            f"root = {str(root)!r}\n"
+            "result, = fm.run([root], 'g+w')\n"
+            "assert result.changed == 421, result.changed\n"
+            "pool, = fm.pools\n"
+            "assert len(pool.workers) == 2, len(pool.workers)\n"
+            "os.system('chmod -R g-w ' + root)\n"
+            "pool.start(4)\n"
+            "pool.tuning[0].value = 4\n"
+            "time.sleep(fastmod.TUNE_WINDOW / 5)\n"
+            "result, = fm.run([root], 'g+w')\n"
+            "assert result.changed == 421, result.changed\n"
+            "fm.close()\n")
+    subprocess.run([sys.executable, "-c", code], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                   env={"PATH": "/bin:/usr/bin", "FASTMOD_CORES": "2",
+                        "FASTMOD_CACHE_DIR": str(tmp_path)}, timeout=60)
+
+
+def test_parse_perms():
+    """Tests parsing of the perms specs accepted by FastMod.run()."""
+    assert parse_perms("g+w") == ("g+w", "g+w", True)
+    assert parse_perms("u+x:g+s") == ("u+x", "g+s", True)
+    assert parse_perms("u+") == ("u+", "u+", False)
+    readonly = get_presets()["readonly"]
+    assert parse_perms("--readonly") == (readonly["fil"], readonly["dir"],
+                                         True)
+    for spec in ("--nosuchpreset", "f+oo", "u+x:rwx"):
+        try:
+            parse_perms(spec)
+        except ValueError:
+            continue
+        raise AssertionError(f"parsed invalid perms spec '{spec}'")
+
+
+def test_watch(tmp_path):
+    """Tests that --watch changes entries created after the first pass and
+    stops cleanly on SIGINT."""
+    root = tmp_path / "root"
+    root.mkdir()
+    proc = subprocess.Popen(
+        [sys.executable, "fastmod.py", "-q", "--watch=0.05", "g+w", str(root)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={"PATH": "", "FASTMOD_CACHE_DIR": str(tmp_path)},
+        stdout=subprocess.DEVNULL)
+    try:
+        new = root / "dir" / "sub" / "file"
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            # Entries are recreated until the watches are in place.
+            new.parent.mkdir(parents=True, exist_ok=True)
+            new.touch(mode=0o644)
+            os.chmod(new, 0o644)
+            time.sleep(0.2)
+            if new.stat().st_mode & 0o777 == 0o664:
+                break
+        assert new.stat().st_mode & 0o777 == 0o664
+        assert new.parent.stat().st_mode & 0o020
+    finally:
+        proc.send_signal(signal.SIGINT)
+        assert proc.wait(timeout=10) == 0
+
+
+def test_snapshot_restore(tmp_path):
+    """Tests that restoring a snapshot undoes the run that wrote it, and that
+    a log cut short by a crash restores as far as it goes."""
+    root = tmp_path / "root"
+    (root / "a" / "b").mkdir(parents=True)
+    modes = {root / "a": 0o750, root / "a" / "b": 0o2755,
+             root / "a" / "f": 0o4755, root / "a" / "b" / "g": 0o640,
+             root / "h": 0o644}
+    for path, mode in modes.items():
+        path.touch()
+        os.chmod(path, mode)
+
+    def current():
+        return {path: path.stat().st_mode & 0o7777 for path in modes}
+
+    snapshot = tmp_path / "snapshot"
+    with FastMod(engine="threads", ncpus=2) as fm:
+        results = list(fm.run([str(root)], "a-rwx,u+rw:a-rx",
+                              snapshot=str(snapshot)))
+        assert results[0].changed == 6
+        assert current() != modes
+        result = fm.restore(str(snapshot))
+        assert (result.total, result.changed, result.errors) == (6, 6, 0)
+        assert current() == modes
+
+        log = tmp_path / "log"
+        start_snapshot(str(log))
+        with open(log, "ab") as f:
+            for path in (root / "h", root / "a" / "f"):
+                name = os.fsencode(path)
+                f.write(SNAPSHOT_LOG_RECORD.pack(0o100600, os.getuid(),
+                                                 os.getgid(), len(name)))
+                f.write(name)
+            f.write(SNAPSHOT_LOG_RECORD.pack(0o100600, 0, 0, 100)[:10])
+        os.chmod(root / "a" / "f", 0o600)
+        result = fm.restore(str(log))
+        assert (result.total, result.changed, result.errors) == (2, 1, 0)
+        assert (root / "h").stat().st_mode & 0o7777 == 0o600
+        assert fm.restore(str(log)).changed == 0
+
+
+def test_snapshot_before_changes(tmp_path):
+    """Tests that the originals of a batch are handed to the snapshot before
+    any entry of it changes, and that the batch is left alone if they
+    cannot be recorded."""
+    paths = [str(tmp_path / name) for name in ("a", "b", "c")]
+    for path, mode in zip(paths, (0o644, 0o664, 0o600)):
+        open(path, "w").close()
+        os.chmod(path, mode)
+    changes = compile_perm("g+w", 0o022)
+    seen = []
+
+    def record(entries):
+        seen.extend((path, st.st_mode & 0o777,
+                     os.stat(path).st_mode & 0o777)
+                    for path, st in entries)
+        return True
+
+    failed = []
+    assert apply_changes([(path, None) for path in paths], changes, None,
+                         True, failed, snapshot=record) == 2
+    assert seen == [(paths[0], 0o644, 0o644), (paths[2], 0o600, 0o600)]
+    assert failed == []
+
+    os.chmod(paths[0], 0o644)
+    assert apply_changes([(path, None) for path in paths], changes, None,
+                         True, failed, snapshot=lambda entries: False) == 0
+    assert failed == [paths[0]]
+    assert os.stat(paths[0]).st_mode & 0o777 == 0o644
+
+
+def test_snapshot_relative_paths(tmp_path):
+    """Tests that a snapshot of relative paths restores from another
+    directory, and that failed restores are reported as such."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "fastmod.py")
+    env = {"PATH": "", "FASTMOD_CACHE_DIR": str(tmp_path)}
+    root = tmp_path / "root"
+    root.mkdir(mode=0o755)
+    for name in ("a", "b"):
+        (root / name).touch(mode=0o644)
+    snapshot = tmp_path / "snapshot"
+    subprocess.run([sys.executable, script, "-q", f"--snapshot={snapshot}",
+                    "g+w", "root"], check=True, cwd=tmp_path, env=env,
+                   stdout=subprocess.DEVNULL)
+    assert (root / "a").stat().st_mode & 0o777 == 0o664
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    result = subprocess.run([sys.executable, script,
+                             f"--restore={snapshot}"], cwd=elsewhere,
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert "(3 changed, 0 already as recorded, 0 failed)" in result.stdout
+    assert (root / "a").stat().st_mode & 0o777 == 0o644
+
+    (root / "b").unlink()
+    result = subprocess.run([sys.executable, script,
+                             f"--restore={snapshot}"], cwd=elsewhere,
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 1
+    assert "(0 changed, 2 already as recorded, 1 failed)" in result.stdout
+
+
+def test_hardlinks_across_runs(tmp_path):
+    """Tests that a warm pool changes hardlinked files again in later runs,
+    with either engine."""
+    for engine in ("threads", "processes"):
+        root = tmp_path / engine
+        root.mkdir()
+        (root / "a").touch(mode=0o644)
+        os.link(root / "a", root / "b")
+        with FastMod(engine=engine, ncpus=2) as fm:
+            result, = fm.run([str(root)], "g+w")
+            assert result.stats["duplicates"] == 1
+            assert (root / "a").stat().st_mode & 0o777 == 0o664
+            result, = fm.run([str(root)], "g-w")
+            assert result.stats["duplicates"] == 1
+            assert (root / "a").stat().st_mode & 0o777 == 0o644
+            os.chmod(root / "a", 0o600)
+            result, = fm.run([str(root)], "g+r")
+            assert result.changed == 1
+            assert (root / "a").stat().st_mode & 0o777 == 0o640
+
+
+def test_cooperate(tmp_path):
+    """Tests that instances sharing a --cooperate directory change every entry
+    once between them and agree on the merged counts."""
+    root = tmp_path / "root"
+    for i in range(20):
+        (root / f"d{i}" / "sub").mkdir(parents=True)
+        (root / f"d{i}" / "f").touch(mode=0o644)
+        (root / f"d{i}" / "sub" / "g").touch(mode=0o644)
+    shared = tmp_path / "shared"
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "fastmod.py", "-q", "-C2",
+             f"--cooperate={shared}", "g+w", str(root)],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env={"PATH": "", "FASTMOD_CACHE_DIR": str(tmp_path),
+                 "FASTMOD_COOPERATE_ITEMS": "8"},
+            stdout=subprocess.PIPE, text=True)
+        for _ in range(3)
+    ]
+    outputs = [proc.communicate(timeout=30)[0] for proc in procs]
+    assert [proc.returncode for proc in procs] == [0, 0, 0]
+    for output in outputs:
+        assert "set permissions on 81 files (81 changed" in output
+    for path in [root, *root.rglob("*")]:
+        assert path.stat().st_mode & 0o020
+    assert not os.listdir(shared / "leases")
+
+
+def test_cooperate_lease_takeover(tmp_path):
+    """Tests that a lease is only taken over once it has expired."""
+    first = Coordinator(str(tmp_path), "key")
+    second = Coordinator(str(tmp_path), "key")
+    second.owner += ".second"
+    second.node += ".second"
+    first.start()
+    second.start()
+    try:
+        assert first.acquire("0")
+        assert not second.acquire("0")
+        expired = time.time() - 2 * COOPERATE_LEASE
+        os.utime(tmp_path / "leases" / "0", (expired, expired))
+        assert second.acquire("0")
+        assert not first.acquire("0")
+        second.release("0")
+        assert first.acquire("0")
+    finally:
+        first.close()
+        second.close()
+    assert os.listdir(tmp_path / "leases") == []
+
+
+def run_fastmod(tmp_path, *args, **env):
+    """Runs fastmod.py with its cache in `tmp_path`, returning the completed
+    process with its output."""
+    return subprocess.run(
+        [sys.executable, "fastmod.py", *args],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={"PATH": "", "FASTMOD_CACHE_DIR": str(tmp_path / "cache"), **env},
+        capture_output=True, text=True, timeout=60)
+
+
+def make_tree(root, ndirs, nfiles, depth=1):
+    """Creates `ndirs` folders of `nfiles` files under `root`, with two such
+    folders in each down to `depth` levels, and a mix of modes."""
+    modes = (0o600, 0o644, 0o755, 0o640, 0o664, 0o700)
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(ndirs):
+        folder = root / f"d{i}"
+        folder.mkdir()
+        for j in range(nfiles):
+            (folder / f"f{j}").touch(mode=modes[(i + j) % len(modes)])
+        if depth > 1:
+            make_tree(folder, 2, nfiles, depth - 1)
+        folder.chmod((0o755, 0o750, 0o700)[i % 3])
+
+
+def tree_modes(root):
+    """Returns the mode and group of every entry below `root`, by relative
+    path."""
+    modes = {}
+    for folder, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(folder, name)
+            st = os.lstat(path)
+            modes[os.path.relpath(path, root)] = (st.st_mode, st.st_gid)
+    return modes
+
+
+def other_group(path):
+    """Returns a group other than that of `path` that it can be given, or
+    skips the test if there is none."""
+    if os.geteuid() == 0:
+        gids = {group.gr_gid for group in grp.getgrall()}
+    else:
+        gids = set(os.getgroups()) | {os.getegid()}
+    gids.discard(os.stat(path).st_gid)
+    if not gids:
+        pytest.skip("needs a second group to give files to")
+    return str(min(gids))
+
+
+def assert_same_as_chmod(tmp_path, root, perms, *args, group=None, **env):
+    """Runs fastmod on `root` and chmod -R, and chgrp -R if given a `group`,
+    on a copy of it, and checks that both leave every entry with the same
+    mode and group."""
+    reference = tmp_path / "reference"
+    subprocess.run(["cp", "-a", str(root), str(reference)], check=True)
+    subprocess.run(["chmod", "-R", perms, str(reference)], check=True)
+    if group is not None:
+        subprocess.run(["chgrp", "-R", group, str(reference)], check=True)
+        args += (f"-G{group}",)
+    result = run_fastmod(tmp_path, *args, perms, str(root), **env)
+    assert result.returncode == 0, result.stderr
+    assert tree_modes(root) == tree_modes(reference)
+    shutil.rmtree(reference)
+    return result
+
+
+def test_index(tmp_path):
+    """Tests that --index skips directories unchanged since the last run,
+    that --full and other perms rescan them, and that a corrupt index is
+    ignored and rebuilt."""
+    root = tmp_path / "root"
+    for name in ("d1", "d2"):
+        (root / name).mkdir(parents=True)
+        (root / name / "f").touch(mode=0o644)
+    hour_ago = time.time() - 3600
+    for path in (root, root / "d1", root / "d2"):
+        # Directories modified just now are not trusted.
+        os.utime(path, (hour_ago, hour_ago))
+
+    def mode(path):
+        return path.stat().st_mode & 0o777
+
+    result = run_fastmod(tmp_path, "--index", "g+w", str(root))
+    assert result.returncode == 0, result.stderr
+    assert "(5 changed, 0 already correct)" in result.stdout
+
+    # Changing a file leaves its directory alone, so it goes unnoticed.
+    os.chmod(root / "d1" / "f", 0o644)
+    result = run_fastmod(tmp_path, "--index", "g+w", str(root))
+    assert "skipped 5 entries" in result.stdout
+    assert mode(root / "d1" / "f") == 0o644
+
+    # Adding one does not.
+    (root / "d2" / "new").touch(mode=0o644)
+    result = run_fastmod(tmp_path, "--index", "g+w", str(root))
+    assert mode(root / "d2" / "new") == 0o664
+    assert mode(root / "d1" / "f") == 0o644
+
+    # Other perms have an index of their own.
+    result = run_fastmod(tmp_path, "--index", "g+rw", str(root))
+    assert "skipped" not in result.stdout
+    assert mode(root / "d1" / "f") == 0o664
+
+    os.chmod(root / "d1" / "f", 0o644)
+    result = run_fastmod(tmp_path, "--index", "--full", "g+w", str(root))
+    assert "skipped" not in result.stdout
+    assert mode(root / "d1" / "f") == 0o664
+
+    os.chmod(root / "d1" / "f", 0o644)
+    for index in (tmp_path / "cache").glob("index-*"):
+        index.write_bytes(b"\x00corrupt")
+    result = run_fastmod(tmp_path, "--index", "g+w", str(root))
+    assert result.returncode == 0
+    assert "ignoring unreadable index" in result.stderr
+    assert mode(root / "d1" / "f") == 0o664
+    os.chmod(root / "d1" / "f", 0o644)
+    result = run_fastmod(tmp_path, "--index", "g+w", str(root))
+    assert "skipped" in result.stdout
+    assert mode(root / "d1" / "f") == 0o644
+
+
+def test_journal_resume(tmp_path):
+    """Tests that a run interrupted with --journal is finished by --resume
+    without redoing the directories it finished."""
+    root = tmp_path / "root"
+    for i in range(30):
+        (root / f"d{i}").mkdir(parents=True)
+        for j in range(10):
+            (root / f"d{i}" / f"f{j}").touch(mode=0o644)
+    proc = subprocess.Popen(
+        [sys.executable, "fastmod.py", "-C2", "--journal", "--max-ops=200",
+         "g+w", str(root)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={"PATH": "", "FASTMOD_CACHE_DIR": str(tmp_path / "cache")},
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    deadline = time.monotonic() + 10
+    while not any(path.stat().st_mode & 0o020
+                  for path in root.glob("*/*")):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    proc.send_signal(signal.SIGINT)
+    output = proc.communicate(timeout=30)[0]
+    assert proc.returncode == 128 + signal.SIGINT
+    first = int(output.split(" changed,")[0].rsplit("(", 1)[1])
+    assert 0 < first < 331
+    assert list((tmp_path / "cache").glob("journal-*"))
+
+    result = run_fastmod(tmp_path, "-C2", "--journal", "--resume", "g+w",
+                         str(root))
+    assert result.returncode == 0, result.stderr
+    assert "directories finished before the run was interrupted" in \
+        result.stdout
+    second = int(result.stdout.split(" changed,")[0].rsplit("(", 1)[1])
+    assert first + second == 331
+    for path in [root, *root.rglob("*")]:
+        assert path.stat().st_mode & 0o020
+    assert not list((tmp_path / "cache").glob("journal-*"))
+
+
+def test_filters(tmp_path):
+    """Tests that --exclude, --include and the age and owner filters leave
+    entries unchanged while still descending, and that --prune skips whole
+    subtrees."""
+    root = tmp_path / "root"
+    paths = {name: root / name for name in (
+        "a.txt", "b.log", "sub/c.txt", "sub/d.log", ".git/e.txt",
+        "old.txt")}
+    for path in paths.values():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    two_days_ago = time.time() - 2 * 86400
+    os.utime(paths["old.txt"], (two_days_ago, two_days_ago))
+
+    def changed():
+        names = {name for name, path in paths.items()
+                 if path.stat().st_mode & 0o020}
+        for path in paths.values():
+            os.chmod(path, 0o644)
+        return names
+
+    def run(*args):
+        for path in [root, *root.rglob("*")]:
+            os.chmod(path, 0o755 if path.is_dir() else 0o644)
+        result = run_fastmod(tmp_path, "-q", *args, "g+w", str(root))
+        assert result.returncode == 0, result.stderr
+        return changed()
+
+    assert run("--exclude=*.log", "--prune=.git") == {
+        "a.txt", "sub/c.txt", "old.txt"}
+    assert not (root / ".git").stat().st_mode & 0o020
+    assert run("--include=*.log") == {"b.log", "sub/d.log"}
+    assert run("--exclude-regex=/sub/") == {
+        "a.txt", "b.log", ".git/e.txt", "old.txt"}
+    assert run("--include=*.txt", "--older=1d") == {"old.txt"}
+    assert run("--newer=1d", "--prune=sub") == {"a.txt", "b.log",
+                                                ".git/e.txt"}
+    assert run(f"--owner={os.getuid()}", "--include=*.log") == {
+        "b.log", "sub/d.log"}
+    assert run(f"--in-group={os.getgid() + 1}") == set()
+
+
+def test_audit(tmp_path):
+    """Tests that --audit changes nothing, counts entries by mode and what
+    would change, writes the offending paths, and exits 0."""
+    root = tmp_path / "root"
+    (root / "sub").mkdir(parents=True)
+    os.chmod(root, 0o755)
+    os.chmod(root / "sub", 0o755)
+    for name, mode in (("a", 0o644), ("sub/b", 0o644), ("sub/c", 0o664)):
+        (root / name).touch()
+        os.chmod(root / name, mode)
+    paths = tmp_path / "paths"
+    result = run_fastmod(tmp_path, "--audit", f"--audit-paths={paths}",
+                         "g+w", str(root))
+    assert result.returncode == 0, result.stderr
+    assert "audited 5 entries: 4 would change (4 permissions, 0 group), " \
+        "1 already correct" in result.stdout
+    rows = [line.split()[:2] for line in result.stdout.splitlines()
+            if line.strip().split(" ")[0].isdigit()]
+    assert sorted(rows) == [["1", "-rw-rw-r--"], ["2", "-rw-r--r--"],
+                            ["2", "drwxr-xr-x"]]
+    assert sorted(paths.read_bytes().split(b"\0")) == sorted(
+        [b"", *(os.fsencode(root / name) for name in ("", "sub", "a",
+                                                      "sub/b"))])
+    assert (root / "a").stat().st_mode & 0o777 == 0o644
+
+    result = run_fastmod(tmp_path, "--audit", f"-G{os.getgid() + 1}", "g+w",
+                         str(root))
+    assert result.returncode == 0, result.stderr
+    assert "5 would change (4 permissions, 5 group)" in result.stdout
+    assert (root / "a").stat().st_gid == os.getgid()
+
+    result = run_fastmod(tmp_path, "--audit", "g+w", str(root),
+                         str(tmp_path / "missing"))
+    assert result.returncode == 1
+
+
+def test_hardlink_dedup(tmp_path):
+    """Tests that a file linked from several directories is changed once,
+    with either engine."""
+    for engine in ("threads", "processes"):
+        root = tmp_path / engine
+        (root / "x").mkdir(parents=True)
+        (root / "y").mkdir()
+        (root / "f").touch(mode=0o644)
+        for i in range(4):
+            (root / "x" / str(i)).touch(mode=0o644)
+            os.link(root / "x" / str(i), root / "y" / str(i))
+        result = run_fastmod(tmp_path, "-C3", f"--engine={engine}", "g+w",
+                             str(root))
+        assert result.returncode == 0, result.stderr
+        assert "(8 changed, 0 already correct)" in result.stdout
+        assert "avoided 4 duplicate operations" in result.stdout
+        for path in root.rglob("*"):
+            assert path.stat().st_mode & 0o020
+
+
+def test_inode_set():
+    """Tests claiming inodes until the set is full, and clearing it."""
+    links = InodeSet(16 * 64, ThreadShared)
+    assert links.claim(0) is None
+    assert links.claim(7) is True
+    assert links.claim(7) is False
+    claimed = [links.claim(ino) for ino in range(8, 8 + 16 * 64)]
+    assert None in claimed
+    assert claimed.count(True) <= 16 * 48
+    links.clear()
+    assert links.claim(7) is True
+    assert links.claim(8) is True
+
+
+def tune(tuner, rate):
+    """Steps `tuner` until it is done, with the rate `rate(cores, blocksize)`
+    for every window, returning the (cores, blocksize) tried after each
+    step."""
+    tried = []
+    while tuner.phases:
+        tuner.step(rate(tuner.active.value, tuner.blocksize.value))
+        tried.append((tuner.active.value, tuner.blocksize.value))
+        assert len(tried) < 20, tried
+    return tried
+
+
+def test_tuner_cores():
+    """Tests that -Cauto doubles the workers until the rate stops improving
+    by TUNE_MIN_GAIN, goes back to the best count, and stops at the
+    limit."""
+    grown = []
+    tuner = Tuner([], SimpleNamespace(value=1), SimpleNamespace(value=64),
+                  16, True, False, grow=grown.append)
+    assert tune(tuner, lambda cores, _: 100 * min(cores, 4)) == [
+        (2, 64), (4, 64), (8, 64), (4, 64)]
+    assert grown == [2, 4, 8]
+    assert tuner.best == {"cores": 4, "blocksize": 64}
+
+    # A 4% gain is not enough to keep going.
+    tuner = Tuner([], SimpleNamespace(value=1), SimpleNamespace(value=64),
+                  16, True, False)
+    assert tune(tuner, lambda cores, _: 100 * 1.04 ** cores) == [
+        (2, 64), (1, 64)]
+
+    tuner = Tuner([], SimpleNamespace(value=1), SimpleNamespace(value=64),
+                  6, True, False)
+    assert tune(tuner, lambda cores, _: 100 * cores) == [
+        (2, 64), (4, 64), (6, 64), (6, 64)]
+    assert tuner.best == {"cores": 6, "blocksize": 64}
+    assert tuner.windows == 4
+
+
+def test_tuner_blocksize():
+    """Tests that -Bauto doubles the batch size while that helps, halves it
+    if doubling did not, and stays within the limits."""
+    def peak(best):
+        return lambda _, blocksize: 1000 - 100 * abs(
+            blocksize.bit_length() - best.bit_length())
+
+    tuner = Tuner([], SimpleNamespace(value=2), SimpleNamespace(value=64),
+                  8, False, True)
+    assert tune(tuner, peak(256)) == [
+        (2, 128), (2, 256), (2, 512), (2, 256)]
+    assert tuner.best == {"cores": 2, "blocksize": 256}
+
+    tuner = Tuner([], SimpleNamespace(value=2), SimpleNamespace(value=64),
+                  8, False, True)
+    assert tune(tuner, peak(32)) == [(2, 128), (2, 32), (2, 16), (2, 32)]
+    assert tuner.best["blocksize"] == 32
+
+    tuner = Tuner([], SimpleNamespace(value=2), SimpleNamespace(value=32),
+                  8, False, True)
+    assert tune(tuner, lambda _, blocksize: 1000 / blocksize) == [
+        (2, 64), (2, 16), (2, 16)]
+    assert tuner.best["blocksize"] == TUNE_MIN_BLOCKSIZE
+
+    tuner = Tuner([], SimpleNamespace(value=2), SimpleNamespace(value=2048),
+                  8, False, True)
+    assert tune(tuner, lambda _, blocksize: blocksize) == [
+        (2, 4096), (2, 4096)]
+    assert tuner.best["blocksize"] == TUNE_MAX_BLOCKSIZE
+
+
+def test_tuner_cores_then_blocksize():
+    """Tests that the batch size is tuned from the best worker count."""
+    tuner = Tuner([], SimpleNamespace(value=1), SimpleNamespace(value=64),
+                  16, True, True)
+    assert tune(tuner, lambda cores, blocksize:
+                min(cores, 2) * min(blocksize, 128)) == [
+        (2, 64), (4, 64), (2, 128), (2, 256), (2, 128)]
+    assert tuner.best == {"cores": 2, "blocksize": 128}
+
+
+def test_throttle():
+    """Tests that workers sharing a bucket keep to its rate once its initial
+    credit is spent, and that --adaptive slows down on slow operations."""
+    shared = Throttle.create_shared(1000, ThreadShared)
+    throttles = [Throttle(shared, 1000, None, 10) for _ in range(2)]
+    start = time.monotonic()
+    for _ in range(750):
+        for throttle in throttles:
+            throttle.charge()
+    elapsed = time.monotonic() - start
+    assert 0.45 <= elapsed < 1.5, elapsed
+
+    shared = Throttle.create_shared(0, ThreadShared)
+    throttle = Throttle(shared, 0, 1e6, 10)
+    deadline = time.monotonic() + Throttle.ADJUST_INTERVAL
+    while time.monotonic() < deadline:
+        throttle.charge(5e6)
+        time.sleep(0.001)
+    throttle.charge(5e6)
+    throttle.settle()
+    assert 0 < shared[0][Throttle.RATE] < 1000
+
+
+def test_max_ops(tmp_path):
+    """Tests that --max-ops slows a run down to about the given rate."""
+    root = tmp_path / "root"
+    for i in range(10):
+        (root / str(i)).mkdir(parents=True)
+        for j in range(30):
+            (root / str(i) / str(j)).touch(mode=0o644)
+    start = time.monotonic()
+    # About 630 listings, stats and chmods, the first 300 of them free.
+    result = run_fastmod(tmp_path, "-C2", "--max-ops=300", "g+w", str(root))
+    elapsed = time.monotonic() - start
+    assert result.returncode == 0, result.stderr
+    assert "(311 changed, 0 already correct)" in result.stdout
+    assert 1.0 <= elapsed < 5, elapsed
+
+
+def test_parallel_traversal(tmp_path):
+    """Tests that scanning a deep tree across the workers, with batches of
+    any size, changes the same entries in the same way as chmod -R and
+    chgrp -R."""
+    for engine in ("threads", "processes"):
+        root = tmp_path / engine
+        make_tree(root, 12, 8, depth=4)
+        for perms, cores, blocksize in (("ug+rwX,o-w", "-C1", "-B1"),
+                                        ("go-rwx", "-C8", "-B7"),
+                                        ("u=rwX,g=rX,o=", "-C8", "-B1000")):
+            assert_same_as_chmod(tmp_path, root, perms, cores, blocksize,
+                                 FASTMOD_ENGINE=engine)
+        assert_same_as_chmod(tmp_path, root, "a+rX", "-C8", "-B7",
+                             group=other_group(root), FASTMOD_ENGINE=engine)
+
+
+def test_packed_directories(tmp_path):
+    """Tests that subdirectories packed into queue messages of up to
+    MAX_DIR_CHUNK names, including names that are not valid UTF-8, are all
+    changed like chmod -R and chgrp -R would."""
+    root = tmp_path / "root"
+    for count, kind in ((500, "wide"), (65, "chunk"), (3, "few")):
+        for i in range(count):
+            (root / kind / str(i)).mkdir(parents=True)
+            (root / kind / str(i) / "f").touch(mode=0o644)
+    for name in (" a b", "new\nline", "caf\u00e9", os.fsdecode(b"\xff")):
+        (root / "odd" / name).mkdir(parents=True)
+        (root / "odd" / name / name).touch(mode=0o600)
+    for engine in ("threads", "processes"):
+        for perms, cores in (("g+w", "-C1"), ("g-w,o-r", "-C2"),
+                             ("a+rX", "-C8")):
+            assert_same_as_chmod(tmp_path, root, perms, cores,
+                                 FASTMOD_ENGINE=engine)
+    assert_same_as_chmod(tmp_path, root, "go-rwx", "-C8",
+                         group=other_group(root), FASTMOD_ENGINE="processes")
+
+
+def test_max_inflight(tmp_path):
+    """Tests that a wide tree is still fully changed when --max-inflight
+    bounds the queue to its minimum."""
+    root = tmp_path / "root"
+    make_tree(root, 300, 4, depth=2)
+    for engine in ("threads", "processes"):
+        assert_same_as_chmod(tmp_path, root, "ug+rwX,o-w", "-C4",
+                             "--max-inflight=1", FASTMOD_ENGINE=engine)
+        assert_same_as_chmod(tmp_path, root, "go-rwx", "-C4",
+                             "--max-inflight=1", FASTMOD_ENGINE=engine)
+
+
+def test_progress(tmp_path):
+    """Tests the format of the lines printed by --progress."""
+    root = tmp_path / "root"
+    for i in range(10):
+        (root / str(i)).mkdir(parents=True)
+        for j in range(30):
+            (root / str(i) / str(j)).touch(mode=0o644)
+    # Slowed down so that the run lasts for many intervals.
+    result = run_fastmod(tmp_path, "-C2", "--max-ops=300", "--progress=0.05",
+                         "g+w", str(root))
+    assert result.returncode == 0, result.stderr
+    lines = result.stderr.splitlines()
+    assert len(lines) > 5, result.stderr
+    for line in lines:
+        assert re.fullmatch(r"fastmod: \d+ found, \d+ applied, "
+                            r"\d+\.\d files/s, queue (\d+|\?)", line), line
+    applied = [int(line.split()[3]) for line in lines]
+    assert applied == sorted(applied) and applied[-1] > 0
+
+
+def test_metrics(tmp_path):
+    """Tests that --metrics writes the summary and the merged counts of the
+    workers."""
+    root = tmp_path / "root"
+    for i in range(3):
+        (root / str(i)).mkdir(parents=True)
+        for j in range(10):
+            (root / str(i) / str(j)).touch(mode=0o644)
+    (root / "0" / "0").chmod(0o664)
+    metrics_file = tmp_path / "metrics.json"
+    result = run_fastmod(tmp_path, "-C2", f"--metrics={metrics_file}",
+                         "g+w", str(root))
+    assert result.returncode == 0, result.stderr
+    metrics = json.loads(metrics_file.read_text())
+    summary = metrics["summary"]
+    assert (summary["total"], summary["changed"]) == (34, 33)
+    assert summary["errors"] == 0
+    counts = metrics["total"]["counts"]
+    assert counts["chmod"] == 33
+    assert (counts["directories"], counts["entries"]) == (4, 33)
+    assert sum(metrics["total"]["histograms_us_log2"]["chmod"]) == 33
+    assert len(metrics["total"]["slowest_directories"]) == 4
+    assert sum(worker["counts"]["chmod"]
+               for worker in metrics["workers"]) == 33
+
+
+def test_mounts(tmp_path):
+    """Tests that paths on different filesystems each get their own pool,
+    and that mount points below a path are only crossed with
+    --cross-mounts."""
+    if not os.path.isdir("/dev/shm") or \
+            os.stat("/dev/shm").st_dev == os.stat(tmp_path).st_dev:
+        pytest.skip("needs /dev/shm on a filesystem of its own")
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "f").touch(mode=0o644)
+    other = tempfile.mkdtemp(dir="/dev/shm")
+    try:
+        os.chmod(other, 0o755)
+        open(os.path.join(other, "g"), "w").close()
+        os.chmod(os.path.join(other, "g"), 0o644)
+        result = run_fastmod(tmp_path, "g+w", str(root), other)
+        assert result.returncode == 0, result.stderr
+        assert "(4 changed, 0 already correct)" in result.stdout
+        mounts = [line.split()[0] for line in result.stdout.splitlines()
+                  if line.startswith("  /")]
+        assert sorted(mounts)[-1] == "/dev/shm"
+        assert len(mounts) == 2
+    finally:
+        shutil.rmtree(other)
+
+    inner = root / "inner"
+    inner.mkdir()
+    if subprocess.run(["mount", "-t", "tmpfs", "tmpfs", str(inner)],
+                      stderr=subprocess.DEVNULL).returncode:
+        pytest.skip("cannot mount a tmpfs below the tree")
+    try:
+        (inner / "g").touch(mode=0o644)
+        result = run_fastmod(tmp_path, "g+w", str(root))
+        assert "not crossing into mount point" in result.stderr
+        assert not (inner / "g").stat().st_mode & 0o020
+        result = run_fastmod(tmp_path, "--cross-mounts", "g+w", str(root))
+        assert result.returncode == 0, result.stderr
+        assert f"  {inner} (tmpfs)" in result.stdout
+        assert (inner / "g").stat().st_mode & 0o020
+    finally:
+        subprocess.run(["umount", str(inner)])
+
+
+def test_worker_failure(tmp_path):
+    """Tests that a worker failing on an unexpected error ends the run with
+    an error instead of leaving it waiting for the work, with either
+    engine."""
+    root = tmp_path / "root"
+    for i in range(5):
+        (root / str(i)).mkdir(parents=True)
+        for j in range(5):
+            (root / str(i) / str(j)).touch(mode=0o644)
+    for engine in ("threads", "processes"):
+        code = ("import fastmod\n"
+                "apply_changes = fastmod.apply_changes\n"
+                "def failing(entries, *args, **kwargs):\n"
+                "    if any(path.endswith('/2/3') for path, _ in entries):\n"
+                "        raise RuntimeError('injected')\n"
+                "    return apply_changes(entries, *args, **kwargs)\n"
+                "fastmod.apply_changes = failing\n"
+                "raise SystemExit(fastmod.main(['fastmod', '-C2', '-B1', "
+                f"'--engine={engine}', 'g+w', {str(root)!r}]))\n")
+        result = subprocess.run([sys.executable, "-c", code],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env={"PATH": "",
+                                     "FASTMOD_CACHE_DIR": str(tmp_path)},
+                                capture_output=True, text=True, timeout=60)
+        assert result.returncode == 1, result.stderr
+        assert "RuntimeError: injected" in result.stderr
+        assert "was not finished: 1 worker failure" in result.stderr
+        assert not (root / "2" / "3").stat().st_mode & 0o020
+        assert (root / "4" / "4").stat().st_mode & 0o020
+        for path in [root, *root.rglob("*")]:
+            os.chmod(path, 0o755 if path.is_dir() else 0o644)
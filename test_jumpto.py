@@ -0,0 +1,222 @@
+"""Tests for jumpto."""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def jumpto(tmp_path, *args, cwd=None, dest=None):
+    """Runs jumpto with its labels under `tmp_path`, returning its exit status
+    and output."""
+    env = {"PATH": os.environ.get("PATH", ""),
+           "JUMPTO_DIR": str(tmp_path / "jump")}
+    if dest is not None:
+        env["_JUMPTO"] = str(dest)
+    proc = subprocess.run(
+        [sys.executable, os.path.join(HERE, "jumpto.py"), *args],
+        cwd=cwd or tmp_path, env=env, stdout=subprocess.PIPE, text=True)
+    return proc.returncode, proc.stdout
+
+
+def test_migrates_label_files(tmp_path):
+    """Tests that per-label files are copied into the store once and moved
+    out of the way."""
+    jump = tmp_path / "jump"
+    jump.mkdir()
+    (jump / "proj").write_text(f"{tmp_path}\n\n/nonexistent\n")
+    (jump / ".nfs0001").write_text("junk\n")
+    status, output = jumpto(tmp_path)
+    assert status == 0
+    assert "proj  (2 locations)" in output
+    assert json.loads((jump / ".labels.json").read_text()) == {
+        "proj": [str(tmp_path), "/nonexistent"]
+    }
+    assert not (jump / "proj").exists()
+    assert (jump / ".migrated" / "proj").exists()
+
+
+def test_store_jump_delete(tmp_path):
+    """Tests storing, jumping to and deleting a label."""
+    dest = tmp_path / "dest"
+    assert jumpto(tmp_path, "-s", "here")[0] == 0
+    assert jumpto(tmp_path, "-s", "here")[0] == 1
+    assert jumpto(tmp_path, "here", dest=dest)[0] == 0
+    assert dest.read_text() == os.path.realpath(tmp_path)
+    assert jumpto(tmp_path, "-d", "here")[0] == 0
+    status, output = jumpto(tmp_path, "here")
+    assert status == 1
+    assert "does not exist" in output
+
+
+def test_concurrent_stores(tmp_path):
+    """Tests that labels stored by concurrent shells are all kept."""
+    env = {"PATH": os.environ.get("PATH", ""),
+           "JUMPTO_DIR": str(tmp_path / "jump")}
+    procs = []
+    for i in range(8):
+        (tmp_path / f"d{i}").mkdir()
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "jumpto.py"), "-s", f"l{i}"],
+            cwd=tmp_path / f"d{i}", env=env, stdout=subprocess.DEVNULL))
+    assert [proc.wait() for proc in procs] == [0] * 8
+    labels = json.loads((tmp_path / "jump" / ".labels.json").read_text())
+    assert sorted(labels) == [f"l{i}" for i in range(8)]
+
+
+def test_tracked_folders(tmp_path):
+    """Tests that folders logged by the prompt hook are ranked by visits and
+    found by a fragment of their path."""
+    build = tmp_path / "proj" / "alpha_build"
+    src = tmp_path / "other" / "src"
+    build.mkdir(parents=True)
+    src.mkdir(parents=True)
+    (tmp_path / "jump").mkdir()
+    script = (f"source {HERE}/jumpto_wrapper.sh --hook; "
+              f"for d in {build} {build} {src} {tmp_path} {build}; do "
+              f"cd $d; eval \"$PROMPT_COMMAND\"; done")
+    subprocess.run(["bash", "-c", script], check=True,
+                   env={"JUMPTO_DIR": str(tmp_path / "jump")})
+    status, output = jumpto(tmp_path, "-l")
+    assert status == 0
+    assert output.split()[1::2] == [str(build), str(src), str(tmp_path)]
+    assert not (tmp_path / "jump" / ".visits").exists()
+
+    dest = tmp_path / "dest"
+    assert jumpto(tmp_path, "alpha", dest=dest)[0] == 0
+    assert dest.read_text() == str(build)
+    assert jumpto(tmp_path, "othsrc", dest=dest)[0] == 0
+    assert dest.read_text() == str(src)
+    assert jumpto(tmp_path, "-s", "alphalabel", cwd=src)[0] == 0
+    assert jumpto(tmp_path, "alpha", dest=dest)[0] == 0
+    assert dest.read_text() == str(src)
+
+
+def test_probe(tmp_path, monkeypatch):
+    """Tests that a location that hangs is reported as unreachable within
+    the timeout without holding up the others, and that results are
+    cached."""
+    import jumpto
+    monkeypatch.setattr(jumpto, "PROBE_TIMEOUT", 0.2)
+    monkeypatch.setattr(jumpto, "PROBE_CACHE_FILE", str(tmp_path / "probes"))
+    hung = threading.Event()
+    real_stat = os.stat
+    calls = []
+
+    def stat(path, *args, **kwargs):
+        calls.append(path)
+        if path == "/hung":
+            hung.wait(10)
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", stat)
+    paths = ["/hung", str(tmp_path), str(tmp_path / "gone")]
+    try:
+        start = time.monotonic()
+        assert jumpto.probe(paths) == {"/hung": None, str(tmp_path): True,
+                                       str(tmp_path / "gone"): False}
+        assert time.monotonic() - start < 2
+        calls.clear()
+        assert jumpto.probe(paths)["/hung"] is None
+        assert calls == []
+    finally:
+        hung.set()
+
+
+def test_probe_unchecked(tmp_path, monkeypatch):
+    """Tests that locations left unchecked because every thread is stuck
+    are neither reported nor cached as unreachable."""
+    import jumpto
+    monkeypatch.setattr(jumpto, "PROBE_THREADS", 1)
+    monkeypatch.setattr(jumpto, "PROBE_TIMEOUT", 0.2)
+    monkeypatch.setattr(jumpto, "PROBE_CACHE_FILE", str(tmp_path / "probes"))
+    hung = threading.Event()
+    real_stat = os.stat
+
+    def stat(path, *args, **kwargs):
+        if path == "/hung":
+            hung.wait(10)
+        return real_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", stat)
+    paths = ["/hung", str(tmp_path)]
+    try:
+        assert jumpto.probe(paths) == {"/hung": None}
+        with open(tmp_path / "probes") as f:
+            assert list(json.load(f)) == ["/hung"]
+        assert jumpto.probe(paths) == {"/hung": None, str(tmp_path): True}
+    finally:
+        hung.set()
+
+
+def test_index_find(tmp_path):
+    """Tests that --index finds folders below its roots, that a refresh
+    only lists folders that have changed, and that --find jumps to a
+    match."""
+    root = tmp_path / "root"
+    for i in range(3):
+        (root / f"area{i}" / "rtl").mkdir(parents=True)
+    (root / "area0" / ".git" / "objects").mkdir(parents=True)
+    old = time.time() - 60
+    for path in [root, *root.rglob("*")]:
+        os.utime(path, (old, old))
+    status, output = jumpto(tmp_path, "--index", str(root))
+    assert status == 0
+    assert "indexed 7 folders under 1 root" in output
+    assert "(7 listed, 0 unchanged)" in output
+
+    (root / "area1" / "rtl" / "newblock").mkdir()
+    status, output = jumpto(tmp_path, "--index")
+    assert "indexed 8 folders" in output
+    assert "(2 listed, 6 unchanged)" in output
+
+    dest = tmp_path / "dest"
+    assert jumpto(tmp_path, "--find", "NewBlock", dest=dest)[0] == 1
+    assert jumpto(tmp_path, "--find", "newblock", dest=dest)[0] == 0
+    assert dest.read_text() == str(root / "area1" / "rtl" / "newblock")
+    assert jumpto(tmp_path, "--find", "*/area[!01]/rtl", dest=dest)[0] == 0
+    assert dest.read_text() == str(root / "area2" / "rtl")
+    status, output = jumpto(tmp_path, "--find", "objects")
+    assert status == 1
+    assert "no indexed folder matches" in output
+
+
+def test_corrupt_labels(tmp_path):
+    """Tests that a corrupt store is reported once and left alone, and only
+    by the commands that use labels."""
+    jump = tmp_path / "jump"
+    jump.mkdir()
+    (jump / ".labels.json").write_text('{"proj": ["/x"')
+    (tmp_path / "root" / "area").mkdir(parents=True)
+    status, output = jumpto(tmp_path, "--index", str(tmp_path / "root"))
+    assert status == 0, output
+    dest = tmp_path / "dest"
+    assert jumpto(tmp_path, "--find", "area", dest=dest)[0] == 0
+    assert dest.read_text() == str(tmp_path / "root" / "area")
+    status, output = jumpto(tmp_path, "-l")
+    assert "cannot read labels" not in output
+    for args in ([], ["-s", "here"], ["proj"], ["-v", "proj"],
+                 ["-d", "proj"]):
+        status, output = jumpto(tmp_path, *args)
+        assert status == 1
+        assert output.startswith(
+            f"jumpto: cannot read labels from '{jump / '.labels.json'}'")
+        assert len(output.splitlines()) == 1
+    assert (jump / ".labels.json").read_text() == '{"proj": ["/x"'
+
+
+def test_scan_stops_threads(tmp_path):
+    """Tests that indexing a root leaves no scanner threads behind."""
+    import jumpto
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    before = threading.active_count()
+    for _ in range(3):
+        records, listed = jumpto.scan_folders(str(tmp_path), {})
+        assert listed == 3
+        assert set(records) == {str(tmp_path), str(tmp_path / "a"),
+                                str(tmp_path / "a" / "b")}
+    assert threading.active_count() == before